@@ -0,0 +1,555 @@
+"""
+API MOCK SERVER
+
+A local stand-in for the OpenAI, Anthropic, and Cohere embedding APIs, for measuring api_request_parallel_processor.py
+(or anything else that calls these APIs) without spending money on the real thing.
+
+The mock answers with well-formed responses after a configurable delay, and can be told to behave
+like a loaded production API: slow tails, server errors, and rate limits, enforced with the same
+429s and rate limit headers the real APIs send.
+
+Endpoints:
+- POST /v1/embeddings (OpenAI); embeddings are hashed bags of words, so texts sharing words get similar
+  embeddings, as with a real model (8 dimensions unless the request asks for more)
+- POST /v1/chat/completions (OpenAI); requests with tools get a call to the first (or chosen) tool,
+  with arguments made up to fit its JSON schema, as instructor and other structured output libraries expect
+- POST /v1/messages (Anthropic)
+- POST /v2/embed (Cohere); text embeddings are hashed bags of words as above, and image embeddings are random
+  unit vectors seeded by the image data, so the same image always gets the same embedding
+- POST /v1/messages/batches, GET /v1/messages/batches/{id}, and GET /v1/messages/batches/{id}/results (Anthropic Message Batches)
+- GET /stats: how many requests and tokens the mock has served, i.e. what a real API would have billed
+
+Example command to call script:
+```
+python api_mock_server.py --port 8731 --latency_seconds 0.2 --latency_distribution lognormal --error_rate 0.01
+```
+then point the processor at it, e.g. with --request_url http://127.0.0.1:8731/v1/embeddings
+
+Inputs:
+- port : int, optional
+    - port to listen on
+    - if omitted, will default to 8731
+- latency_seconds : float, optional
+    - mean time the mock waits before answering each request
+    - if omitted, will default to 0.01
+- latency_distribution : str, optional
+    - how the wait varies between requests
+    - "constant" waits latency_seconds every time
+    - "exponential" waits an exponentially distributed time with mean latency_seconds
+    - "lognormal" has mean latency_seconds too, but a long tail: about 1 request in 100 waits 6x the mean or more
+    - if omitted, will default to "constant"
+- error_rate : float, optional
+    - fraction of requests answered with a 500 (after the usual wait)
+    - if omitted, will default to 0
+- rate_limit_error_rate : float, optional
+    - fraction of requests answered with a 429 right away, regardless of the limits below
+    - if omitted, will default to 0
+- requests_per_minute : float, optional
+    - request limit to enforce; requests over it get a 429, and every response carries rate limit headers
+    - if omitted, requests are not limited
+- tokens_per_minute : float, optional
+    - token limit to enforce, counting prompt tokens plus max_tokens, as the real APIs do
+    - for /v1/messages, the unused part of max_tokens is given back once the response is made, as Anthropic's output token limit does
+    - if omitted, tokens are not limited
+- batch_seconds : float, optional
+    - how long a message batch stays in progress before it ends; error_rate applies to each request in it
+    - if omitted, will default to 1
+- upload_megabits_per_second : float, optional
+    - bandwidth of the link requests are uploaded over; no request is answered before its body would have
+      finished uploading behind those ahead of it, so big request bodies cost time as over a real link
+    - if omitted, uploads take no time
+
+Requests whose API key contains "failing" always get a 503, like a broken deployment.
+Tokens are estimated at 4 characters each; the mock doesn't need an exact count.
+"""
+
+# imports
+import argparse  # for running script from command line
+import asyncio  # for waiting before answering
+import json  # for estimating token counts
+import math  # for shaping the lognormal latency distribution
+import random  # for latencies and injected errors
+import time  # for refilling rate limits
+import zlib  # for hashing words into embeddings
+from dataclasses import dataclass  # for storing rate limit state
+from datetime import datetime, timezone  # for Anthropic's reset timestamps
+
+from aiohttp import web  # for serving HTTP
+
+
+# dataclasses
+
+
+@dataclass
+class RateLimit:
+    """A per-minute limit the mock enforces, refilling continuously like the real APIs."""
+
+    per_minute: float
+    available: float = None  # starts full
+    last_update_time: float = None
+
+    def __post_init__(self):
+        if self.available is None:
+            self.available = self.per_minute
+        if self.last_update_time is None:
+            self.last_update_time = time.time()
+
+    def refill(self, current_time: float) -> None:
+        self.available = min(
+            self.available
+            + self.per_minute * (current_time - self.last_update_time) / 60,
+            self.per_minute,
+        )
+        self.last_update_time = current_time
+
+    def seconds_until_full(self) -> float:
+        return (self.per_minute - self.available) * 60 / self.per_minute
+
+
+# functions
+
+
+def estimate_tokens(request_json: dict) -> int:
+    """Roughly count a request's prompt tokens, at 4 characters per token."""
+    if "input" in request_json:
+        prompt = request_json["input"]
+    elif "texts" in request_json or "images" in request_json:
+        prompt = request_json.get("texts") or [image[:64] for image in request_json["images"]]
+    else:
+        prompt = [request_json.get("system"), request_json.get("messages")]
+    return max(1, len(json.dumps(prompt)) // 4)
+
+
+def completion_text(max_tokens: int) -> str:
+    """Make up a completion of about `max_tokens` tokens (capped, to keep responses small)."""
+    return " ".join(["lorem"] * min(max_tokens, 16))
+
+
+def value_from_schema(schema: dict, definitions: dict) -> object:
+    """Make up a value that fits a JSON schema (as pydantic writes them): random enum members and numbers in range."""
+    if "$ref" in schema:
+        return value_from_schema(definitions[schema["$ref"].split("/")[-1]], definitions)
+    for key in ("allOf", "anyOf", "oneOf"):
+        if key in schema:
+            return value_from_schema(schema[key][0], definitions)
+    if "enum" in schema:
+        return random.choice(schema["enum"])
+    schema_type = schema.get("type", "object")
+    if schema_type == "object":
+        return {
+            name: value_from_schema(property_schema, definitions)
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [value_from_schema(schema.get("items", {}), definitions)]
+    if schema_type in ("number", "integer"):
+        low = schema.get("minimum", schema.get("exclusiveMinimum", 0))
+        high = schema.get("maximum", schema.get("exclusiveMaximum", max(low, 1)))
+        return random.randint(int(low), int(high)) if schema_type == "integer" else random.uniform(low, high)
+    if schema_type == "boolean":
+        return random.random() < 0.5
+    return completion_text(4)
+
+
+def sample_latency(latency_seconds: float, latency_distribution: str) -> float:
+    """Draw one request's wait from the configured distribution (every distribution has mean latency_seconds)."""
+    if latency_seconds <= 0:
+        return 0.0
+    if latency_distribution == "constant":
+        return latency_seconds
+    if latency_distribution == "exponential":
+        return random.expovariate(1 / latency_seconds)
+    if latency_distribution == "lognormal":
+        sigma = 1.0
+        return random.lognormvariate(math.log(latency_seconds) - sigma**2 / 2, sigma)
+    raise ValueError(f"Unknown latency distribution {latency_distribution!r}")
+
+
+def openai_rate_limit_headers(request_limit: RateLimit, token_limit: RateLimit) -> dict:
+    """Describe the mock's rate limits in x-ratelimit-* headers, as the OpenAI API does."""
+    headers = {}
+    for name, limit in (("requests", request_limit), ("tokens", token_limit)):
+        if limit is not None:
+            headers[f"x-ratelimit-limit-{name}"] = str(int(limit.per_minute))
+            headers[f"x-ratelimit-remaining-{name}"] = str(int(limit.available))
+            headers[f"x-ratelimit-reset-{name}"] = f"{limit.seconds_until_full():.3f}s"
+    return headers
+
+
+def anthropic_rate_limit_headers(
+    request_limit: RateLimit, token_limit: RateLimit
+) -> dict:
+    """Describe the mock's rate limits in anthropic-ratelimit-* headers, as the Anthropic API does."""
+    headers = {}
+    for name, limit in (("requests", request_limit), ("tokens", token_limit)):
+        if limit is not None:
+            reset_time = datetime.fromtimestamp(
+                time.time() + limit.seconds_until_full(), tz=timezone.utc
+            )
+            headers[f"anthropic-ratelimit-{name}-limit"] = str(int(limit.per_minute))
+            headers[f"anthropic-ratelimit-{name}-remaining"] = str(int(limit.available))
+            headers[f"anthropic-ratelimit-{name}-reset"] = reset_time.isoformat(
+                timespec="seconds"
+            ).replace("+00:00", "Z")
+    return headers
+
+
+def error_response(
+    api: str, status: int, error_type: str, message: str, headers: dict = None
+) -> web.Response:
+    """Build an error in the shape the given API ("openai", "anthropic", or "cohere") uses."""
+    if api == "anthropic":
+        error_type = {
+            429: "rate_limit_error",
+            500: "api_error",
+            503: "overloaded_error",
+        }.get(status, error_type)
+        body = {"type": "error", "error": {"type": error_type, "message": message}}
+    elif api == "cohere":
+        body = {"message": message}
+    else:
+        body = {"error": {"message": message, "type": error_type}}
+        if status == 429:
+            body["error"]["code"] = "rate_limit_exceeded"
+    return web.json_response(body, status=status, headers=headers)
+
+
+def embedding_from_text(text: str, dimensions: int) -> list:
+    """Hash the text's words into a unit vector, so texts sharing words (like near-duplicates) get similar embeddings."""
+    vector = [0.0] * dimensions
+    for word in str(text).lower().split():
+        vector[zlib.crc32(word.encode()) % dimensions] += 1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def embeddings_response(request_json: dict, prompt_tokens: int) -> dict:
+    inputs = request_json["input"]
+    inputs = [inputs] if isinstance(inputs, str) else inputs
+    dimensions = request_json.get("dimensions", 8)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": embedding_from_text(text, dimensions)}
+            for i, text in enumerate(inputs)
+        ],
+        "model": request_json.get("model"),
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+def cohere_embed_response(request_json: dict, prompt_tokens: int) -> dict:
+    dimensions = request_json.get("output_dimension") or 1024
+    embeddings = [embedding_from_text(text, dimensions) for text in request_json.get("texts") or []]
+    for image in request_json.get("images") or []:
+        seeded = random.Random(zlib.crc32(image.encode()))
+        vector = [seeded.gauss(0, 1) for _ in range(dimensions)]
+        norm = math.sqrt(sum(value * value for value in vector))
+        embeddings.append([value / norm for value in vector])
+    return {
+        "id": f"mock-{random.getrandbits(48):x}",
+        "response_type": "embeddings_by_type",
+        "embeddings": {"float": embeddings},
+        "texts": request_json.get("texts") or [],
+        "meta": {
+            "api_version": {"version": "2"},
+            "billed_units": {
+                "input_tokens": prompt_tokens if request_json.get("texts") else 0,
+                "images": len(request_json.get("images") or []),
+            },
+        },
+    }
+
+
+def chat_completions_response(request_json: dict, prompt_tokens: int) -> dict:
+    n = request_json.get("n", 1)
+    max_tokens = request_json.get("max_tokens", 16)
+    text = completion_text(max_tokens)
+    completion_tokens = len(text.split()) * n
+    tools = request_json.get("tools")
+    if tools:
+        tool_choice = request_json.get("tool_choice")
+        function = tools[0]["function"]
+        if isinstance(tool_choice, dict):
+            function = next(
+                tool["function"]
+                for tool in tools
+                if tool["function"]["name"] == tool_choice["function"]["name"]
+            )
+        parameters = function.get("parameters", {})
+        arguments = json.dumps(
+            value_from_schema(parameters, parameters.get("$defs", {}))
+        )
+        completion_tokens = max(1, len(arguments) // 4) * n
+    return {
+        "id": f"chatcmpl-mock{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request_json.get("model"),
+        "choices": [
+            (
+                {
+                    "index": i,
+                    "message": {
+                        "role": "assistant",
+                        "content": None,
+                        "tool_calls": [
+                            {
+                                "id": f"call_mock{random.getrandbits(48):x}",
+                                "type": "function",
+                                "function": {
+                                    "name": function["name"],
+                                    "arguments": arguments,
+                                },
+                            }
+                        ],
+                    },
+                    "finish_reason": "tool_calls",
+                }
+                if tools
+                else {
+                    "index": i,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }
+            )
+            for i in range(n)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def messages_response(request_json: dict, prompt_tokens: int) -> dict:
+    text = completion_text(request_json.get("max_tokens", 16))
+    return {
+        "id": f"msg_mock{random.getrandbits(48):x}",
+        "type": "message",
+        "role": "assistant",
+        "model": request_json.get("model"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": prompt_tokens, "output_tokens": len(text.split())},
+    }
+
+
+def run_mock_server(
+    port: int,
+    latency_seconds: float = 0.01,
+    latency_distribution: str = "constant",
+    error_rate: float = 0.0,
+    rate_limit_error_rate: float = 0.0,
+    requests_per_minute: float = None,
+    tokens_per_minute: float = None,
+    batch_seconds: float = 1.0,
+    upload_megabits_per_second: float = None,
+) -> None:
+    """Serve the mock API until terminated."""
+    sample_latency(latency_seconds, latency_distribution)  # fail fast on an unknown distribution
+    stats = {"requests_served": 0, "tokens_served": 0}  # what the caller would be billed for
+    request_limit = None if requests_per_minute is None else RateLimit(requests_per_minute)
+    token_limit = None if tokens_per_minute is None else RateLimit(tokens_per_minute)
+    uplink = {"free_time": 0.0}  # when the upload link finishes the bodies sent so far
+
+    def handler(api: str, make_response) -> callable:
+        """Wrap a response builder with the behavior every endpoint shares: failures, rate limits, and latency."""
+        rate_limit_headers = (
+            anthropic_rate_limit_headers if api == "anthropic" else openai_rate_limit_headers
+        )
+
+        async def handle(request: web.Request) -> web.Response:
+            request_body = await request.read()
+            request_json = json.loads(request_body)
+            if upload_megabits_per_second is not None:
+                upload_start = max(time.time(), uplink["free_time"])
+                uplink["free_time"] = upload_start + len(request_body) * 8 / (upload_megabits_per_second * 1e6)
+            api_key = request.headers.get("Authorization", "") + request.headers.get(
+                "x-api-key", ""
+            )
+            if "failing" in api_key:
+                return error_response(api, 503, "server_error", "Service unavailable")
+            if random.random() < rate_limit_error_rate:
+                return error_response(
+                    api, 429, "requests", "Rate limit reached", {"retry-after": "1"}
+                )
+
+            # check & spend capacity, then describe what's left in headers
+            prompt_tokens = estimate_tokens(request_json)
+            tokens = prompt_tokens + request_json.get("max_tokens", 0)
+            current_time = time.time()
+            for limit in (request_limit, token_limit):
+                if limit is not None:
+                    limit.refill(current_time)
+            headers = rate_limit_headers(request_limit, token_limit)
+            if (request_limit is not None and request_limit.available < 1) or (
+                token_limit is not None and token_limit.available < tokens
+            ):
+                return error_response(
+                    api, 429, "requests", "Rate limit reached", headers
+                )
+            if request_limit is not None:
+                request_limit.available -= 1
+            if token_limit is not None:
+                token_limit.available -= tokens
+            headers = rate_limit_headers(request_limit, token_limit)
+
+            await asyncio.sleep(sample_latency(latency_seconds, latency_distribution))
+            if upload_megabits_per_second is not None:
+                await asyncio.sleep(max(0.0, uplink["free_time"] - time.time()))
+            if random.random() < error_rate:
+                return error_response(
+                    api,
+                    500,
+                    "server_error",
+                    "The server had an error while processing your request.",
+                )
+            response_json = make_response(request_json, prompt_tokens)
+            if api == "anthropic":
+                # settle the max_tokens charged up front against the tokens actually generated
+                unused_tokens = (
+                    request_json.get("max_tokens", 0) - response_json["usage"]["output_tokens"]
+                )
+                tokens -= unused_tokens
+                if token_limit is not None:
+                    token_limit.refill(time.time())
+                    token_limit.available = min(
+                        token_limit.available + unused_tokens, token_limit.per_minute
+                    )
+            stats["requests_served"] += 1
+            stats["tokens_served"] += tokens
+            return web.json_response(response_json, headers=headers)
+
+        return handle
+
+    batches = {}  # batch ID -> batch object, plus its requests (and results, once it has ended)
+
+    def batch_object(batch: dict) -> dict:
+        """End the batch if its time is up, and describe it as the API does."""
+        if batch["processing_status"] == "in_progress" and (
+            time.time() >= batch["created_time"] + batch_seconds
+        ):
+            batch["results"] = []
+            for batch_request in batch.pop("requests"):
+                if random.random() < error_rate:
+                    result = {
+                        "type": "errored",
+                        "error": {
+                            "type": "error",
+                            "error": {"type": "api_error", "message": "Internal server error"},
+                        },
+                    }
+                else:
+                    params = batch_request["params"]
+                    prompt_tokens = estimate_tokens(params)
+                    result = {
+                        "type": "succeeded",
+                        "message": messages_response(params, prompt_tokens),
+                    }
+                    stats["requests_served"] += 1
+                    stats["tokens_served"] += prompt_tokens + params.get("max_tokens", 0)
+                batch["results"].append(
+                    {"custom_id": batch_request["custom_id"], "result": result}
+                )
+                batch["request_counts"]["processing"] -= 1
+                batch["request_counts"][result["type"]] += 1
+            batch["processing_status"] = "ended"
+            batch["ended_at"] = datetime.now(timezone.utc).isoformat()
+            batch["results_url"] = f"{batch['base_url']}/v1/messages/batches/{batch['id']}/results"
+        return {
+            key: value
+            for key, value in batch.items()
+            if key not in ("requests", "results", "created_time", "base_url")
+        }
+
+    async def create_batch(request: web.Request) -> web.Response:
+        batch_requests = (await request.json())["requests"]
+        batch_id = f"msgbatch_mock{random.getrandbits(48):x}"
+        batches[batch_id] = {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "in_progress",
+            "request_counts": {
+                "processing": len(batch_requests),
+                "succeeded": 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "ended_at": None,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "results_url": None,
+            "requests": batch_requests,
+            "created_time": time.time(),
+            "base_url": f"{request.scheme}://{request.host}",
+        }
+        return web.json_response(batch_object(batches[batch_id]))
+
+    async def get_batch(request: web.Request) -> web.Response:
+        batch = batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return error_response("anthropic", 404, "not_found_error", "Batch not found")
+        return web.json_response(batch_object(batch))
+
+    async def get_batch_results(request: web.Request) -> web.Response:
+        batch = batches.get(request.match_info["batch_id"])
+        if batch is None or "results" not in batch:
+            return error_response("anthropic", 404, "not_found_error", "Results not found")
+        return web.Response(
+            body="".join(json.dumps(result) + "\n" for result in batch["results"]),
+            content_type="application/x-jsonl",
+        )
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=256 * 1024**2)
+    app.router.add_post("/v1/embeddings", handler("openai", embeddings_response))
+    app.router.add_post(
+        "/v1/chat/completions", handler("openai", chat_completions_response)
+    )
+    app.router.add_post("/v1/messages", handler("anthropic", messages_response))
+    app.router.add_post("/v2/embed", handler("cohere", cohere_embed_response))
+    app.router.add_post("/v1/messages/batches", create_batch)
+    app.router.add_get("/v1/messages/batches/{batch_id}", get_batch)
+    app.router.add_get("/v1/messages/batches/{batch_id}/results", get_batch_results)
+    app.router.add_get("/stats", get_stats)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+# run script
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8731)
+    parser.add_argument("--latency_seconds", type=float, default=0.01)
+    parser.add_argument(
+        "--latency_distribution",
+        default="constant",
+        choices=["constant", "exponential", "lognormal"],
+    )
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_error_rate", type=float, default=0.0)
+    parser.add_argument("--requests_per_minute", type=float, default=None)
+    parser.add_argument("--tokens_per_minute", type=float, default=None)
+    parser.add_argument("--batch_seconds", type=float, default=1.0)
+    parser.add_argument("--upload_megabits_per_second", type=float, default=None)
+    args = parser.parse_args()
+
+    # run script
+    run_mock_server(
+        port=args.port,
+        latency_seconds=args.latency_seconds,
+        latency_distribution=args.latency_distribution,
+        error_rate=args.error_rate,
+        rate_limit_error_rate=args.rate_limit_error_rate,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        batch_seconds=args.batch_seconds,
+        upload_megabits_per_second=args.upload_megabits_per_second,
+    )
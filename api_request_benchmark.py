@@ -0,0 +1,789 @@
+"""
+API REQUEST BENCHMARK
+
+Measures how fast api_request_parallel_processor.py can push requests, and how much CPU it
+burns doing so, without spending money on the real API.
+
+The benchmark starts the mock API from api_mock_server.py in a separate process, writes a synthetic
+requests file, and runs process_api_requests_from_file against the mock.
+Because the mock runs in its own process, the CPU time reported is the processor's alone.
+Each scenario reports requests/s, tokens/s (as the processor estimates them), p50 & p99 request
+latency (from first attempt to result, so including retries and time waiting for a connection),
+CPU time, and failures. On Linux, the number of write-type syscalls the processor makes is
+reported too (from /proc/self/io); it includes socket writes as well as results file writes.
+
+Thirteen kinds of scenario are run (fourteen with --workers):
+- saturated: rate limits far above what the mock can serve, so throughput is limited by the
+  dispatcher, tokenizer, and writer; run at each of --num_requests, each in a fresh process,
+  so the peak RSS reported is that run's alone
+- priority: the throttled scenario run for --priority_seconds after its initial burst, with 5% of requests
+  at priority 1 and 10% at priority -1 (in their metadata); reports latency from read to result per priority,
+  so the high-priority tail should stay near the mock's latency while normal requests queue behind the limit
+- throttled_pool: the throttled scenario spread over --pool_size targets (API keys), each with the
+  throttled limit, plus one more target whose key the mock always answers with a 503; throughput
+  should scale with the pool size, and the failing target should be ejected without losing requests
+- saturated_coalesced: the smallest saturated scenario with up to 100 embeddings inputs coalesced into each
+  request (embeddings only); the api_calls reported should drop about a hundredfold, with one result per line still
+- saturated_sharded: the saturated scenario split across --workers processes (CPU time includes the workers)
+- cache_cold / cache_warm: the same requests run twice with a response cache; the cold run fills
+  the cache, and the warm run should be answered entirely from it, without calling the mock
+- throttled: a low request limit, so the run is dominated by waiting for capacity
+  (a well-behaved dispatcher should use almost no CPU here)
+- rate_limited_static / rate_limited_adaptive: a second mock enforces its own request limit (returning
+  429s and x-ratelimit-* headers), while the processor is told the limit is twice as high; the adaptive
+  run recalibrates from the headers, the static one only learns from 429s
+- completion_tokens_static / completion_tokens_learned: Anthropic messages requests with max_tokens of 256
+  (the mock generates 16) against a mock enforcing --server_tokens_per_minute; the static run reserves
+  max_tokens for every request, the learned one reserves what responses have really used and refunds the rest
+- memory_unbounded / memory_bounded: a slow mock that fails half of all requests, run at each of
+  --memory_num_requests, without and with the processor's in-flight and error history limits; each
+  run happens in a fresh process, so the peak RSS reported is that run's alone, and should stay flat
+  across sizes when bounded
+- message_batches: Anthropic messages requests submitted through the mock's Message Batches API in
+  four batches, with 5% of requests erroring and being resubmitted; measures the polling and
+  result download path rather than throughput (each batch takes a second to end)
+- parse: no API calls; times reading and decoding --parse_num_requests requests, first the way the processor
+  used to (json.loads on each line of a plain file), then through its readers for plain, gzip, and zstd JSONL
+  and Parquet (each when its package is installed), decoding with orjson when it's installed
+- resume: the processor is run as a script and killed at random points, then restarted with --resume,
+  until it finishes; the report counts missing and duplicated results, and how many requests the
+  mock server was paid for beyond one each (only requests in flight at a kill can be paid for twice);
+  the benchmark fails if any result is missing, duplicated, or torn, or if more requests were paid for
+  twice than could have been in flight at the kills
+- resume_gz / resume_zst: the same, saving results gzip- or zstd-compressed (zst when the package is installed),
+  and reading them back through the decompressor, which fails if resuming left the file unreadable
+
+Example command to call script:
+```
+python api_request_benchmark.py --num_requests 10000 100000 1000000 --latency_seconds 0.01
+```
+
+Inputs:
+- num_requests : list of int, optional
+    - sizes of the saturated scenario; the smallest is also used for the sharded and resume scenarios
+    - if omitted, will default to 10,000, 100,000, and 1,000,000
+- endpoint : str, optional
+    - API endpoint the synthetic requests are for, "embeddings", "chat/completions", or "messages" (Anthropic)
+    - if omitted, will default to "embeddings"
+- latency_seconds : float, optional
+    - mean time the mock server waits before answering each request
+    - if omitted, will default to 0.01
+- latency_distribution : str, optional
+    - "constant", "exponential", or "lognormal"; see api_mock_server.py
+    - if omitted, will default to "constant"
+- error_rate : float, optional
+    - fraction of requests the mock answers with a 500, outside the memory scenarios
+    - if omitted, will default to 0
+- rate_limit_error_rate : float, optional
+    - fraction of requests the mock answers with a 429 regardless of limits, outside the rate_limited scenarios
+    - if omitted, will default to 0
+- throttled_requests_per_minute : float, optional
+    - request limit used in the throttled scenario
+    - if omitted, will default to 1,200
+- throttled_seconds : float, optional
+    - how long the throttled scenario should spend waiting for capacity after its initial burst
+    - if omitted, will default to 5
+- priority_seconds : float, optional
+    - how long the priority scenario should spend waiting for capacity after its initial burst
+    - if omitted, will default to 20
+- pool_size : int, optional
+    - number of healthy targets in the throttled_pool scenario
+    - if omitted, will default to 3
+- workers : int, optional
+    - number of worker processes for the saturated_sharded scenario; 1 skips the scenario
+    - if omitted, will default to 1
+- server_requests_per_minute : float, optional
+    - request limit enforced by the mock in the rate_limited scenarios, which send 10 seconds' worth of requests after the initial burst
+    - if omitted, will default to 3,000
+- server_tokens_per_minute : float, optional
+    - token limit enforced by the mock in the completion_tokens scenarios, which send 3,000 requests
+    - if omitted, will default to 600,000
+- memory_num_requests : list of int, optional
+    - sizes of the memory scenarios; pass no values to skip them
+    - if omitted, will default to 10,000 and 30,000
+- memory_latency_seconds : float, optional
+    - how long the mock server in the memory scenarios waits before answering each request
+    - if omitted, will default to 0.1
+- parse_num_requests : int, optional
+    - number of requests in the parse scenario; 0 skips it
+    - if omitted, will default to 200,000
+- resume_kills : int, optional
+    - how many times the resume scenario kills the processor; 0 skips the scenario
+    - if omitted, will default to 3
+- port : int, optional
+    - port the mock server listens on
+    - if omitted, will default to 8731
+"""
+
+# imports
+import aiohttp  # for waiting until the mock server is up
+from concurrent.futures import ProcessPoolExecutor  # for measuring peak memory of one run
+import argparse  # for running script from command line
+import asyncio  # for running the processor
+import gzip  # for writing compressed requests files and reading compressed results
+import json  # for writing the requests file
+import logging  # for silencing the processor's per-request logs
+import multiprocessing  # for running the mock server in its own process
+import os  # for cleaning up temporary files
+import random  # for picking when to kill the processor
+import resource  # for measuring CPU time
+import subprocess  # for running the processor as a script that can be killed
+import sys  # for finding the Python interpreter
+import tempfile  # for the requests and results files
+import time  # for measuring wall time
+
+from api_mock_server import run_mock_server
+from api_request_parallel_processor import (
+    numbered_requests_from_file,
+    orjson,
+    process_api_requests_from_file,
+    process_api_requests_from_file_in_shards,
+    process_api_requests_in_message_batches,
+    pyarrow,
+    request_json_from_line,
+    zstandard,
+)
+
+
+# mock server
+
+
+def start_mock_server(port: int, **server_kwargs) -> multiprocessing.Process:
+    """Start the mock server in its own process (so its CPU time isn't counted) and wait until it is up.
+
+    Keyword arguments are passed on to api_mock_server.run_mock_server.
+    """
+    server = multiprocessing.Process(
+        target=run_mock_server,
+        args=(port,),
+        kwargs=server_kwargs,
+        daemon=True,
+    )
+    server.start()
+    asyncio.run(wait_for_server(f"http://127.0.0.1:{port}"))
+    return server
+
+
+def stop_mock_server(server: multiprocessing.Process) -> None:
+    server.terminate()
+    server.join()
+
+
+async def wait_for_server(url: str, timeout_seconds: float = 10) -> None:
+    """Poll the mock server until it accepts connections."""
+    deadline = time.time() + timeout_seconds
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientConnectionError:
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+
+# benchmark
+
+
+def write_requests_file(
+    filepath: str,
+    num_requests: int,
+    endpoint: str = "embeddings",
+    priorities: list = None,
+    max_tokens: int = 16,
+) -> None:
+    """Write a synthetic job, like the one in the processor's appendix; every input is unique.
+
+    If `priorities` is given, request x gets metadata {"priority": priorities[x % len(priorities)]}.
+    """
+    with open(filepath, "w") as f:
+        for x in range(num_requests):
+            if endpoint == "chat/completions":
+                job = {
+                    "model": "gpt-4o-mini",
+                    "messages": [
+                        {"role": "user", "content": f"Say something about the number {x}."}
+                    ],
+                    "max_tokens": max_tokens,
+                }
+            elif endpoint == "messages":
+                job = {
+                    "model": "claude-3-5-haiku-latest",
+                    "max_tokens": max_tokens,
+                    "messages": [
+                        {"role": "user", "content": f"Say something about the number {x}."}
+                    ],
+                }
+            else:
+                job = {"model": "text-embedding-3-small", "input": str(x) + "\n"}
+            if priorities:
+                job["metadata"] = {"priority": priorities[x % len(priorities)]}
+            f.write(json.dumps(job) + "\n")
+
+
+def cpu_seconds() -> float:
+    """Return user + system CPU time used so far by this process and its finished children."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        usage.ru_utime
+        + usage.ru_stime
+        + children_usage.ru_utime
+        + children_usage.ru_stime
+    )
+
+
+def write_syscalls() -> int:
+    """Return the number of write-type syscalls this process has made, or None if unavailable."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def run_scenario(
+    name: str,
+    num_requests: int,
+    request_url: str,
+    max_requests_per_minute: float,
+    max_tokens_per_minute: float,
+    workers: int = 1,
+    endpoint: str = "embeddings",
+    message_batches: bool = False,
+    priorities: list = None,
+    max_tokens: int = 16,
+    **processor_kwargs,
+) -> dict:
+    """Run the processor once and return its throughput, latency, and CPU use."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        requests_filepath = os.path.join(tmpdir, "requests.jsonl")
+        save_filepath = os.path.join(tmpdir, "results.jsonl")
+        write_requests_file(
+            requests_filepath, num_requests, endpoint, priorities, max_tokens
+        )
+
+        wall_start, cpu_start, syscw_start = time.time(), cpu_seconds(), write_syscalls()
+        processor_kwargs = dict(
+            {"max_attempts": 1},
+            requests_filepath=requests_filepath,
+            save_filepath=save_filepath,
+            request_url=request_url,
+            api_key="mock-key",
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute,
+            token_encoding_name="cl100k_base",
+            logging_level=logging.ERROR,
+            **processor_kwargs,
+        )
+        if message_batches:
+            # batches aren't throttled client-side
+            for key in (
+                "max_requests_per_minute",
+                "max_tokens_per_minute",
+                "token_encoding_name",
+            ):
+                del processor_kwargs[key]
+            status_tracker = asyncio.run(
+                process_api_requests_in_message_batches(**processor_kwargs)
+            )
+        elif workers > 1:
+            status_tracker = process_api_requests_from_file_in_shards(
+                workers=workers, **processor_kwargs
+            )
+        else:
+            status_tracker = asyncio.run(
+                process_api_requests_from_file(**processor_kwargs)
+            )
+        wall_seconds, cpu_used = time.time() - wall_start, cpu_seconds() - cpu_start
+        syscw_end = write_syscalls()
+
+        with open(save_filepath) as f:
+            num_results = sum(1 for _ in f)
+        latency_p50, latency_p99 = (
+            status_tracker.request_latency.percentile(percent) for percent in (50, 99)
+        )
+
+    return {
+        "scenario": name,
+        "requests": num_results,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(num_results / wall_seconds, 1),
+        "tokens_per_second": round(status_tracker.num_tokens_consumed / wall_seconds),
+        "latency_p50_seconds": None if latency_p50 is None else round(latency_p50, 4),
+        "latency_p99_seconds": None if latency_p99 is None else round(latency_p99, 4),
+        "cpu_seconds": round(cpu_used, 3),
+        "cpu_utilization": round(cpu_used / wall_seconds, 3),
+        "write_syscalls": None if syscw_end is None else syscw_end - syscw_start,
+        "failed": status_tracker.num_tasks_failed,
+        "rate_limit_errors": status_tracker.num_rate_limit_errors,
+        "target_ejections": status_tracker.num_target_ejections,
+        "cache_hits": status_tracker.num_cache_hits,
+        "api_calls": status_tracker.num_api_calls,
+        **(
+            {
+                "latency_by_priority": {
+                    priority: {
+                        "p50_seconds": round(latency.percentile(50), 4),
+                        "p99_seconds": round(latency.percentile(99), 4),
+                    }
+                    for priority, latency in sorted(
+                        status_tracker.latency_by_priority.items(), reverse=True
+                    )
+                }
+            }
+            if priorities
+            else {}
+        ),
+    }
+
+
+def run_scenario_with_peak_rss(name: str, scenario_kwargs: dict) -> dict:
+    """Run a scenario and add the peak resident memory of the process it ran in."""
+    result = run_scenario(name, **scenario_kwargs)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    return result
+
+
+def run_scenario_in_fresh_process(name: str, **scenario_kwargs) -> dict:
+    """Run a scenario in a fresh process, since peak memory can't be reset within one."""
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(
+            run_scenario_with_peak_rss, name, scenario_kwargs
+        ).result()
+
+
+async def requests_served(base_url: str) -> int:
+    """Ask the mock server how many requests it has answered."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base_url}/stats") as response:
+            return (await response.json())["requests_served"]
+
+
+def run_parse_scenario(num_requests: int, endpoint: str = "embeddings") -> list:
+    """Time reading and decoding a requests file in each supported format, against plain json.loads per line."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        requests_filepath = os.path.join(tmpdir, "requests.jsonl")
+        write_requests_file(requests_filepath, num_requests, endpoint)
+        filepaths = [requests_filepath]
+        with open(requests_filepath, "rb") as f:
+            requests_bytes = f.read()
+        with gzip.open(requests_filepath + ".gz", "wb") as f:
+            f.write(requests_bytes)
+        filepaths.append(requests_filepath + ".gz")
+        if zstandard is not None:
+            with zstandard.open(requests_filepath + ".zst", "wb") as f:
+                f.write(requests_bytes)
+            filepaths.append(requests_filepath + ".zst")
+        if pyarrow is not None:
+            with open(requests_filepath, "rb") as f:
+                table = pyarrow.Table.from_pylist([json.loads(line) for line in f])
+            pyarrow.parquet.write_table(
+                table, os.path.join(tmpdir, "requests.parquet"), row_group_size=10_000
+            )
+            filepaths.append(os.path.join(tmpdir, "requests.parquet"))
+
+        def report(reader: str, decoder: str, filepath: str, seconds: float) -> None:
+            results.append(
+                {
+                    "scenario": "parse",
+                    "reader": reader,
+                    "decoder": decoder,
+                    "requests": num_requests,
+                    "file_megabytes": round(os.path.getsize(filepath) / 1024**2, 2),
+                    "seconds": round(seconds, 3),
+                    "requests_per_second": round(num_requests / seconds),
+                }
+            )
+
+        # the baseline: the processor's original loop
+        start_time = time.perf_counter()
+        with open(requests_filepath) as f:
+            for line in f:
+                json.loads(line)
+        report("text lines", "json", requests_filepath, time.perf_counter() - start_time)
+
+        for filepath in filepaths:
+            start_time = time.perf_counter()
+            for _, _, line in numbered_requests_from_file(filepath, 0, 0, set()):
+                request_json_from_line(line)
+            report(
+                os.path.basename(filepath),
+                (
+                    "pyarrow"  # rows arrive decoded
+                    if filepath.endswith(".parquet")
+                    else "json" if orjson is None else "orjson"
+                ),
+                filepath,
+                time.perf_counter() - start_time,
+            )
+    return results
+
+
+def run_resume_scenario(
+    num_requests: int,
+    base_url: str,
+    request_url: str,
+    num_kills: int,
+    endpoint: str = "embeddings",
+    max_requests_in_flight: int = 200,
+    compression: str = None,
+) -> dict:
+    """Kill the processor at random points, resume it until it finishes, and audit the results.
+
+    With compression ("gz" or "zst"), results are saved compressed, and read back through the same decompressor.
+    Raises RuntimeError if the audit fails.
+    """
+    processor_filepath = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "api_request_parallel_processor.py"
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        requests_filepath = os.path.join(tmpdir, "requests.jsonl")
+        save_filepath = os.path.join(tmpdir, "results.jsonl" + (f".{compression}" if compression else ""))
+        write_requests_file(requests_filepath, num_requests, endpoint)
+        command = [
+            sys.executable,
+            processor_filepath,
+            "--requests_filepath", requests_filepath,
+            "--save_filepath", save_filepath,
+            "--request_url", request_url,
+            "--api_key", "mock-key",
+            "--max_requests_per_minute", str(10**9),
+            "--max_tokens_per_minute", str(10**12),
+            "--max_attempts", "1",
+            "--max_requests_in_flight", str(max_requests_in_flight),
+            "--logging_level", str(logging.ERROR),
+        ]  # fmt: skip
+
+        served_before = asyncio.run(requests_served(base_url))
+        num_runs = 0
+        while True:
+            process = subprocess.Popen(command + (["--resume"] if num_runs else []))
+            num_runs += 1
+            if num_runs <= num_kills:
+                try:
+                    process.wait(timeout=random.uniform(0.5, 2.0))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                    continue
+            elif process.wait() != 0:
+                raise RuntimeError("processor failed after resuming")
+            if process.returncode == 0:
+                break
+        served = asyncio.run(requests_served(base_url)) - served_before
+
+        # every input is unique, so count results per input
+        results_per_input = {}
+        torn_lines = 0  # lines cut short by a kill
+        if compression == "gz":
+            results_file = gzip.open(save_filepath, "rt")
+        elif compression == "zst":
+            results_file = zstandard.open(save_filepath, "rt")
+        else:
+            results_file = open(save_filepath)
+        with results_file as f:
+            for line in f:
+                try:
+                    request_json = json.loads(line)[0]
+                except ValueError:
+                    torn_lines += 1
+                    continue
+                key = json.dumps(request_json, sort_keys=True)
+                results_per_input[key] = results_per_input.get(key, 0) + 1
+
+    result = {
+        "scenario": f"resume_{compression}" if compression else "resume",
+        "requests": num_requests,
+        "runs": num_runs,
+        "missing_results": num_requests - len(results_per_input),
+        "duplicate_results": sum(n - 1 for n in results_per_input.values()),
+        "torn_lines": torn_lines,
+        "extra_requests_paid_for": served - num_requests,
+    }
+    if (
+        result["missing_results"]
+        or result["duplicate_results"]
+        or torn_lines
+        or result["extra_requests_paid_for"] > (num_runs - 1) * max_requests_in_flight
+    ):
+        raise RuntimeError(f"resume audit failed: {json.dumps(result)}")
+    return result
+
+
+# run script
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_requests", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--endpoint",
+        default="embeddings",
+        choices=["embeddings", "chat/completions", "messages"],
+    )
+    parser.add_argument("--latency_seconds", type=float, default=0.01)
+    parser.add_argument(
+        "--latency_distribution",
+        default="constant",
+        choices=["constant", "exponential", "lognormal"],
+    )
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_error_rate", type=float, default=0.0)
+    parser.add_argument("--throttled_requests_per_minute", type=float, default=1_200)
+    parser.add_argument("--throttled_seconds", type=float, default=5)
+    parser.add_argument("--priority_seconds", type=float, default=20)
+    parser.add_argument("--pool_size", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--server_requests_per_minute", type=float, default=3_000)
+    parser.add_argument("--server_tokens_per_minute", type=float, default=600_000)
+    parser.add_argument(
+        "--memory_num_requests", type=int, nargs="*", default=[10_000, 30_000]
+    )
+    parser.add_argument("--memory_latency_seconds", type=float, default=0.1)
+    parser.add_argument("--parse_num_requests", type=int, default=200_000)
+    parser.add_argument("--resume_kills", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8731)
+    args = parser.parse_args()
+
+    server_kwargs = dict(
+        latency_seconds=args.latency_seconds,
+        latency_distribution=args.latency_distribution,
+        error_rate=args.error_rate,
+        rate_limit_error_rate=args.rate_limit_error_rate,
+    )
+    server = start_mock_server(args.port, **server_kwargs)
+    try:
+        base_url = f"http://127.0.0.1:{args.port}"
+        request_url = f"{base_url}/v1/{args.endpoint}"
+        scenario_kwargs = dict(request_url=request_url, endpoint=args.endpoint)
+
+        results = [
+            run_scenario_in_fresh_process(
+                "saturated",
+                num_requests=num_requests,
+                max_requests_per_minute=1e9,
+                max_tokens_per_minute=1e12,
+                **scenario_kwargs,
+            )
+            for num_requests in args.num_requests
+        ]
+        if args.endpoint == "embeddings":
+            results.append(
+                run_scenario(
+                    "saturated_coalesced",
+                    num_requests=args.num_requests[0],
+                    max_requests_per_minute=1e9,
+                    max_tokens_per_minute=1e12,
+                    coalesce_max_inputs=100,
+                    **scenario_kwargs,
+                )
+            )
+        results.append(
+            run_scenario(
+                "throttled",
+                # the bucket starts full, so send one minute's worth plus the waiting period
+                num_requests=int(
+                    args.throttled_requests_per_minute * (1 + args.throttled_seconds / 60)
+                ),
+                max_requests_per_minute=args.throttled_requests_per_minute,
+                max_tokens_per_minute=1e12,
+                **scenario_kwargs,
+            )
+        )
+        results.append(
+            run_scenario(
+                "priority",
+                num_requests=int(
+                    args.throttled_requests_per_minute * (1 + args.priority_seconds / 60)
+                ),
+                max_requests_per_minute=args.throttled_requests_per_minute,
+                max_tokens_per_minute=1e12,
+                priorities=[1] + [0] * 17 + [-1] * 2,
+                **scenario_kwargs,
+            )
+        )
+        results.append(
+            run_scenario(
+                "throttled_pool",
+                num_requests=int(
+                    args.pool_size
+                    * args.throttled_requests_per_minute
+                    * (1 + args.throttled_seconds / 60)
+                ),
+                max_requests_per_minute=args.throttled_requests_per_minute,
+                max_tokens_per_minute=1e12,
+                max_attempts=5,
+                targets=[
+                    dict(
+                        request_url=request_url,
+                        api_key=api_key,
+                        max_requests_per_minute=args.throttled_requests_per_minute,
+                        max_tokens_per_minute=1e12,
+                    )
+                    for api_key in [f"mock-key-{i}" for i in range(args.pool_size)]
+                    + ["mock-key-failing"]
+                ],
+                **scenario_kwargs,
+            )
+        )
+        if args.workers > 1:
+            results.append(
+                run_scenario(
+                    "saturated_sharded",
+                    num_requests=min(args.num_requests),
+                    max_requests_per_minute=1e9,
+                    max_tokens_per_minute=1e12,
+                    workers=args.workers,
+                    **scenario_kwargs,
+                )
+            )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # the synthetic requests are the same for a given size, so the warm run repeats the cold one
+            for name in ("cache_cold", "cache_warm"):
+                results.append(
+                    run_scenario(
+                        name,
+                        num_requests=min(args.num_requests),
+                        max_requests_per_minute=1e9,
+                        max_tokens_per_minute=1e12,
+                        cache_filepath=os.path.join(cache_dir, "cache.sqlite"),
+                        **scenario_kwargs,
+                    )
+                )
+        for adaptive_rate_limits in (False, True):
+            # a fresh rate-limited mock per run, so each starts with a full bucket
+            rate_limited_server = start_mock_server(
+                args.port + 1,
+                **dict(
+                    server_kwargs,
+                    rate_limit_error_rate=0.0,
+                    requests_per_minute=args.server_requests_per_minute,
+                ),
+            )
+            try:
+                results.append(
+                    run_scenario(
+                        "rate_limited_adaptive"
+                        if adaptive_rate_limits
+                        else "rate_limited_static",
+                        num_requests=int(args.server_requests_per_minute * (1 + 10 / 60)),
+                        request_url=f"http://127.0.0.1:{args.port + 1}/v1/{args.endpoint}",
+                        endpoint=args.endpoint,
+                        max_requests_per_minute=2 * args.server_requests_per_minute,
+                        max_tokens_per_minute=1e12,
+                        max_attempts=20,
+                        adaptive_rate_limits=adaptive_rate_limits,
+                    )
+                )
+            finally:
+                stop_mock_server(rate_limited_server)
+        for learn_completion_tokens in (False, True):
+            # a fresh token-limited mock per run, so each starts with a full bucket
+            token_limited_server = start_mock_server(
+                args.port + 4,
+                **dict(
+                    server_kwargs,
+                    rate_limit_error_rate=0.0,
+                    tokens_per_minute=args.server_tokens_per_minute,
+                ),
+            )
+            try:
+                results.append(
+                    run_scenario(
+                        "completion_tokens_learned"
+                        if learn_completion_tokens
+                        else "completion_tokens_static",
+                        num_requests=3_000,
+                        request_url=f"http://127.0.0.1:{args.port + 4}/v1/messages",
+                        endpoint="messages",
+                        max_tokens=256,
+                        max_requests_per_minute=1e9,
+                        max_tokens_per_minute=args.server_tokens_per_minute,
+                        max_attempts=20,
+                        learn_completion_tokens=learn_completion_tokens,
+                    )
+                )
+            finally:
+                stop_mock_server(token_limited_server)
+        if args.memory_num_requests:
+            failing_server = start_mock_server(
+                args.port + 2,
+                **dict(
+                    server_kwargs,
+                    latency_seconds=args.memory_latency_seconds,
+                    error_rate=0.5,
+                ),
+            )
+            try:
+                for num_requests in args.memory_num_requests:
+                    for bounded in (False, True):
+                        limits = (
+                            {}  # the processor's defaults
+                            if bounded
+                            else dict(max_requests_in_flight=10**9, max_error_history=10**9)
+                        )
+                        results.append(
+                            run_scenario_in_fresh_process(
+                                "memory_bounded" if bounded else "memory_unbounded",
+                                num_requests=num_requests,
+                                request_url=f"http://127.0.0.1:{args.port + 2}/v1/{args.endpoint}",
+                                endpoint=args.endpoint,
+                                max_requests_per_minute=1e9,
+                                max_tokens_per_minute=1e12,
+                                max_attempts=3,
+                                **limits,
+                            )
+                        )
+            finally:
+                stop_mock_server(failing_server)
+        batch_server = start_mock_server(
+            args.port + 3, **dict(server_kwargs, error_rate=0.05, batch_seconds=1.0)
+        )
+        try:
+            num_requests = min(args.num_requests)
+            results.append(
+                run_scenario(
+                    "message_batches",
+                    num_requests=num_requests,
+                    request_url=f"http://127.0.0.1:{args.port + 3}/v1/messages",
+                    endpoint="messages",
+                    max_requests_per_minute=1e9,
+                    max_tokens_per_minute=1e12,
+                    message_batches=True,
+                    max_attempts=5,
+                    requests_per_batch=-(-num_requests // 4),
+                    poll_interval_seconds=0.2,
+                )
+            )
+        finally:
+            stop_mock_server(batch_server)
+        if args.resume_kills > 0:
+            for compression in [None, "gz"] + (["zst"] if zstandard is not None else []):
+                results.append(
+                    run_resume_scenario(
+                        num_requests=min(args.num_requests),
+                        base_url=base_url,
+                        request_url=request_url,
+                        num_kills=args.resume_kills,
+                        endpoint=args.endpoint,
+                        compression=compression,
+                    )
+                )
+        if args.parse_num_requests > 0:
+            results.extend(run_parse_scenario(args.parse_num_requests, args.endpoint))
+    finally:
+        stop_mock_server(server)
+
+    for result in results:
+        print(json.dumps(result))
@@ -7,13 +7,29 @@ If you flood a million API requests in parallel, they'll exceed the rate limits
 To maximize throughput, parallel requests need to be throttled to stay under rate limits.
 
 This script parallelizes requests to the OpenAI API while throttling to stay under rate limits.
+It also works with the Anthropic Messages API, and can send a whole file through Anthropic's Message Batches API instead.
 
 Features:
 - Streams requests from file, to avoid running out of memory for giant jobs
+- Reads plain, gzip, or zstd JSONL, or Parquet & Arrow files row group by row group, without decompressing to disk first
+- Caps the number of requests in flight (and the error history kept for each), so memory stays flat however slow or error-prone the API gets
+- Parses and counts tokens in a background thread, ahead of the dispatcher, so the event loop never blocks on tokenization
 - Makes requests concurrently, to maximize throughput
+- Optionally packs consecutive single-input embeddings requests into one request with a list of inputs, then splits the results back per line
 - Throttles request and token usage, to stay under rate limits
-- Retries failed requests up to {max_attempts} times, to avoid missing data
+- Optionally learns how many completion tokens requests really use, reserving that instead of max_tokens and refunding the difference
+- Sends waiting requests (and retries) in order of the priority & deadline in their metadata, aging lower priorities so they don't starve
+- Optionally answers repeated requests from an on-disk cache, without calling the API or using rate limit capacity
+- Optionally spreads requests over a pool of endpoints & API keys, each with its own rate limits, ejecting failing ones for a while
+- Retries failed requests up to {max_attempts} times, with exponential backoff and jitter, to avoid missing data
+- Optionally recalibrates its rate limits from the API's x-ratelimit-* response headers, to run right at the real limit
 - Logs errors, to diagnose problems with requests
+- Reports request latency percentiles and token throughput at the end, to spot slowdowns
+- Optionally publishes live metrics (a JSON file and/or a Prometheus endpoint) and a per-attempt trace, to find the bottleneck in long runs
+- Checkpoints finished requests, so an interrupted job can resume without paying for finished requests again
+- Writes results from a single writer task in batches, optionally compressed, instead of reopening the file per result
+- Optionally shards the file across several worker processes, for jobs that saturate one CPU core
+- Optionally submits the file through Anthropic's Message Batches API, for bulk jobs that can wait for the batch discount
 
 Example command to call script:
 ```
@@ -33,20 +49,34 @@ Inputs:
     - path to the file containing the requests to be processed
     - file should be a jsonl file, where each line is a json object with API parameters and an optional metadata field
     - e.g., {"model": "text-embedding-3-small", "input": "embed me", "metadata": {"row_id": 1}}
+    - metadata may set "priority" (an integer; higher goes first, default 0) and "deadline" (Unix time in seconds,
+      or an ISO 8601 timestamp like "2024-10-01T12:00:00Z"); unreadable values are logged and ignored
+    - requests read but not yet sent are ordered by priority, then earliest deadline (none counts as last), then line number;
+      only requests within max_requests_in_flight of each other are reordered, so splice urgent lines in near where they're needed
+    - deadlines only order requests; a request finishing late is still saved, and counted as a missed deadline
     - as with all jsonl files, take care that newlines in the content are properly escaped (json.dumps does this automatically)
+    - files ending in .gz or .zst are decompressed as they're read (.zst requires the `zstandard` package);
+      resuming has to decompress the finished part of the file again, and workers and message_batches need an uncompressed file
+    - files ending in .parquet, .arrow, or .feather are read a row group (or record batch) at a time, one request per row,
+      with columns as API parameters (and an optional metadata column); null values are left out of the request (requires the `pyarrow` package)
+    - lines are parsed with `orjson`, if it's installed, which is several times faster than the json module
     - an example file is provided at examples/data/example_requests_to_parallel_process.jsonl
     - the code to generate the example file is appended to the bottom of this script
 - save_filepath : str, optional
     - path to the file where the results will be saved
     - file will be a jsonl file, where each line is an array with the original request plus the API response
     - e.g., [{"model": "text-embedding-3-small", "input": "embed me"}, {...}]
-    - if omitted, results will be saved to {requests_filename}_results.jsonl
+    - if omitted, results will be saved to {requests_filename}_results.jsonl (or .jsonl.gz / .jsonl.zst, for compressed requests)
+    - if the path ends in .gz or .zst, results are written compressed (.zst requires the `zstandard` package),
+      each batch as its own gzip member or zstd frame, so resuming can cut the file back to its last checkpoint and append to it
+      (small batches compress less well than one stream would; a larger --result_flush_interval_seconds makes them bigger)
 - request_url : str, optional
     - URL of the API endpoint to call
+    - for Anthropic, use https://api.anthropic.com/v1/messages; requests are then counted for their system prompt, messages (including image & tool blocks), tools, and max_tokens
     - if omitted, will default to "https://api.openai.com/v1/embeddings"
 - api_key : str, optional
     - API key to use
-    - if omitted, the script will attempt to read it from an environment variable {os.getenv("OPENAI_API_KEY")}
+    - if omitted, the script will attempt to read it from an environment variable {os.getenv("OPENAI_API_KEY")}, or {os.getenv("ANTHROPIC_API_KEY")} for Anthropic URLs
 - max_requests_per_minute : float, optional
     - target number of requests to make per minute (will make less if limited by tokens)
     - leave headroom by setting this to 50% or 75% of your limit
@@ -59,53 +89,262 @@ Inputs:
 - token_encoding_name : str, optional
     - name of the token encoding used, as defined in the `tiktoken` package
     - if omitted, will default to "cl100k_base" (used by `text-embedding-3-small`)
+    - Claude's tokenizer isn't public, so for Anthropic requests this encoding only gives an estimate
 - max_attempts : int, optional
     - number of times to retry a failed request before giving up
     - if omitted, will default to 5
+- max_requests_in_flight : int, optional
+    - most requests that may be started but not yet finished, counting those waiting to be retried
+    - when reached, reading from the file pauses until requests finish, which bounds memory use
+    - if omitted, will default to 1,000
+- priority_aging_seconds : float, optional
+    - waiting requests gain one priority level per this many seconds, so a stream of high-priority requests can't starve lower ones
+    - e.g. a priority 0 request that has waited 10 seconds goes ahead of a priority 1 request that has just arrived
+    - if omitted, will default to 10
+- coalesce_max_inputs : int, optional
+    - for embeddings, consecutive requests with a single string input and otherwise identical parameters (and the same priority & deadline)
+      are sent as one request with up to this many inputs; each line still gets its own result, with its own request, embedding, and metadata
+    - usage in each line's result is the coalesced request's usage, shared out in proportion to each line's estimated tokens
+    - if a coalesced request fails with a client error (4xx, other than a rate limit), or gets a response that doesn't match its inputs,
+      its lines are retried one by one, so one bad line can't fail the rest;
+      attempts the coalesced request made count toward each line's max_attempts, except the failed one
+    - max_requests_in_flight still counts lines, so raise it along with this
+    - if omitted, will default to 1 (no coalescing); the embeddings API accepts up to 2,048 inputs per request
+- coalesce_max_tokens : int, optional
+    - most estimated tokens in one coalesced request
+    - if omitted, will default to 100,000
+- max_error_history : int, optional
+    - most errors kept (and saved) per request; older ones are dropped, and the count of dropped errors is saved in their place
+    - if omitted, will default to 5
 - logging_level : int, optional
     - level of logging to use; higher numbers will log fewer messages
     - 40 = ERROR; will log only when requests fail after all retries
-    - 30 = WARNING; will log when requests his rate limits or other errors
+    - 30 = WARNING; will log when requests hit rate limits or other errors
     - 20 = INFO; will log when requests start and the status at finish
     - 10 = DEBUG; will log various things as the loop runs to see when they occur
     - if omitted, will default to 20 (INFO).
+- checkpoint_filepath : str, optional
+    - path to a sidecar file where finished requests are recorded as they are saved
+    - each record is the request's line number, the byte offset just past its line, and the results file's length once its result was saved (24 bytes per request)
+    - if omitted, will default to {save_filepath}.checkpoint
+- resume : flag, optional
+    - if set, requests recorded in the checkpoint are skipped, and reading seeks past the finished prefix of the file
+    - requests that were in flight when the job stopped are sent again
+    - results saved but not yet recorded in the checkpoint when the job stopped are cut from the results file, and their requests sent again
+    - if omitted, the checkpoint is cleared and every request is processed
+- fsync_policy : str, optional
+    - when to force results (and their checkpoint records) from the OS onto disk
+    - "never" relies on the OS; results survive the process being killed, but not a power failure
+    - "batch" fsyncs after every batch of results; "close" fsyncs once, when the job ends
+    - if omitted, will default to "never"
+- result_batch_size : int, optional
+    - most results appended to the results file (and recorded in the checkpoint) in one write
+    - if omitted, will default to 1,000
+- result_flush_interval_seconds : float, optional
+    - how long the first result of a batch may wait for others to join it before the batch is written
+    - results still waiting when the job is killed are lost, and their requests sent (and paid for) again on resume
+    - 0 writes each batch as soon as the writer is free, which costs some throughput
+    - if omitted, will default to 0.05 with a checkpoint, and 1 without
+- learn_completion_tokens : flag, optional
+    - if set, completion tokens are estimated per model from the usage reported in responses, instead of always charging n * max_tokens
+    - once 20 responses for a model have arrived, requests reserve completion_token_quantile of the last 1,000 completions (never more than max_tokens)
+    - when a response arrives, the difference between the tokens reserved and its reported usage goes back into the token capacity (or is charged, if it used more)
+    - use this when max_tokens is generous compared to typical completions; APIs that charge max_tokens against their limit up front
+      (rather than adjusting to real usage, as Anthropic's output token limit does) may then return rate limit errors, so pair it with adaptive_rate_limits
+    - if omitted, n * max_tokens is reserved for every request, and nothing is refunded
+- completion_token_quantile : float, optional
+    - quantile of recent completion lengths to reserve when learn_completion_tokens is set; higher means fewer underestimates
+    - if omitted, will default to 0.99
+- adaptive_rate_limits : flag, optional
+    - if set, request & token capacity is recalibrated from every response's rate limit headers
+    - x-ratelimit-limit-* replaces max_requests_per_minute / max_tokens_per_minute, which then only set the starting rate
+    - x-ratelimit-remaining-* caps available capacity, so the script never runs ahead of what the API will accept
+    - if omitted, the static limits are used throughout
+- targets_filepath : str, optional
+    - path to a jsonl file listing the endpoints & API keys to spread requests over, one per line
+    - e.g., {"request_url": "https://example.openai.azure.com/openai/deployments/emb/embeddings?api-version=2024-02-01", "api_key_env": "AZURE_KEY_1", "max_requests_per_minute": 600}
+    - each line may set request_url, api_key (or api_key_env, the name of an environment variable holding it), max_requests_per_minute, and max_tokens_per_minute; omitted fields take the values above
+    - each target has its own request & token capacity; requests go to whichever target can take them soonest, preferring the one with the most spare capacity
+    - a target that fails 3 requests in a row (connection errors or 5xx responses; not rate limit errors) is ejected for 10 seconds, doubling each time it fails again
+    - if every target is ejected, ejections are ignored until one comes back, so a single target is never ejected
+    - all targets must serve the same API endpoint (e.g. all embeddings)
+    - if omitted, all requests go to request_url with api_key
+- message_batches : flag, optional
+    - if set, requests are submitted through Anthropic's Message Batches API (request_url must be an Anthropic messages URL) instead of one at a time
+    - batches are billed at a discount and not throttled client-side; results arrive when each batch ends, within 24 hours
+    - each batch is polled until it ends, then its results are saved in the same format as usual; errored and expired requests are resubmitted up to max_attempts times
+    - submitted batches are logged to {checkpoint_filepath}.batches, so resuming collects their results rather than submitting them again
+    - rate limit, workers, and targets options don't apply
+- requests_per_batch : int, optional
+    - number of requests per batch (the API allows up to 100,000, and 256 MB)
+    - if omitted, will default to 10,000
+- batch_poll_seconds : float, optional
+    - how often to check whether a batch has ended
+    - if omitted, will default to 60
+- cache_filepath : str, optional
+    - path to a SQLite file caching successful responses, keyed by a hash of the API endpoint and the request (without its metadata)
+    - requests found in the cache are answered from it and saved as usual, without calling the API or using rate limit capacity
+    - the cache can be shared by several jobs (and workers); for Azure, the deployment isn't part of the key, so use one cache per model
+    - not used with message_batches
+    - if omitted, no cache is used
+- cache_max_megabytes : float, optional
+    - once the cache grows past this size, the least recently used responses are evicted
+    - if omitted, will default to 1,024
+- cache_ttl_hours : float, optional
+    - cached responses older than this are ignored (and eventually evicted)
+    - if omitted, cached responses never expire
+- metrics_filepath : str, optional
+    - path to a JSON file rewritten every metrics_interval_seconds with live metrics: request counts, how many requests are
+      waiting at each stage (parsed, scheduled, in flight, backing off, waiting to be written), request & token rates,
+      latency percentiles, errors by class, each target's available capacity, and time spent parsing and writing
+    - with workers, each worker writes its own file, named like its results file
+    - if omitted, no metrics file is written
+- metrics_interval_seconds : float, optional
+    - how often the metrics file is rewritten
+    - if omitted, will default to 10
+- metrics_port : int, optional
+    - port on 127.0.0.1 to serve the same metrics on, in Prometheus text format, at /metrics
+    - with workers, worker i serves on metrics_port + i
+    - if omitted, no metrics are served
+- trace_filepath : str, optional
+    - path to a jsonl file getting one line per API call attempt: task_id (the first line's, if coalesced), inputs (lines coalesced), attempt, target, status, error class, and the Unix times
+      the request was queued (entered the scheduler), dispatched, got its first response byte (headers), and finished
+    - comparing the gaps shows whether requests wait for capacity, the network, or the API
+    - with workers, each worker writes its own file, named like its results file
+    - not used with message_batches
+    - if omitted, no trace is written
+- workers : int, optional
+    - number of worker processes; the requests file is split into this many byte ranges (at line boundaries)
+    - each worker gets an equal share of the request & token limits (and of limits learned from headers)
+    - each worker writes its own results and checkpoint file; results are then merged into save_filepath in shard order
+    - resuming requires the same number of workers as the interrupted run
+    - if omitted, will default to 1 (no sharding)
 
 The script is structured as follows:
     - Imports
     - Define main()
         - Initialize things
+        - Load the checkpoint, if resuming
+        - Start reading requests ahead of the main loop (parsing and token counting run in a worker thread)
         - In main loop:
-            - Get next request if one is not already waiting for capacity
+            - Move requests due for retry into the scheduler
+            - Move new requests into the scheduler while under the in-flight limit, answering those the reader found in the cache
+            - Pick the scheduler's most urgent request
             - Update available token & request capacity
+            - Pick the target (endpoint & API key) that can take the request soonest
             - If enough capacity available, call API
-            - The loop pauses if a rate limit error is hit
+            - Otherwise, sleep until capacity refills or a request finishes or is queued for retry
             - The loop breaks when no tasks remain
     - Define dataclasses
+        - LatencyHistogram (counts request latencies in buckets, for percentiles in fixed memory)
         - StatusTracker (stores script metadata counters; only one instance is created)
-        - APIRequest (stores API inputs, outputs, metadata; one method to call API)
+        - CapacityBucket (tracks available capacity for one rate limit; one each for requests and tokens)
+        - CompletionTokenEstimator (learns a high quantile of completion tokens per model, from usage in responses)
+        - MetricsReporter (publishes live metrics as a JSON file and/or a Prometheus endpoint)
+        - RequestCoalescer (packs consecutive single-input embeddings requests into one request)
+        - RequestScheduler (orders waiting requests in priority lanes by deadline, raising the priority of those that have waited long)
+        - APITarget (an endpoint & API key with its own capacity buckets; ejected for a while after repeated failures)
+        - Checkpoint (append-only log of finished requests, used to resume interrupted jobs)
+        - ResultWriter (single writer task that batches results into the results file, and successful responses into the cache)
+        - ResponseCache (SQLite store of responses by request hash, with LRU eviction by size and an optional TTL)
+        - APIRequest (stores API inputs, outputs, metadata; one method to call API, one to answer from the cache; failed requests back off before retrying)
+        - MessageBatch (a group of requests submitted through the Message Batches API)
     - Define functions
+        - read_requests_ahead (reads, parses, and counts tokens for requests in chunks, in a worker thread)
+        - requests_file_format (tells the requests file's format from its name)
+        - numbered_requests_from_file (opens the requests file in its format, and yields each request with its task ID and end offset)
+        - numbered_lines_from_file (yields each line with its task ID and end offset)
+        - numbered_rows_from_table_file (yields each row of a Parquet or Arrow file with its task ID and row number)
+        - open_table_file (opens a Parquet or Arrow file for reading row group by row group)
+        - request_json_from_line (decodes a request from a line, with orjson if available)
+        - parse_request_chunk (parses a chunk of request lines, looks them up in the cache, and counts tokens for the rest)
+        - cache_key_from_request (hashes a request's canonical JSON)
+        - split_embeddings_response (splits a coalesced embeddings response back into one response per line)
+        - priority_and_deadline_from_metadata (reads a request's scheduling fields)
         - api_endpoint_from_url (extracts API endpoint from request URL)
-        - append_to_jsonl (writes to results file)
-        - num_tokens_consumed_from_request (bigger function to infer token usage from request)
-        - task_id_generator_function (yields 0, 1, 2, ...)
+        - request_header_from_url (builds the authentication header for OpenAI, Azure, or Anthropic)
+        - load_api_targets (reads the pool of endpoints & API keys from a jsonl file)
+        - choose_target (picks the target that can take a request soonest)
+        - rate_limits_from_headers (reads limits, remaining capacity, and retry delays from response headers)
+        - seconds_from_duration (parses durations like "6m0s" used by rate limit headers)
+        - seconds_until_timestamp (parses the reset timestamps used by Anthropic's rate limit headers)
+        - results_file_compressor (compresses each batch of results, if the results file's name says so)
+        - get_token_encoding (loads a tiktoken encoding once per process)
+        - num_tokens_consumed_from_request (infers token usage from one request)
+        - num_tokens_consumed_from_requests (infers token usage from many requests, encoding their text in one batch)
+        - completion_token_limits_from_request (reads max_tokens and the number of completions a request asks for)
+        - tokens_from_usage (reads completion and total tokens from a response's usage)
+        - texts_and_fixed_tokens_from_request (bigger function listing the text to encode for a request)
+        - texts_and_fixed_tokens_from_content_blocks (lists the text to encode in Anthropic content blocks)
+        - image_tokens (estimates an image's tokens from its size)
+        - log_final_status (logs the outcome of a job)
+        - process_api_requests_from_file_in_shards (runs main() in worker processes, one per shard of the file, and merges their results)
+        - shard_byte_ranges (splits the requests file into byte ranges at line boundaries)
+        - shard_filepath (names the per-shard results and checkpoint files)
+        - process_shard (runs main() on one shard, in a worker process)
+        - process_api_requests_in_message_batches (alternative to main() that submits the file through the Message Batches API)
+        - run_message_batch (submits one batch, waits for it to end, saves its results, and resubmits retryable failures)
+        - read_request_at (reads one request back from the file, to save with its batch result)
+        - call_batches_api (makes one Message Batches API call, retrying transient errors)
+        - iter_batch_results (streams a batch's results file line by line)
     - Run main()
 """
 
 # imports
 import aiohttp  # for making API calls concurrently
+from aiohttp import web  # for serving live metrics
 import argparse  # for running script from command line
 import asyncio  # for running API calls concurrently
+import base64  # for reading image sizes when counting tokens
+import collections  # for holding parsed requests until they are dispatched
+import dataclasses  # for sending status counters between processes
+import functools  # for caching token encodings
+import gzip  # for writing compressed results
+import hashlib  # for cache keys
+import io  # for buffering zstd-compressed requests
+import heapq  # for ordering waiting requests by deadline
+import itertools  # for reading the file in chunks
 import json  # for saving results to a jsonl file
 import logging  # for logging rate limit warnings and other messages
+import math  # for latency histogram buckets
 import os  # for reading API key
+import random  # for jittering retry backoff
 import re  # for matching endpoint from request URL
+import shutil  # for merging shard results
+import sqlite3  # for caching responses
+import struct  # for packing checkpoint records
+import threading  # for sharing the cache between threads
 import tiktoken  # for counting tokens
-import time  # for sleeping after rate limit is hit
+import time  # for tracking capacity refills
+from datetime import datetime  # for Anthropic's rate limit reset timestamps
+from email.utils import parsedate_to_datetime  # for retry-after headers given as dates
+from concurrent.futures import (
+    ProcessPoolExecutor,  # for running shards in worker processes
+    ThreadPoolExecutor,  # for counting tokens off the event loop
+)
 from dataclasses import (
     dataclass,
     field,
 )  # for storing API inputs, outputs, and metadata
 
+try:
+    import zstandard  # for reading & writing zstd-compressed files
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson  # for parsing requests faster
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow.ipc  # for reading Arrow requests files
+    import pyarrow.parquet  # for reading Parquet requests files
+except ImportError:
+    pyarrow = None
+
+ANTHROPIC_VERSION = "2023-06-01"  # sent as the anthropic-version header
+
 
 async def process_api_requests_from_file(
     requests_filepath: str,
@@ -117,163 +356,418 @@ async def process_api_requests_from_file(
     token_encoding_name: str,
     max_attempts: int,
     logging_level: int,
+    checkpoint_filepath: str = None,
+    resume: bool = False,
+    fsync_policy: str = "never",
+    adaptive_rate_limits: bool = False,
+    start_offset: int = 0,
+    end_offset: int = None,
+    rate_limit_share: float = 1.0,
+    targets: list = None,
+    max_requests_in_flight: int = 1_000,
+    max_error_history: int = 5,
+    priority_aging_seconds: float = 10.0,
+    coalesce_max_inputs: int = 1,
+    coalesce_max_tokens: int = 100_000,
+    learn_completion_tokens: bool = False,
+    completion_token_quantile: float = 0.99,
+    cache_filepath: str = None,
+    cache_max_bytes: int = 1024**3,
+    cache_ttl_seconds: float = None,
+    metrics_filepath: str = None,
+    metrics_interval_seconds: float = 10.0,
+    metrics_port: int = None,
+    trace_filepath: str = None,
+    result_batch_size: int = 1_000,
+    result_flush_interval_seconds: float = None,
 ):
-    """Processes API requests in parallel, throttling to stay under rate limits."""
+    """Processes API requests in parallel, throttling to stay under rate limits. Returns the final StatusTracker.
+
+    If `targets` is given (a list of dicts, as returned by load_api_targets), requests are spread over
+    those endpoints & API keys instead of request_url with api_key.
+    Only lines starting in [start_offset, end_offset) are processed; rate_limit_share scales limits
+    learned from response headers. Both are set when running as one of several shards.
+    """
     # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
-    )
+    requests_per_read_ahead_chunk = 1_000  # lines parsed and counted per trip to the worker thread
+    max_read_ahead_chunks = 4  # how far the reader may run ahead of the dispatcher
 
     # initialize logging
     logging.basicConfig(level=logging_level)
     logging.debug(f"Logging initialized at level {logging_level}")
 
-    # infer API endpoint and construct request header
-    api_endpoint = api_endpoint_from_url(request_url)
-    request_header = {"Authorization": f"Bearer {api_key}"}
-    # use api-key header for Azure deployments
-    if "/deployments" in request_url:
-        request_header = {"api-key": f"{api_key}"}
+    # initialize targets, each with its own request header and available capacity counts
+    if targets is None:
+        targets = [
+            dict(
+                request_url=request_url,
+                api_key=api_key,
+                max_requests_per_minute=max_requests_per_minute,
+                max_tokens_per_minute=max_tokens_per_minute,
+            )
+        ]
+    targets = [
+        APITarget(
+            index=index,
+            request_url=target["request_url"],
+            api_key=target["api_key"],
+            request_bucket=CapacityBucket(
+                max_per_minute=target["max_requests_per_minute"],
+                share=rate_limit_share,
+            ),
+            token_bucket=CapacityBucket(
+                max_per_minute=target["max_tokens_per_minute"],
+                share=rate_limit_share,
+            ),
+        )
+        for index, target in enumerate(targets)
+    ]
+
+    # infer API endpoint; tokens are counted once per request, so every target must serve the same one
+    api_endpoint = api_endpoint_from_url(targets[0].request_url)
+    for target in targets:
+        if api_endpoint_from_url(target.request_url) != api_endpoint:
+            raise ValueError(
+                f"All targets must serve the same API endpoint; {target.request_url} does not serve {api_endpoint}"
+            )
+
+    # initialize completion token learning
+    completion_token_estimator = None
+    if learn_completion_tokens:
+        completion_token_estimator = CompletionTokenEstimator(
+            api_endpoint=api_endpoint, quantile=completion_token_quantile
+        )
 
     # initialize trackers
     queue_of_requests_to_retry = asyncio.Queue()
-    task_id_generator = (
-        task_id_generator_function()
-    )  # generates integer IDs of 0, 1, 2, ...
     status_tracker = (
         StatusTracker()
     )  # single instance to track a collection of variables
-    next_request = None  # variable to hold the next request to call
+    scheduler = RequestScheduler(aging_seconds=priority_aging_seconds)  # requests waiting to be sent
+    coalescer = None
+    if coalesce_max_inputs > 1 and api_endpoint == "embeddings":
+        coalescer = RequestCoalescer(
+            max_inputs=coalesce_max_inputs, max_tokens=coalesce_max_tokens
+        )
+    in_flight_tasks = set()  # holds references so running API calls aren't garbage collected
+
+    # the main loop sleeps on this event instead of polling; it is set whenever a request
+    # finishes or is queued for retry, or new requests are parsed, so the loop can react right away
+    dispatcher_wakeup = asyncio.Event()
+
+    # initialize checkpoint; task IDs are line numbers (counted from the shard's first line) or, for Parquet
+    # and Arrow, row numbers (counted from the file's first row), so they stay stable across restarts
+    first_task_id = start_offset if requests_file_format(requests_filepath) in ("parquet", "arrow") else 0
+    checkpoint = None
+    if checkpoint_filepath is not None:
+        checkpoint = Checkpoint(
+            filepath=checkpoint_filepath, first_task_id=first_task_id, start_offset=start_offset
+        )
+        if resume:
+            checkpoint.load()
+            checkpoint.truncate_results(save_filepath)
+            logging.info(
+                f"Resuming from {checkpoint_filepath}: skipping the first {checkpoint.first_task_id - first_task_id} requests and {len(checkpoint.completed_task_ids)} more finished after them"
+            )
+        checkpoint.open(append=resume)
+
+    # initialize the response cache
+    cache = None
+    if cache_filepath is not None:
+        cache = ResponseCache(
+            filepath=cache_filepath,
+            max_bytes=cache_max_bytes,
+            ttl_seconds=cache_ttl_seconds,
+        )
+        cache.open()
 
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
+    # initialize result writing; results are saved (then checkpointed) in batches by one writer task
+    result_writer = ResultWriter(
+        filepath=save_filepath,
+        checkpoint=checkpoint,
+        fsync_policy=fsync_policy,
+        cache=cache,
+        status_tracker=status_tracker,
+        max_batch_size=result_batch_size,
+        flush_interval_seconds=result_flush_interval_seconds,
+    )
+    result_writer.open()
+
+    # initialize tracing; lines are buffered, so writing one per attempt costs no extra syscalls
+    trace_file = None
+    if trace_filepath is not None:
+        trace_file = open(trace_filepath, "a" if resume else "w", buffering=1024**2)
 
     # initialize flags
     file_not_finished = True  # after file is empty, we'll skip reading it
     logging.debug(f"Initialization complete.")
 
-    # initialize file reading
-    with open(requests_filepath) as file:
-        # `requests` will provide requests one at a time
-        requests = file.__iter__()
+    # initialize file reading (in binary, so byte offsets can be checkpointed)
+    with ThreadPoolExecutor(max_workers=1) as token_counting_executor:
+        # start at this shard, or past the finished prefix of the file, if resuming
+        first_offset, completed_task_ids = start_offset, set()
+        if checkpoint is not None:
+            first_task_id = checkpoint.first_task_id
+            first_offset = checkpoint.start_offset
+            completed_task_ids = checkpoint.completed_task_ids
+        numbered_requests = numbered_requests_from_file(
+            requests_filepath, first_task_id, first_offset, completed_task_ids, end_offset
+        )
+        # the reader parses requests and counts their tokens in a worker thread, in chunks,
+        # running ahead of the main loop; parsed chunks arrive on `queue_of_new_requests`
+        queue_of_new_requests = asyncio.Queue(maxsize=max_read_ahead_chunks)
+        reader_task = asyncio.create_task(
+            read_requests_ahead(
+                numbered_lines=numbered_requests,
+                queue_of_new_requests=queue_of_new_requests,
+                api_endpoint=api_endpoint,
+                token_encoding_name=token_encoding_name,
+                chunk_size=requests_per_read_ahead_chunk,
+                executor=token_counting_executor,
+                dispatcher_wakeup=dispatcher_wakeup,
+                cache=cache,
+                status_tracker=status_tracker,
+            )
+        )
+        parsed_requests = collections.deque()  # the chunk currently being dispatched
+
+        # initialize live metrics
+        metrics = MetricsReporter(
+            status_tracker=status_tracker,
+            targets=targets,
+            queue_of_new_requests=queue_of_new_requests,
+            parsed_requests=parsed_requests,
+            scheduler=scheduler,
+            in_flight_tasks=in_flight_tasks,
+            result_writer=result_writer,
+        )
+        metrics_task, metrics_server = None, None
+        if metrics_filepath is not None:
+            metrics_task = asyncio.create_task(
+                metrics.write_periodically(metrics_filepath, metrics_interval_seconds)
+            )
+        if metrics_port is not None:
+            metrics_server = await metrics.serve(metrics_port)
         logging.debug(f"File opened. Entering main loop")
         async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
             while True:
-                # get next request (if one is not already waiting for capacity)
-                if next_request is None:
-                    if not queue_of_requests_to_retry.empty():
-                        next_request = queue_of_requests_to_retry.get_nowait()
+                # requests due for retry go back into the scheduler
+                while not queue_of_requests_to_retry.empty():
+                    retry_request = queue_of_requests_to_retry.get_nowait()
+                    logging.debug(
+                        f"Retrying request {retry_request.task_id}: {retry_request}"
+                    )
+                    scheduler.push(retry_request, time.time())
+
+                # new requests join them while under the in-flight limit
+                while (
+                    file_not_finished
+                    and status_tracker.num_tasks_in_progress < max_requests_in_flight
+                ):
+                    if not parsed_requests and not queue_of_new_requests.empty():
+                        parsed_requests.extend(queue_of_new_requests.get_nowait())
+                    if parsed_requests:
+                        # get new request
+                        (
+                            task_id,
+                            file_offset,
+                            request_json,
+                            metadata,
+                            token_consumption,
+                            cache_key,
+                            cached,
+                        ) = parsed_requests.popleft()
+                        priority, deadline = priority_and_deadline_from_metadata(metadata, task_id)
+                        new_request = APIRequest(
+                            task_id=task_id,
+                            request_json=request_json,
+                            token_consumption=token_consumption,
+                            attempts_left=max_attempts,
+                            metadata=metadata,
+                            file_offset=file_offset,
+                            max_error_history=max_error_history,
+                            cache_key=cache_key,
+                            cached=cached,
+                            priority=priority,
+                            deadline=deadline,
+                            time_queued=time.time(),
+                        )
+                        status_tracker.num_tasks_started += 1
+                        status_tracker.num_tasks_in_progress += 1
                         logging.debug(
-                            f"Retrying request {next_request.task_id}: {next_request}"
+                            f"Reading request {new_request.task_id}: {new_request}"
                         )
-                    elif file_not_finished:
-                        try:
-                            # get new request
-                            request_json = json.loads(next(requests))
-                            next_request = APIRequest(
-                                task_id=next(task_id_generator),
-                                request_json=request_json,
-                                token_consumption=num_tokens_consumed_from_request(
-                                    request_json, api_endpoint, token_encoding_name
-                                ),
-                                attempts_left=max_attempts,
-                                metadata=request_json.pop("metadata", None),
+                        if cached:
+                            # answer from the cache, if the reader found the request there
+                            task = asyncio.create_task(
+                                new_request.answer_from_cache(
+                                    cache=cache,
+                                    executor=token_counting_executor,
+                                    api_endpoint=api_endpoint,
+                                    token_encoding_name=token_encoding_name,
+                                    retry_queue=queue_of_requests_to_retry,
+                                    result_writer=result_writer,
+                                    status_tracker=status_tracker,
+                                    dispatcher_wakeup=dispatcher_wakeup,
+                                )
                             )
-                            status_tracker.num_tasks_started += 1
-                            status_tracker.num_tasks_in_progress += 1
-                            logging.debug(
-                                f"Reading request {next_request.task_id}: {next_request}"
-                            )
-                        except StopIteration:
-                            # if file runs out, set flag to stop reading it
-                            logging.debug("Read file exhausted")
-                            file_not_finished = False
+                            in_flight_tasks.add(task)
+                            task.add_done_callback(in_flight_tasks.discard)
+                        else:
+                            if cache is not None:
+                                status_tracker.num_cache_misses += 1
+                            if coalescer is not None:
+                                for coalesced_request in coalescer.add(new_request):
+                                    scheduler.push(coalesced_request, time.time())
+                            else:
+                                scheduler.push(new_request, new_request.time_queued)
+                    elif reader_task.done():
+                        reader_task.result()  # re-raises any error hit while parsing
+                        # if file runs out, set flag to stop reading it
+                        logging.debug("Read file exhausted")
+                        file_not_finished = False
+                    else:
+                        break  # the reader hasn't delivered the next chunk yet
+                if coalescer is not None:
+                    # don't hold a partly filled request back waiting for more lines
+                    for coalesced_request in coalescer.flush():
+                        scheduler.push(coalesced_request, time.time())
 
                 # update available capacity
                 current_time = time.time()
-                seconds_since_update = current_time - last_update_time
-                available_request_capacity = min(
-                    available_request_capacity
-                    + max_requests_per_minute * seconds_since_update / 60.0,
-                    max_requests_per_minute,
-                )
-                available_token_capacity = min(
-                    available_token_capacity
-                    + max_tokens_per_minute * seconds_since_update / 60.0,
-                    max_tokens_per_minute,
-                )
-                last_update_time = current_time
+                for target in targets:
+                    target.request_bucket.refill(current_time)
+                    target.token_bucket.refill(current_time)
 
                 # if enough capacity available, call API
+                seconds_to_wait = None  # None means wait for a request to finish or retry
+                next_request = scheduler.peek(current_time)
                 if next_request:
                     next_request_tokens = next_request.token_consumption
-                    if (
-                        available_request_capacity >= 1
-                        and available_token_capacity >= next_request_tokens
-                    ):
+                    if completion_token_estimator is not None:
+                        next_request_tokens = completion_token_estimator.tokens_to_reserve(
+                            next_request.request_json, next_request.token_consumption
+                        )
+                    target, seconds_to_wait = choose_target(
+                        targets, next_request_tokens, current_time
+                    )
+                    if seconds_to_wait == 0:
+                        scheduler.pop(next_request.priority)
+
                         # update counters
-                        available_request_capacity -= 1
-                        available_token_capacity -= next_request_tokens
+                        target.request_bucket.available -= 1
+                        target.token_bucket.available -= next_request_tokens
+                        next_request.tokens_reserved = next_request_tokens
                         next_request.attempts_left -= 1
 
                         # call API
-                        asyncio.create_task(
+                        task = asyncio.create_task(
                             next_request.call_api(
                                 session=session,
-                                request_url=request_url,
-                                request_header=request_header,
+                                target=target,
                                 retry_queue=queue_of_requests_to_retry,
-                                save_filepath=save_filepath,
+                                result_writer=result_writer,
                                 status_tracker=status_tracker,
+                                dispatcher_wakeup=dispatcher_wakeup,
+                                adaptive_rate_limits=adaptive_rate_limits,
+                                completion_token_estimator=completion_token_estimator,
+                                trace_file=trace_file,
                             )
                         )
-                        next_request = None  # reset next_request to empty
+                        in_flight_tasks.add(task)
+                        task.add_done_callback(in_flight_tasks.discard)
+
+                        # yield once so the new task can start, then fetch the next request
+                        await asyncio.sleep(0)
+                        continue
 
                 # if all tasks are finished, break
-                if status_tracker.num_tasks_in_progress == 0:
+                if status_tracker.num_tasks_in_progress == 0 and not file_not_finished:
                     break
 
-                # main loop sleeps briefly so concurrent tasks can run
-                await asyncio.sleep(seconds_to_sleep_each_loop)
-
-                # if a rate limit error was hit recently, pause to cool down
-                seconds_since_rate_limit_error = (
-                    time.time() - status_tracker.time_of_last_rate_limit_error
-                )
-                if (
-                    seconds_since_rate_limit_error
-                    < seconds_to_pause_after_rate_limit_error
-                ):
-                    remaining_seconds_to_pause = (
-                        seconds_to_pause_after_rate_limit_error
-                        - seconds_since_rate_limit_error
-                    )
-                    await asyncio.sleep(remaining_seconds_to_pause)
-                    # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-                    logging.warn(
-                        f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
+                # sleep until capacity refills, a request finishes or is queued for retry, or the reader delivers more requests;
+                # at the in-flight limit, the reader stops too, once it has filled queue_of_new_requests
+                try:
+                    await asyncio.wait_for(
+                        dispatcher_wakeup.wait(), timeout=seconds_to_wait
                     )
+                except asyncio.TimeoutError:
+                    pass
+                dispatcher_wakeup.clear()
+
+        await result_writer.close()  # saves (and checkpoints) any results still buffered
+        numbered_requests.close()  # closes the requests file
+        if checkpoint is not None:
+            checkpoint.close()
+        if cache is not None:
+            cache.close()
+        if trace_file is not None:
+            trace_file.close()
+        if metrics_task is not None:
+            metrics_task.cancel()
+            metrics.write_file(metrics_filepath)  # final numbers
+        if metrics_server is not None:
+            await metrics_server.cleanup()
 
         # after finishing, log final status
-        logging.info(
-            f"""Parallel processing complete. Results saved to {save_filepath}"""
-        )
-        if status_tracker.num_tasks_failed > 0:
-            logging.warning(
-                f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
-            )
-        if status_tracker.num_rate_limit_errors > 0:
-            logging.warning(
-                f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
-            )
+        log_final_status(status_tracker, save_filepath)
+
+    return status_tracker
 
 
 # dataclasses
 
 
+@dataclass
+class LatencyHistogram:
+    """Counts latencies in logarithmic buckets, so percentiles take fixed memory however many requests run.
+
+    Bucket i holds latencies from min_seconds * growth**(i - 1) up to min_seconds * growth**i
+    (bucket 0 holds anything faster), so percentiles are accurate to within a factor of `growth`.
+    """
+
+    counts: list = field(default_factory=list)
+    min_seconds: float = 0.001
+    growth: float = 2 ** (1 / 8)  # 8 buckets per doubling, about 9% apart
+    total_seconds: float = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.total_seconds += seconds
+        index = 0
+        if seconds > self.min_seconds:
+            index = math.ceil(math.log(seconds / self.min_seconds, self.growth))
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Add another histogram's counts (with the same buckets) into this one."""
+        self.total_seconds += other.total_seconds
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def percentile(self, percent: float) -> float:
+        """Return the upper edge of the bucket holding the given percentile, or None if nothing was recorded."""
+        total = sum(self.counts)
+        if total == 0:
+            return None
+        rank = math.ceil(total * percent / 100)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= max(rank, 1):
+                return self.min_seconds * self.growth**index
+
+    def count_at_most(self, seconds: float) -> int:
+        """Count the latencies in buckets whose upper edge is at most `seconds` (for cumulative histograms)."""
+        if seconds < self.min_seconds:
+            return 0
+        last_index = math.floor(math.log(seconds / self.min_seconds, self.growth) + 1e-9)
+        return sum(self.counts[: last_index + 1])
+
+
 @dataclass
 class StatusTracker:
     """Stores metadata about the script's progress. Only one instance is created."""
@@ -282,10 +776,872 @@ class StatusTracker:
     num_tasks_in_progress: int = 0  # script ends when this reaches 0
     num_tasks_succeeded: int = 0
     num_tasks_failed: int = 0
+    num_api_calls: int = 0  # including retries; fewer than requests when coalescing
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
-    time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
+    time_of_last_rate_limit_error: int = 0  # when the most recent rate limit error arrived
+    num_target_ejections: int = 0  # times a target was set aside after repeated failures
+    num_tokens_consumed: int = 0  # estimated (or as reported, when learning completion tokens), for requests that succeeded
+    num_cache_hits: int = 0  # requests answered from the cache
+    num_cache_misses: int = 0  # requests sent to the API while a cache was in use
+    num_deadlines_missed: int = 0  # requests that finished after the deadline in their metadata
+    num_errors_by_class: dict = field(default_factory=dict)  # e.g. "rate_limit", "http_500", "ClientConnectorError"
+    seconds_reading: float = 0.0  # spent parsing requests and counting their tokens
+    seconds_writing: float = 0.0  # spent serializing and writing results
+    time_started: float = field(default_factory=time.time)
+    # from first attempt to result, over requests that finished
+    request_latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # from being read to result, per priority; includes time waiting in the scheduler
+    latency_by_priority: dict = field(default_factory=dict)
+
+
+@dataclass
+class CapacityBucket:
+    """Tracks available capacity for one rate limit, refilling continuously up to its per-minute maximum."""
+
+    max_per_minute: float
+    available: float = None  # starts full
+    last_update_time: float = field(default_factory=time.time)
+    share: float = 1.0  # fraction of limits reported by the API that belongs to this bucket
+
+    def __post_init__(self):
+        if self.available is None:
+            self.available = self.max_per_minute
+
+    def refill(self, current_time: float) -> None:
+        """Add the capacity that has accrued since the last update."""
+        seconds_since_update = current_time - self.last_update_time
+        self.available = min(
+            self.available + self.max_per_minute * seconds_since_update / 60.0,
+            self.max_per_minute,
+        )
+        self.last_update_time = current_time
+
+    def calibrate(
+        self, limit: float, remaining: float, current_time: float
+    ) -> None:
+        """Adjust to the limit and remaining capacity reported by the API (either may be None)."""
+        self.refill(current_time)
+        if limit is not None and limit > 0:
+            self.max_per_minute = limit * self.share
+            self.available = min(self.available, self.max_per_minute)
+        if remaining is not None:
+            # the API's count is authoritative; it just can't see requests still in flight,
+            # which are already subtracted here, so only ever lower local capacity to match it
+            self.available = min(self.available, remaining * self.share)
+
+    def refund(self, amount: float, current_time: float) -> None:
+        """Give back capacity that was taken but not used (a negative amount takes more)."""
+        self.refill(current_time)
+        self.available = min(self.available + amount, self.max_per_minute)
+
+    def seconds_until_available(self, amount: float) -> float:
+        """Return how long until `amount` fits in the bucket (0 if it fits now)."""
+        shortfall = amount - self.available
+        if shortfall <= 0:
+            return 0.0
+        return shortfall * 60.0 / self.max_per_minute
+
+
+@dataclass
+class CompletionTokenEstimator:
+    """Learns how many completion tokens requests really use, per model, from the usage in responses.
+
+    Once `min_samples` completions of a model have been seen, its requests reserve the `quantile`
+    of the last `window` of them (per completion) instead of max_tokens, never more than max_tokens.
+    A job calls a single endpoint, so the model alone identifies what is being learned.
+    """
+
+    api_endpoint: str
+    quantile: float = 0.99
+    window: int = 1_000
+    min_samples: int = 20
+    samples: dict = field(default_factory=dict)  # model -> recent completion tokens, per completion
+    estimates: dict = field(default_factory=dict)  # model -> completion tokens to reserve, per completion
+    num_new_samples: dict = field(default_factory=dict)  # model -> samples since its estimate was computed
+
+    # not dataclass fields
+    recompute_every = 50  # samples between recomputing a model's quantile, which sorts its window
+
+    def tokens_to_reserve(self, request_json: dict, token_consumption: int) -> int:
+        """Return a request's token consumption (counted with max_tokens) with the learned estimate in place of max_tokens."""
+        max_tokens, num_completions = completion_token_limits_from_request(
+            request_json, self.api_endpoint
+        )
+        estimate = self.estimates.get(request_json.get("model"))
+        if estimate is None or estimate >= max_tokens:
+            return token_consumption
+        return token_consumption - num_completions * (max_tokens - estimate)
+
+    def record(self, request_json: dict, usage: dict) -> int:
+        """Learn from a response's usage, and return the total tokens it reports (None if it reports none)."""
+        completion_tokens, total_tokens = tokens_from_usage(usage)
+        _, num_completions = completion_token_limits_from_request(
+            request_json, self.api_endpoint
+        )
+        if completion_tokens is None or num_completions == 0:
+            return total_tokens
+        model = request_json.get("model")
+        if model not in self.samples:
+            self.samples[model] = collections.deque(maxlen=self.window)
+            self.num_new_samples[model] = 0
+        samples = self.samples[model]
+        samples.append(completion_tokens / num_completions)
+        self.num_new_samples[model] += 1
+        if len(samples) >= self.min_samples and (
+            model not in self.estimates
+            or self.num_new_samples[model] >= self.recompute_every
+        ):
+            index = min(len(samples) - 1, int(self.quantile * len(samples)))
+            self.estimates[model] = math.ceil(sorted(samples)[index])
+            self.num_new_samples[model] = 0
+        return total_tokens
+
+
+@dataclass
+class MetricsReporter:
+    """Publishes live metrics about a running job: a JSON file rewritten periodically, and/or a Prometheus endpoint.
+
+    Holds references to the job's moving parts and reads them when asked; it never changes them.
+    """
+
+    status_tracker: StatusTracker
+    targets: list
+    queue_of_new_requests: asyncio.Queue
+    parsed_requests: collections.deque
+    scheduler: "RequestScheduler"
+    in_flight_tasks: set
+    result_writer: "ResultWriter"
+    last_snapshot: dict = None  # for rates between snapshots written to the file
+
+    # not dataclass fields
+    latency_bucket_bounds = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def snapshot(self, current_time: float) -> dict:
+        """Return the current metrics as a dict."""
+        status_tracker = self.status_tracker
+        num_scheduled = len(self.scheduler)
+        num_in_flight = len(self.in_flight_tasks)
+        return {
+            "time": current_time,
+            "seconds_elapsed": current_time - status_tracker.time_started,
+            "requests": {
+                "started": status_tracker.num_tasks_started,
+                "in_progress": status_tracker.num_tasks_in_progress,
+                "succeeded": status_tracker.num_tasks_succeeded,
+                "failed": status_tracker.num_tasks_failed,
+                "cache_hits": status_tracker.num_cache_hits,
+                "deadlines_missed": status_tracker.num_deadlines_missed,
+                "api_calls": status_tracker.num_api_calls,
+            },
+            # where requests are waiting; a stage that fills up is downstream of the bottleneck
+            "waiting": {
+                "parsed_chunks": self.queue_of_new_requests.qsize(),
+                "parsed_requests": len(self.parsed_requests),
+                "scheduled": num_scheduled,
+                "in_flight": num_in_flight,
+                "backing_off": max(
+                    0, status_tracker.num_tasks_in_progress - num_scheduled - num_in_flight
+                ),
+                "results_to_write": self.result_writer.queue.qsize(),
+            },
+            "tokens_consumed": status_tracker.num_tokens_consumed,
+            "seconds_reading": status_tracker.seconds_reading,
+            "seconds_writing": status_tracker.seconds_writing,
+            "errors": {
+                "rate_limit": status_tracker.num_rate_limit_errors,
+                "api": status_tracker.num_api_errors,
+                "other": status_tracker.num_other_errors,
+                "by_class": dict(status_tracker.num_errors_by_class),
+            },
+            "latency_seconds": {
+                f"p{percent}": status_tracker.request_latency.percentile(percent)
+                for percent in (50, 90, 99)
+            },
+            "targets": [
+                {
+                    "index": target.index,
+                    "request_url": target.request_url,
+                    "requests_available": target.request_bucket.available,
+                    "requests_per_minute": target.request_bucket.max_per_minute,
+                    "tokens_available": target.token_bucket.available,
+                    "tokens_per_minute": target.token_bucket.max_per_minute,
+                    "ejected": target.ejected_until > current_time,
+                    "consecutive_failures": target.consecutive_failures,
+                }
+                for target in self.targets
+            ],
+        }
+
+    def write_file(self, filepath: str) -> None:
+        """Write a snapshot, with request & token rates since the last one, replacing the file atomically."""
+        snapshot = self.snapshot(time.time())
+        previous = self.last_snapshot or {
+            "time": self.status_tracker.time_started,
+            "requests": {"succeeded": 0, "failed": 0},
+            "tokens_consumed": 0,
+        }
+        seconds = max(snapshot["time"] - previous["time"], 1e-9)
+        snapshot["requests_per_second"] = (
+            snapshot["requests"]["succeeded"]
+            + snapshot["requests"]["failed"]
+            - previous["requests"]["succeeded"]
+            - previous["requests"]["failed"]
+        ) / seconds
+        snapshot["tokens_per_second"] = (
+            snapshot["tokens_consumed"] - previous["tokens_consumed"]
+        ) / seconds
+        self.last_snapshot = snapshot
+        with open(filepath + ".tmp", "w") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(filepath + ".tmp", filepath)
+
+    async def write_periodically(self, filepath: str, interval_seconds: float) -> None:
+        while True:
+            self.write_file(filepath)
+            await asyncio.sleep(interval_seconds)
+
+    def prometheus_text(self, current_time: float) -> str:
+        """Render the current metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot(current_time)
+        lines = []
+
+        def metric(name: str, kind: str, help: str, samples: list) -> None:
+            lines.append(f"# HELP api_processor_{name} {help}")
+            lines.append(f"# TYPE api_processor_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{label}"' for key, label in labels.items()
+                )
+                lines.append(
+                    f"api_processor_{name}{{{label_text}}} {value}"
+                    if label_text
+                    else f"api_processor_{name} {value}"
+                )
+
+        metric(
+            "requests_total",
+            "counter",
+            "Requests by outcome.",
+            [
+                ({"outcome": outcome}, snapshot["requests"][outcome])
+                for outcome in ("started", "succeeded", "failed", "cache_hits")
+            ],
+        )
+        metric(
+            "requests_waiting",
+            "gauge",
+            "Requests waiting at each stage of the pipeline.",
+            [({"stage": stage}, count) for stage, count in snapshot["waiting"].items()],
+        )
+        metric(
+            "api_calls_total",
+            "counter",
+            "HTTP requests made, including retries.",
+            [({}, snapshot["requests"]["api_calls"])],
+        )
+        metric(
+            "tokens_consumed_total",
+            "counter",
+            "Tokens used by successful requests.",
+            [({}, snapshot["tokens_consumed"])],
+        )
+        metric(
+            "busy_seconds_total",
+            "counter",
+            "Time spent reading (parsing & counting tokens) and writing results.",
+            [
+                ({"stage": "reading"}, snapshot["seconds_reading"]),
+                ({"stage": "writing"}, snapshot["seconds_writing"]),
+            ],
+        )
+        metric(
+            "errors_total",
+            "counter",
+            "Errors by class.",
+            [
+                ({"class": error_class}, count)
+                for error_class, count in snapshot["errors"]["by_class"].items()
+            ],
+        )
+        latency = self.status_tracker.request_latency
+        name = "api_processor_request_latency_seconds"
+        lines.append(f"# HELP {name} Time from a request's first attempt to its result.")
+        lines.append(f"# TYPE {name} histogram")
+        for bound in self.latency_bucket_bounds:
+            lines.append(f'{name}_bucket{{le="{bound}"}} {latency.count_at_most(bound)}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {sum(latency.counts)}')
+        lines.append(f"{name}_sum {latency.total_seconds}")
+        lines.append(f"{name}_count {sum(latency.counts)}")
+        for limit in ("requests", "tokens"):
+            metric(
+                f"target_{limit}_available",
+                "gauge",
+                f"Capacity available in each target's {limit} bucket.",
+                [
+                    ({"target": target["index"]}, target[f"{limit}_available"])
+                    for target in snapshot["targets"]
+                ],
+            )
+        metric(
+            "target_ejected",
+            "gauge",
+            "Whether each target is ejected.",
+            [
+                ({"target": target["index"]}, int(target["ejected"]))
+                for target in snapshot["targets"]
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int) -> web.AppRunner:
+        """Serve the metrics at http://127.0.0.1:{port}/metrics until the returned runner is cleaned up."""
+
+        async def get_metrics(request: web.Request) -> web.Response:
+            return web.Response(
+                text=self.prometheus_text(time.time()), content_type="text/plain"
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", get_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        logging.info(f"Serving metrics at http://127.0.0.1:{port}/metrics")
+        return runner
+
+
+@dataclass
+class RequestCoalescer:
+    """Packs consecutive single-input embeddings requests into one request with a list of inputs.
+
+    Requests join the pending one while they have the same parameters (other than input), priority,
+    and deadline, up to `max_inputs` inputs and `max_tokens` estimated tokens. The packed request
+    keeps its lines as `members`, whose results are saved separately.
+    """
+
+    max_inputs: int
+    max_tokens: int
+    pending: list = field(default_factory=list)  # requests waiting to be packed
+    pending_key: tuple = None  # what requests must share to join the pending ones
+    pending_tokens: int = 0
+
+    def add(self, request: "APIRequest") -> list:
+        """Take a request; returns the requests ready to send (none, or one or two when the pending one closes)."""
+        if not isinstance(request.request_json.get("input"), str):
+            return self.flush() + [request]  # already a list (or tokens), so sent as it is
+        key = (
+            json.dumps(
+                {k: v for k, v in request.request_json.items() if k != "input"},
+                sort_keys=True,
+            ),
+            request.priority,
+            request.deadline,
+        )
+        ready = []
+        if self.pending and (
+            key != self.pending_key
+            or self.pending_tokens + request.token_consumption > self.max_tokens
+        ):
+            ready = self.flush()
+        self.pending.append(request)
+        self.pending_key = key
+        self.pending_tokens += request.token_consumption
+        if len(self.pending) >= self.max_inputs or self.pending_tokens >= self.max_tokens:
+            ready += self.flush()
+        return ready
+
+    def flush(self) -> list:
+        """Pack the pending requests; returns the packed request (or the lone request), or nothing if none are pending."""
+        if not self.pending:
+            return []
+        members = self.pending
+        self.pending, self.pending_key, self.pending_tokens = [], None, 0
+        if len(members) == 1:
+            return members
+        first = members[0]
+        return [
+            APIRequest(
+                task_id=first.task_id,
+                request_json=dict(
+                    first.request_json,
+                    input=[member.request_json["input"] for member in members],
+                ),
+                token_consumption=sum(member.token_consumption for member in members),
+                attempts_left=first.attempts_left,
+                metadata=None,
+                file_offset=first.file_offset,
+                max_error_history=first.max_error_history,
+                priority=first.priority,
+                deadline=first.deadline,
+                time_queued=first.time_queued,
+                members=members,
+            )
+        ]
+
+
+@dataclass
+class RequestScheduler:
+    """Orders requests waiting to be sent: by priority, then earliest deadline, then task ID.
+
+    Each priority has its own lane (a heap). So low priorities don't starve, a waiting request gains
+    one priority level for every `aging_seconds` it has waited, and each lane competes at the
+    aged priority of its first request.
+    """
+
+    aging_seconds: float = 10.0
+    lanes: dict = field(default_factory=dict)  # priority -> heap of (deadline, task_id, request)
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def push(self, request: "APIRequest", current_time: float) -> None:
+        request.time_scheduled = current_time
+        deadline = math.inf if request.deadline is None else request.deadline
+        heapq.heappush(
+            self.lanes.setdefault(request.priority, []),
+            (deadline, request.task_id, request),
+        )
+
+    def peek(self, current_time: float) -> "APIRequest":
+        """Return the request that should be sent next, or None if none are waiting."""
+        if not self.lanes:
+            return None
+        priority = max(
+            self.lanes,
+            key=lambda priority: (
+                priority
+                + (current_time - self.lanes[priority][0][-1].time_scheduled)
+                / self.aging_seconds,
+                priority,  # ties go to the higher priority
+            ),
+        )
+        return self.lanes[priority][0][-1]
+
+    def pop(self, priority: int) -> "APIRequest":
+        """Remove and return the first request in a lane (the one peek returned, given its priority)."""
+        lane = self.lanes[priority]
+        request = heapq.heappop(lane)[-1]
+        if not lane:
+            del self.lanes[priority]
+        return request
+
+
+@dataclass
+class APITarget:
+    """An endpoint & API key that requests can be sent to, with its own capacity buckets.
+
+    A target that fails `max_consecutive_failures` requests in a row is ejected: no requests are sent
+    to it until `ejected_until`, unless every target is ejected. The ejection doubles each time it happens again without a success
+    in between, and the first request after one decides whether the target is back.
+    """
+
+    request_url: str
+    api_key: str
+    request_bucket: CapacityBucket
+    token_bucket: CapacityBucket
+    index: int = 0  # position in the pool, to identify the target in metrics and traces
+    request_header: dict = None  # built from api_key if omitted
+    consecutive_failures: int = 0
+    num_ejections: int = 0  # ejections since the last success
+    ejected_until: float = 0.0
+
+    # ejection policy
+    max_consecutive_failures: int = 3
+    base_seconds_ejected: float = 10.0
+    max_seconds_ejected: float = 300.0
+
+    def __post_init__(self):
+        if self.request_header is None:
+            self.request_header = request_header_from_url(self.request_url, self.api_key)
+
+    def seconds_until_available(self, num_tokens: float) -> float:
+        """Return how long until this target has capacity for a request of `num_tokens` (0 if it does now)."""
+        return max(
+            self.request_bucket.seconds_until_available(1),
+            self.token_bucket.seconds_until_available(num_tokens),
+        )
+
+    def headroom(self) -> float:
+        """Return the fraction of capacity still available, for whichever limit is closest."""
+        return min(
+            self.request_bucket.available / self.request_bucket.max_per_minute,
+            self.token_bucket.available / self.token_bucket.max_per_minute,
+        )
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.num_ejections = 0
+
+    def record_failure(self, current_time: float) -> bool:
+        """Count a failure that looks like the target's fault; returns True if it gets the target ejected."""
+        if current_time < self.ejected_until:
+            return False  # a request sent before the ejection; it's already been dealt with
+        self.consecutive_failures += 1
+        if self.consecutive_failures < self.max_consecutive_failures:
+            return False
+        seconds_ejected = min(
+            self.max_seconds_ejected,
+            self.base_seconds_ejected * 2**self.num_ejections,
+        )
+        self.ejected_until = current_time + seconds_ejected
+        self.num_ejections += 1
+        # after the ejection, one more failure is enough to eject the target again
+        self.consecutive_failures = self.max_consecutive_failures - 1
+        logging.warning(
+            f"Ejecting {self.request_url} for {seconds_ejected:.0f} seconds after repeated failures"
+        )
+        return True
+
+
+@dataclass
+class Checkpoint:
+    """Append-only log of finished requests, so an interrupted job can resume where it stopped.
+
+    Each record is a request's task ID (its 0-based line number), the byte offset just past its line, and
+    the results file's length once its result was saved. On resume, the log is compacted to a single
+    prefix record (every request before `first_task_id` is finished, and its line starts at `start_offset`),
+    plus the few requests after it that finished out of order; and results saved after the last record
+    (by a job killed between saving a batch and recording it) are cut from the results file, since
+    their requests will be sent again.
+    """
+
+    filepath: str
+    first_task_id: int = 0  # every request before this one is finished
+    start_offset: int = 0  # byte offset of the line for first_task_id
+    completed_task_ids: set = field(default_factory=set)  # finished requests after the prefix
+    results_length: int = 0  # bytes of the results file holding every recorded result (0 if unknown)
+    file: object = None  # open checkpoint file, while the job runs
+
+    # not dataclass fields
+    record_struct = struct.Struct("<QQQ")  # (task_id, offset past the line, results file length)
+    prefix_flag = 1 << 63  # marks the prefix record, which holds (first_task_id, start_offset, results_length)
+
+    def load(self) -> None:
+        """Read the checkpoint, find the finished prefix, and rewrite the log in compacted form."""
+        if not os.path.exists(self.filepath):
+            return
+        record_size = self.record_struct.size
+
+        # first pass: mark every finished task ID past the prefix in a bitmap (1 bit per request)
+        finished = bytearray()  # bit i is set once request first_task_id + i is finished
+        for task_id, file_offset, results_length in self._read_records(record_size):
+            self.results_length = max(self.results_length, results_length)
+            if task_id & self.prefix_flag:  # only ever written first, by a previous compaction
+                self.first_task_id = task_id ^ self.prefix_flag
+                self.start_offset = file_offset
+                continue
+            i = task_id - self.first_task_id
+            if i >= 8 * len(finished):
+                finished.extend(bytes((i >> 3) + 1 - len(finished)))
+            finished[i >> 3] |= 1 << (i & 7)
+
+        # the first unfinished request ends the finished prefix
+        num_newly_finished = 0
+        while num_newly_finished >> 3 < len(finished):
+            byte = finished[num_newly_finished >> 3]
+            if byte == 0xFF:
+                num_newly_finished += 8
+            elif byte >> (num_newly_finished & 7) & 1:
+                num_newly_finished += 1
+            else:
+                break
+        last_task_id_in_prefix = self.first_task_id + num_newly_finished - 1
+        self.first_task_id += num_newly_finished
+
+        # second pass: find where the prefix now ends, and keep records past it
+        kept_records = []
+        for task_id, file_offset, results_length in self._read_records(record_size):
+            if task_id == last_task_id_in_prefix:
+                self.start_offset = file_offset
+            elif self.first_task_id < task_id < self.prefix_flag:
+                self.completed_task_ids.add(task_id)
+                kept_records.append((task_id, file_offset, results_length))
+
+        # rewrite the log, so it stays small across restarts
+        compacted_filepath = self.filepath + ".tmp"
+        with open(compacted_filepath, "wb") as f:
+            f.write(
+                self.record_struct.pack(
+                    self.first_task_id | self.prefix_flag,
+                    self.start_offset,
+                    self.results_length,
+                )
+            )
+            for record in kept_records:
+                f.write(self.record_struct.pack(*record))
+        os.replace(compacted_filepath, self.filepath)
+
+    def truncate_results(self, results_filepath: str) -> None:
+        """Cut results saved after the last record from the results file; their requests are sent again on resume."""
+        if not self.results_length or not os.path.exists(results_filepath):
+            return
+        unrecorded_bytes = os.path.getsize(results_filepath) - self.results_length
+        if unrecorded_bytes > 0:
+            logging.warning(
+                f"Cutting {unrecorded_bytes} bytes of results saved after the last checkpoint record from {results_filepath}"
+            )
+            os.truncate(results_filepath, self.results_length)
+
+    def _read_records(self, record_size: int):
+        """Yield (task_id, file_offset, results_length) records, ignoring a partial record left by a crash."""
+        with open(self.filepath, "rb") as f:
+            while True:
+                block = f.read(record_size * 65_536)
+                usable_size = len(block) - len(block) % record_size
+                yield from self.record_struct.iter_unpack(block[:usable_size])
+                if len(block) < record_size * 65_536:
+                    break
+
+    def open(self, append: bool) -> None:
+        """Open the log for writing, keeping existing records only if resuming."""
+        self.file = open(self.filepath, "ab" if append else "wb")
+
+    def record(self, finished_requests: list, results_length: int) -> None:
+        """Record (task_id, file_offset) for finished requests. Called right after their results are saved,
+        with the results file's length then."""
+        self.file.write(
+            b"".join(
+                self.record_struct.pack(task_id, file_offset, results_length)
+                for task_id, file_offset in finished_requests
+            )
+        )
+        self.file.flush()  # hand the records to the OS, so they survive the process being killed
+
+    def close(self) -> None:
+        self.file.close()
+
+
+@dataclass
+class ResultWriter:
+    """Saves results from a single task, appending them to the results file in batches.
+
+    Results are queued by `write` and flushed when `max_batch_size` of them are waiting, or
+    `flush_interval_seconds` after the first one arrived. With a checkpoint, that interval defaults to
+    50 ms, since results still queued when the job is killed are lost, and their requests paid for again
+    on resume (0 writes each batch as soon as the writer is free, but costs throughput); without one, it
+    defaults to 1 second. File writes run in a worker thread. A compressed results file gets each batch
+    as a complete gzip member or zstd frame, so every length recorded in the checkpoint ends one.
+    After each batch is written, its requests are recorded in the checkpoint (if any), and
+    successful responses are stored in the cache (if any).
+    """
+
+    filepath: str
+    checkpoint: Checkpoint = None
+    cache: "ResponseCache" = None
+    status_tracker: StatusTracker = None  # gets the time spent writing, if given
+    fsync_policy: str = "never"  # "never", "batch", or "close"
+    max_batch_size: int = 1_000
+    flush_interval_seconds: float = None  # 0.05 with a checkpoint, 1 without, if not given
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    batch_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    file: object = None  # open results file (binary), while the job runs
+    compress: object = None  # compresses a batch's bytes, if the results file is compressed
+    task: asyncio.Task = None  # writer task, while the job runs
+
+    def __post_init__(self):
+        if self.fsync_policy not in ("never", "batch", "close"):
+            raise ValueError(
+                f'fsync_policy must be "never", "batch", or "close", not "{self.fsync_policy}"'
+            )
+        if self.flush_interval_seconds is None:
+            self.flush_interval_seconds = 0.05 if self.checkpoint is not None else 1.0
+
+    def open(self) -> None:
+        """Open the results file and start the writer task."""
+        self.file = open(self.filepath, "ab")
+        self.compress = results_file_compressor(self.filepath)
+        self.task = asyncio.create_task(self._write_batches())
+
+    def write(self, data, task_id: int, file_offset: int, cache_key: bytes = None) -> None:
+        """Queue a result to be saved; if `cache_key` is given, its response (data[1]) is cached too."""
+        self.queue.put_nowait((data, task_id, file_offset, cache_key))
+        if self.queue.qsize() >= self.max_batch_size:
+            self.batch_ready.set()
+
+    async def close(self) -> None:
+        """Save everything still queued, then close the results file."""
+        self.queue.put_nowait(None)  # tells the writer task to finish
+        self.batch_ready.set()
+        await self.task
+        if self.fsync_policy == "close":
+            self._fsync()
+        self.file.close()
+
+    async def _write_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            # wait for the first result of a batch, then give the batch time to fill up
+            batch = [await self.queue.get()]
+            if (
+                batch[0] is not None
+                and self.flush_interval_seconds > 0
+                and self.queue.qsize() + 1 < self.max_batch_size
+            ):
+                try:
+                    await asyncio.wait_for(
+                        self.batch_ready.wait(), timeout=self.flush_interval_seconds
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self.batch_ready.clear()
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            closing = batch[-1] is None  # close() queues None after every result
+            results = [result for result in batch if result is not None]
+            if results:
+                await loop.run_in_executor(None, self._write_batch, results)
+
+    def _write_batch(self, results: list) -> None:
+        """Serialize and append a batch of results, then checkpoint and cache them. Runs in a worker thread."""
+        start_time = time.perf_counter()
+        lines = []
+        responses_to_cache = []
+        for data, _, _, cache_key in results:
+            # serialized part by part (matching json.dumps(data)), so a response can be cached as is
+            parts = [json.dumps(part) for part in data]
+            lines.append("[" + ", ".join(parts) + "]\n")
+            if cache_key is not None and self.cache is not None:
+                responses_to_cache.append((cache_key, parts[1]))
+        batch_bytes = "".join(lines).encode()
+        self.file.write(self.compress(batch_bytes) if self.compress is not None else batch_bytes)
+        self.file.flush()
+        if self.fsync_policy == "batch":
+            self._fsync()
+        if self.checkpoint is not None:
+            self.checkpoint.record(
+                [(task_id, file_offset) for _, task_id, file_offset, _ in results],
+                self._file_size(),
+            )
+            if self.fsync_policy == "batch":
+                os.fsync(self.checkpoint.file.fileno())
+        if responses_to_cache:
+            self.cache.put_many(responses_to_cache)
+        if self.status_tracker is not None:
+            self.status_tracker.seconds_writing += time.perf_counter() - start_time
+
+    def _file_size(self) -> int:
+        """Bytes of the results file on disk (compressed, if it is)."""
+        return os.fstat(self.file.fileno()).st_size
+
+    def _fsync(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+@dataclass
+class ResponseCache:
+    """SQLite store of successful responses, keyed by a hash of the API endpoint and request.
+
+    When the stored responses outgrow `max_bytes`, the least recently used are evicted; responses
+    older than `ttl_seconds` (if set) count as missing. The file can be shared between processes.
+    Methods may be called from several threads, so each takes a lock.
+    """
+
+    filepath: str
+    max_bytes: int = 1024**3
+    ttl_seconds: float = None  # None means responses never expire
+    connection: sqlite3.Connection = None  # open connection, while the job runs
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    # not dataclass fields
+    max_keys_per_query = 500  # stays under SQLite's limit on query parameters
+    evict_to_fraction = 0.9  # evicting down to a bit under max_bytes, so eviction doesn't run on every write
+
+    def open(self) -> None:
+        self.connection = sqlite3.connect(
+            self.filepath, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")  # lets other processes read while one writes
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key BLOB PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_by_last_use ON responses (last_used_at)"
+        )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def oldest_fresh_time(self) -> float:
+        return 0.0 if self.ttl_seconds is None else time.time() - self.ttl_seconds
+
+    def cached_keys(self, keys: list) -> set:
+        """Return which of `keys` have a fresh response cached, marking them as just used."""
+        found = set()
+        current_time = time.time()
+        with self.lock:
+            for i in range(0, len(keys), self.max_keys_per_query):
+                some_keys = keys[i : i + self.max_keys_per_query]
+                found.update(
+                    key
+                    for (key,) in self.connection.execute(
+                        f"SELECT key FROM responses WHERE created_at >= ? AND key IN ({','.join('?' * len(some_keys))})",
+                        [self.oldest_fresh_time(), *some_keys],
+                    )
+                )
+            if found:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(
+                    "UPDATE responses SET last_used_at = ? WHERE key = ?",
+                    [(current_time, key) for key in found],
+                )
+                self.connection.execute("COMMIT")
+        return found
+
+    def get(self, key: bytes) -> dict:
+        """Return the cached response for `key`, or None if there isn't a fresh one."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at >= ?",
+                (key, self.oldest_fresh_time()),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_many(self, responses: list) -> None:
+        """Store (key, response serialized as JSON) pairs, then evict if the cache has grown too big."""
+        current_time = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, response, len(response), current_time, current_time)
+                    for key, response in responses
+                ],
+            )
+            self.connection.execute("COMMIT")
+            self._evict()
+
+    def _evict(self) -> None:
+        (total_bytes,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total_bytes <= self.max_bytes:
+            return
+        bytes_to_free = total_bytes - self.max_bytes * self.evict_to_fraction
+        self.connection.execute("BEGIN")
+        freed = 0
+        keys_to_delete = []
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_used_at"
+        ):
+            if freed >= bytes_to_free:
+                break
+            keys_to_delete.append((key,))
+            freed += size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", keys_to_delete)
+        self.connection.execute("COMMIT")
+        logging.debug(f"Evicted {len(keys_to_delete)} responses ({freed} bytes) from the cache")
 
 
 @dataclass
@@ -297,37 +1653,100 @@ class APIRequest:
     token_consumption: int
     attempts_left: int
     metadata: dict
-    result: list = field(default_factory=list)
+    file_offset: int = 0  # byte offset just past this request's line; recorded in the checkpoint
+    result: list = field(default_factory=list)  # the most recent errors, as strings
+    num_errors: int = 0  # including errors dropped from result
+    time_of_first_attempt: float = None
+    max_error_history: int = 5
+    cache_key: bytes = None  # set when a cache is in use
+    cached: bool = False  # whether the reader found a response in the cache
+    priority: int = 0  # higher is sent first
+    deadline: float = None  # Unix time; earlier is sent first within a priority
+    time_queued: float = None  # when the request was read from the file
+    time_scheduled: float = None  # when the request last entered the scheduler
+    tokens_reserved: int = None  # token capacity taken for the latest attempt
+    members: list = None  # for a coalesced request, the requests (lines) it packs
+
+    # retry backoff, in seconds: full jitter over an exponentially growing window
+    base_seconds_to_back_off: float = 1.0
+    max_seconds_to_back_off: float = 60.0
 
     async def call_api(
         self,
         session: aiohttp.ClientSession,
-        request_url: str,
-        request_header: dict,
+        target: APITarget,
         retry_queue: asyncio.Queue,
-        save_filepath: str,
+        result_writer: ResultWriter,
         status_tracker: StatusTracker,
+        dispatcher_wakeup: asyncio.Event,
+        adaptive_rate_limits: bool = False,
+        completion_token_estimator: CompletionTokenEstimator = None,
+        trace_file=None,
     ):
         """Calls the OpenAI API and saves results."""
         logging.info(f"Starting request #{self.task_id}")
+        time_dispatched = time.time()
+        if self.time_of_first_attempt is None:
+            self.time_of_first_attempt = time_dispatched
+        status_tracker.num_api_calls += 1
+        requests = self.members or [self]  # the lines whose results this call decides
+        responses = None
+        attempt = self.num_errors + 1
         error = None
+        error_class = None  # counted in status_tracker.num_errors_by_class
+        target_failed = False  # whether the error looks like the target's fault, rather than the request's
+        rate_limits = {}
+        http_status, time_of_first_byte = None, None
         try:
             async with session.post(
-                url=request_url, headers=request_header, json=self.request_json
-            ) as response:
-                response = await response.json()
+                url=target.request_url,
+                headers=target.request_header,
+                json=self.request_json,
+            ) as http_response:
+                time_of_first_byte = time.time()
+                http_status = http_response.status
+                rate_limits = rate_limits_from_headers(http_response.headers)
+                is_rate_limited = http_response.status == 429
+                target_failed = http_response.status >= 500
+                response = await http_response.json()
+            if adaptive_rate_limits:
+                current_time = time.time()
+                target.request_bucket.calibrate(
+                    rate_limits.get("limit_requests"),
+                    rate_limits.get("remaining_requests"),
+                    current_time,
+                )
+                target.token_bucket.calibrate(
+                    rate_limits.get("limit_tokens"),
+                    rate_limits.get("remaining_tokens"),
+                    current_time,
+                )
             if "error" in response:
                 logging.warning(
                     f"Request {self.task_id} failed with error {response['error']}"
                 )
                 status_tracker.num_api_errors += 1
                 error = response
-                if "rate limit" in response["error"].get("message", "").lower():
+                error_class = f"http_{http_status}"
+                if (
+                    is_rate_limited
+                    or "rate limit" in response["error"].get("message", "").lower()
+                ):
+                    error_class = "rate_limit"
                     status_tracker.time_of_last_rate_limit_error = time.time()
                     status_tracker.num_rate_limit_errors += 1
                     status_tracker.num_api_errors -= (
                         1  # rate limit errors are counted separately
                     )
+            elif self.members:
+                try:
+                    responses = split_embeddings_response(response, self.members)
+                except (KeyError, TypeError, ValueError) as e:
+                    # the response doesn't match the coalesced inputs; that's no sign the target is unhealthy
+                    logging.warning(f"Request {self.task_id} got a response it can't split: {e}")
+                    status_tracker.num_api_errors += 1
+                    error = e
+                    error_class = "unsplittable_response"
 
         except (
             Exception
@@ -335,53 +1754,660 @@ class APIRequest:
             logging.warning(f"Request {self.task_id} failed with Exception {e}")
             status_tracker.num_other_errors += 1
             error = e
+            error_class = type(e).__name__
+            target_failed = True
+        if error_class is not None:
+            status_tracker.num_errors_by_class[error_class] = (
+                status_tracker.num_errors_by_class.get(error_class, 0) + 1
+            )
+        if target_failed:
+            if target.record_failure(time.time()):
+                status_tracker.num_target_ejections += 1
+        elif not error:
+            target.record_success()
         if error:
-            self.result.append(error)
-            if self.attempts_left:
-                retry_queue.put_nowait(self)
+            # keep errors as strings, so exceptions don't hold on to their tracebacks (and the frames in them)
+            self.num_errors += 1
+            self.result.append(str(error))
+            del self.result[: -self.max_error_history]
+            if self.members and (
+                error_class == "unsplittable_response"
+                or (
+                    error_class != "rate_limit"
+                    and http_status is not None
+                    and 400 <= http_status < 500
+                )
+            ):
+                # one bad input fails a whole coalesced request (and a response that doesn't match its inputs
+                # can't be shared out), so its lines are retried on their own
+                logging.warning(
+                    f"Coalesced request {self.task_id} failed; retrying its {len(self.members)} lines one by one"
+                )
+                for member in self.members:
+                    # attempts the coalesced request used count against its lines, except the one that split it
+                    member.attempts_left = min(member.attempts_left, self.attempts_left + 1)
+                    member.queue_for_retry(retry_queue, dispatcher_wakeup)
+            elif self.attempts_left:
+                # back off before retrying, jittered so failed requests don't all retry at once,
+                # but never sooner than the API asked (retry-after) or capacity should free up
+                seconds_to_back_off = max(
+                    random.uniform(
+                        0,
+                        min(
+                            self.max_seconds_to_back_off,
+                            self.base_seconds_to_back_off * 2 ** (self.num_errors - 1),
+                        ),
+                    ),
+                    rate_limits.get("retry_after_seconds", 0),
+                )
+                logging.debug(
+                    f"Request {self.task_id} will be retried in {seconds_to_back_off:.2f} seconds"
+                )
+                asyncio.get_running_loop().call_later(
+                    seconds_to_back_off,
+                    self.queue_for_retry,
+                    retry_queue,
+                    dispatcher_wakeup,
+                )
             else:
                 logging.error(
                     f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
                 )
+                errors = self.result
+                if self.num_errors > len(self.result):
+                    errors = [
+                        f"{self.num_errors - len(self.result)} earlier errors not kept"
+                    ] + errors
+                for request in requests:
+                    data = (
+                        [request.request_json, errors, request.metadata]
+                        if request.metadata
+                        else [request.request_json, errors]
+                    )
+                    result_writer.write(data, request.task_id, request.file_offset)
+                    status_tracker.num_tasks_in_progress -= 1
+                    status_tracker.num_tasks_failed += 1
+                    request.record_finish(status_tracker, self.time_of_first_attempt)
+        else:
+            tokens_used = None
+            if completion_token_estimator is not None:
+                tokens_used = completion_token_estimator.record(
+                    self.request_json, response.get("usage")
+                )
+                if tokens_used is not None:
+                    # settle the reservation with what the response actually used
+                    target.token_bucket.refund(
+                        self.tokens_reserved - tokens_used, time.time()
+                    )
+            for request, request_response in zip(requests, responses or [response]):
                 data = (
-                    [self.request_json, [str(e) for e in self.result], self.metadata]
-                    if self.metadata
-                    else [self.request_json, [str(e) for e in self.result]]
+                    [request.request_json, request_response, request.metadata]
+                    if request.metadata
+                    else [request.request_json, request_response]
+                )
+                result_writer.write(
+                    data, request.task_id, request.file_offset, request.cache_key
                 )
-                append_to_jsonl(data, save_filepath)
                 status_tracker.num_tasks_in_progress -= 1
-                status_tracker.num_tasks_failed += 1
+                status_tracker.num_tasks_succeeded += 1
+                request.record_finish(status_tracker, self.time_of_first_attempt)
+            status_tracker.num_tokens_consumed += (
+                self.token_consumption if tokens_used is None else tokens_used
+            )
+            logging.debug(f"Request {self.task_id} queued for saving to {result_writer.filepath}")
+        if trace_file is not None:
+            trace_file.write(
+                json.dumps(
+                    {
+                        "task_id": self.task_id,
+                        "inputs": len(requests),
+                        "attempt": attempt,
+                        "target": target.index,
+                        "status": http_status,
+                        "error": error_class,
+                        "queued": self.time_scheduled,
+                        "dispatched": time_dispatched,
+                        "first_byte": time_of_first_byte,
+                        "done": time.time(),
+                    }
+                )
+                + "\n"
+            )
+        dispatcher_wakeup.set()  # let the main loop notice completion or refreshed capacity
+
+    def record_finish(
+        self, status_tracker: StatusTracker, time_of_first_attempt: float
+    ) -> None:
+        """Record the request's latencies (from `time_of_first_attempt`, which is a coalesced request's for its members), and whether it missed its deadline."""
+        current_time = time.time()
+        status_tracker.request_latency.record(current_time - time_of_first_attempt)
+        if self.time_queued is not None:
+            if self.priority not in status_tracker.latency_by_priority:
+                status_tracker.latency_by_priority[self.priority] = LatencyHistogram()
+            status_tracker.latency_by_priority[self.priority].record(
+                current_time - self.time_queued
+            )
+        if self.deadline is not None and current_time > self.deadline:
+            status_tracker.num_deadlines_missed += 1
+
+    async def answer_from_cache(
+        self,
+        cache: ResponseCache,
+        executor: ThreadPoolExecutor,
+        api_endpoint: str,
+        token_encoding_name: str,
+        retry_queue: asyncio.Queue,
+        result_writer: ResultWriter,
+        status_tracker: StatusTracker,
+        dispatcher_wakeup: asyncio.Event,
+    ):
+        """Saves the cached response; if it has been evicted since the reader found it, sends the request to the API instead."""
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(executor, cache.get, self.cache_key)
+        if response is None:
+            logging.debug(f"Request {self.task_id} left the cache; calling the API")
+            self.cached = False
+            self.token_consumption = await loop.run_in_executor(
+                executor,
+                num_tokens_consumed_from_request,
+                self.request_json,
+                api_endpoint,
+                token_encoding_name,
+            )
+            status_tracker.num_cache_misses += 1
+            retry_queue.put_nowait(self)
         else:
             data = (
                 [self.request_json, response, self.metadata]
                 if self.metadata
                 else [self.request_json, response]
             )
-            append_to_jsonl(data, save_filepath)
+            result_writer.write(data, self.task_id, self.file_offset)
+            # a cache hit's latency is from when it was read; it made no attempt of its own
+            self.record_finish(status_tracker, self.time_queued)
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
-            logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+            status_tracker.num_cache_hits += 1
+        dispatcher_wakeup.set()
+
+    def queue_for_retry(
+        self, retry_queue: asyncio.Queue, dispatcher_wakeup: asyncio.Event
+    ) -> None:
+        """Put the request back in line, once its backoff has elapsed."""
+        retry_queue.put_nowait(self)
+        dispatcher_wakeup.set()
+
+
+@dataclass
+class MessageBatch:
+    """A group of requests sent through the Anthropic Message Batches API as one batch."""
+
+    requests: list  # (task_id, byte offset of the request's line) for each request
+    id: str = None  # set once the batch is submitted
+    time_submitted: float = None
 
 
 # functions
 
 
+async def read_requests_ahead(
+    numbered_lines,
+    queue_of_new_requests: asyncio.Queue,
+    api_endpoint: str,
+    token_encoding_name: str,
+    chunk_size: int,
+    executor: ThreadPoolExecutor,
+    dispatcher_wakeup: asyncio.Event,
+    cache: ResponseCache = None,
+    status_tracker: StatusTracker = None,
+):
+    """Read requests in chunks, parsing and counting tokens (or finding them in the cache) in a worker thread."""
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            start_time = time.perf_counter()
+            chunk = await loop.run_in_executor(
+                executor,
+                parse_request_chunk,
+                numbered_lines,
+                chunk_size,
+                api_endpoint,
+                token_encoding_name,
+                cache,
+            )
+            if status_tracker is not None:
+                status_tracker.seconds_reading += time.perf_counter() - start_time
+            if not chunk:
+                break
+            await queue_of_new_requests.put(chunk)  # waits while the dispatcher is behind
+            dispatcher_wakeup.set()
+    finally:
+        dispatcher_wakeup.set()  # let the main loop notice the file is exhausted (or failed)
+
+
+def requests_file_format(filepath: str) -> str:
+    """Return "jsonl", "jsonl.gz", "jsonl.zst", "parquet", or "arrow", from a requests file's name."""
+    if filepath.endswith(".gz"):
+        return "jsonl.gz"
+    elif filepath.endswith(".zst"):
+        return "jsonl.zst"
+    elif filepath.endswith(".parquet"):
+        return "parquet"
+    elif filepath.endswith((".arrow", ".feather")):
+        return "arrow"
+    return "jsonl"
+
+
+def numbered_requests_from_file(
+    requests_filepath: str,
+    first_task_id: int,
+    start_offset: int,
+    completed_task_ids: set,
+    end_offset: int = None,
+):
+    """Yield (task_id, offset past the request, request) for each unfinished request starting in [start_offset, end_offset).
+
+    For JSONL, offsets are byte offsets (into the decompressed stream, for .gz and .zst files), and each
+    request is a line, as bytes. For Parquet and Arrow, offsets are row numbers, and each request is a dict.
+    The file stays open until the generator is exhausted or closed.
+    """
+    file_format = requests_file_format(requests_filepath)
+    if file_format in ("parquet", "arrow"):
+        yield from numbered_rows_from_table_file(
+            requests_filepath, file_format, start_offset, completed_task_ids, end_offset
+        )
+        return
+    if file_format == "jsonl.gz":
+        file = gzip.open(requests_filepath, "rb")
+    elif file_format == "jsonl.zst":
+        if zstandard is None:
+            raise ImportError(
+                "Reading .zst requests requires the zstandard package (pip install zstandard)"
+            )
+        file = zstandard.open(requests_filepath, "rb")
+    else:
+        file = open(requests_filepath, "rb")
+    with file:
+        # compressed files seek forward by decompressing up to the offset
+        file.seek(start_offset)
+        if file_format == "jsonl.zst":
+            file = io.BufferedReader(file, buffer_size=1024**2)  # zstd readers can't iterate lines
+        yield from numbered_lines_from_file(
+            file, first_task_id, start_offset, completed_task_ids, end_offset
+        )
+
+
+def numbered_lines_from_file(
+    file,
+    first_task_id: int,
+    start_offset: int,
+    completed_task_ids: set,
+    end_offset: int = None,
+):
+    """Yield (task_id, offset past the line, line) for each unfinished line starting in [start_offset, end_offset)."""
+    task_id, file_offset = first_task_id, start_offset
+    for line in file:
+        if end_offset is not None and file_offset >= end_offset:
+            break
+        file_offset += len(line)
+        if task_id not in completed_task_ids:  # finished before a restart
+            yield task_id, file_offset, line
+        task_id += 1
+
+
+def numbered_rows_from_table_file(
+    filepath: str,
+    file_format: str,
+    start_offset: int,
+    completed_task_ids: set,
+    end_offset: int = None,
+):
+    """Yield (task_id, row number + 1, request) for each unfinished row in [start_offset, end_offset) of a Parquet or Arrow file.
+
+    Rows are read a row group (or record batch) at a time; groups entirely outside the range aren't read.
+    Task IDs are row numbers, so the first row yielded is `start_offset`.
+    """
+    group_sizes, read_group = open_table_file(filepath, file_format)
+    group_start = 0
+    for group_index, group_size in enumerate(group_sizes):
+        group_end = group_start + group_size
+        if group_end > start_offset:
+            if end_offset is not None and group_start >= end_offset:
+                break
+            for row_number, row in enumerate(
+                read_group(group_index).to_pylist(), start=group_start
+            ):
+                if row_number < start_offset or row_number in completed_task_ids:
+                    continue
+                if end_offset is not None and row_number >= end_offset:
+                    break
+                # columns missing from a row are null; they aren't API parameters for it
+                request = {key: value for key, value in row.items() if value is not None}
+                yield row_number, row_number + 1, request
+        group_start = group_end
+
+
+def open_table_file(filepath: str, file_format: str) -> tuple:
+    """Open a Parquet or Arrow file; returns the number of rows in each row group (or record batch), and a function reading one."""
+    if pyarrow is None:
+        raise ImportError(
+            f"Reading {file_format} requests requires the pyarrow package (pip install pyarrow)"
+        )
+    if file_format == "parquet":
+        table_file = pyarrow.parquet.ParquetFile(filepath)
+        group_sizes = [
+            table_file.metadata.row_group(i).num_rows
+            for i in range(table_file.num_row_groups)
+        ]
+        return group_sizes, table_file.read_row_group
+    # memory-mapped, so record batches are only read from disk as their rows are used
+    table_file = pyarrow.ipc.open_file(pyarrow.memory_map(filepath))
+    group_sizes = [
+        table_file.get_batch(i).num_rows for i in range(table_file.num_record_batches)
+    ]
+    return group_sizes, table_file.get_batch
+
+
+def request_json_from_line(line) -> dict:
+    """Decode a request from a line of JSON (with orjson, if installed); rows of table files are already dicts."""
+    if isinstance(line, dict):
+        return line
+    return json.loads(line) if orjson is None else orjson.loads(line)
+
+
+def parse_request_chunk(
+    numbered_lines,
+    chunk_size: int,
+    api_endpoint: str,
+    token_encoding_name: str,
+    cache: ResponseCache = None,
+) -> list:
+    """Read up to `chunk_size` requests and return (task_id, file_offset, request_json, metadata, token_consumption, cache_key, cached) for each.
+
+    Tokens are only counted for requests that aren't cached (cached ones get 0).
+    """
+    chunk = list(itertools.islice(numbered_lines, chunk_size))
+    request_jsons = [request_json_from_line(line) for _, _, line in chunk]
+    metadatas = [request_json.pop("metadata", None) for request_json in request_jsons]
+    cache_keys = [None] * len(chunk)
+    cached_keys = set()
+    if cache is not None:
+        cache_keys = [
+            cache_key_from_request(request_json, api_endpoint)
+            for request_json in request_jsons
+        ]
+        cached_keys = cache.cached_keys(cache_keys)
+    uncached = [i for i, key in enumerate(cache_keys) if key not in cached_keys]
+    token_consumptions = [0] * len(chunk)
+    for i, token_consumption in zip(
+        uncached,
+        num_tokens_consumed_from_requests(
+            [request_jsons[i] for i in uncached], api_endpoint, token_encoding_name
+        ),
+    ):
+        token_consumptions[i] = token_consumption
+    return [
+        (
+            task_id,
+            file_offset,
+            request_json,
+            metadata,
+            token_consumption,
+            cache_key,
+            cache_key in cached_keys,
+        )
+        for (task_id, file_offset, _), request_json, metadata, token_consumption, cache_key in zip(
+            chunk, request_jsons, metadatas, token_consumptions, cache_keys
+        )
+    ]
+
+
+def priority_and_deadline_from_metadata(metadata, task_id: int = None) -> tuple:
+    """Read a request's priority (default 0) and deadline (Unix time, default None) from its metadata.
+
+    A deadline may also be an ISO 8601 timestamp (local time unless it gives a timezone). Values that
+    can't be read are logged and replaced by the defaults, rather than failing the whole run."""
+    if not isinstance(metadata, dict):
+        return 0, None
+    priority = metadata.get("priority", 0)
+    try:
+        priority = int(priority)
+    except (TypeError, ValueError, OverflowError):
+        logging.warning(f"Request {task_id} has priority {priority!r}, not an integer; using 0")
+        priority = 0
+    deadline = metadata.get("deadline")
+    if deadline is None:
+        return priority, None
+    try:
+        try:
+            deadline_time = float(deadline)
+        except ValueError:  # not a number, so perhaps a timestamp
+            deadline_time = datetime.fromisoformat(deadline.replace("Z", "+00:00")).timestamp()
+        if math.isnan(deadline_time):
+            raise ValueError
+    except (TypeError, ValueError, OverflowError):
+        logging.warning(
+            f"Request {task_id} has deadline {deadline!r}, neither Unix time nor an ISO 8601 timestamp; ignoring it"
+        )
+        return priority, None
+    return priority, deadline_time
+
+
+def split_embeddings_response(response: dict, members: list) -> list:
+    """Split a coalesced embeddings response into one response per member request, as if each had been sent alone.
+
+    Usage is shared out in proportion to each member's estimated tokens, so it only adds up approximately.
+    """
+    data = sorted(response["data"], key=lambda item: item["index"])
+    if len(data) != len(members):
+        raise ValueError(
+            f"Coalesced request got {len(data)} embeddings for {len(members)} inputs"
+        )
+    usage = response.get("usage") or {}
+    total_tokens = sum(member.token_consumption for member in members) or 1
+    responses = []
+    for member, item in zip(members, data):
+        member_response = dict(response, data=[dict(item, index=0)])
+        if usage:
+            member_response["usage"] = {
+                key: round(value * member.token_consumption / total_tokens)
+                for key, value in usage.items()
+                if isinstance(value, int)
+            }
+        responses.append(member_response)
+    return responses
+
+
+def cache_key_from_request(request_json: dict, api_endpoint: str) -> bytes:
+    """Hash the API endpoint and the request's canonical JSON (sorted keys, no whitespace) into a cache key."""
+    canonical_json = json.dumps(
+        request_json, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(f"{api_endpoint}\n{canonical_json}".encode()).digest()
+
+
 def api_endpoint_from_url(request_url):
     """Extract the API endpoint from the request URL."""
-    match = re.search("^https://[^/]+/v\\d+/(.+)$", request_url)
+    match = re.search("^https?://[^/]+/v\\d+/(.+)$", request_url)
     if match is None:
         # for Azure OpenAI deployment urls
         match = re.search(
-            r"^https://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
+            r"^https?://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
         )
     return match[1]
 
 
-def append_to_jsonl(data, filename: str) -> None:
-    """Append a json payload to the end of a jsonl file."""
-    json_string = json.dumps(data)
-    with open(filename, "a") as f:
-        f.write(json_string + "\n")
+def request_header_from_url(request_url: str, api_key: str) -> dict:
+    """Construct the authentication header the API behind `request_url` expects."""
+    # use x-api-key and a version header for the Anthropic API
+    if api_endpoint_from_url(request_url).startswith("messages"):
+        return {"x-api-key": f"{api_key}", "anthropic-version": ANTHROPIC_VERSION}
+    # use api-key header for Azure deployments
+    if "/deployments" in request_url:
+        return {"api-key": f"{api_key}"}
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+def load_api_targets(
+    targets_filepath: str,
+    request_url: str,
+    api_key: str,
+    max_requests_per_minute: float,
+    max_tokens_per_minute: float,
+) -> list:
+    """Read a jsonl file of targets into a list of dicts; fields a line omits take the given defaults."""
+    targets = []
+    with open(targets_filepath) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            target = json.loads(line)
+            if "api_key_env" in target:
+                target["api_key"] = os.environ[target.pop("api_key_env")]
+            targets.append(
+                dict(
+                    dict(
+                        request_url=request_url,
+                        api_key=api_key,
+                        max_requests_per_minute=max_requests_per_minute,
+                        max_tokens_per_minute=max_tokens_per_minute,
+                    ),
+                    **target,
+                )
+            )
+    if not targets:
+        raise ValueError(f"No targets found in {targets_filepath}")
+    return targets
+
+
+def choose_target(targets: list, num_tokens: float, current_time: float) -> tuple:
+    """Return the target that can take a request of `num_tokens` soonest, and how long until it can.
+
+    Among targets that can take it now, the one with the most spare capacity wins, so load spreads evenly.
+    Ejected targets are skipped, unless every target is ejected; then ejections are ignored, since
+    the failures are more likely the API's as a whole than any one target's.
+    """
+    in_service = [
+        target for target in targets if target.ejected_until <= current_time
+    ] or targets
+    best_target, best_seconds_to_wait, best_headroom = None, None, None
+    for target in in_service:
+        seconds_to_wait = target.seconds_until_available(num_tokens)
+        headroom = target.headroom()
+        if (
+            best_target is None
+            or seconds_to_wait < best_seconds_to_wait
+            or (seconds_to_wait == best_seconds_to_wait and headroom > best_headroom)
+        ):
+            best_target, best_seconds_to_wait, best_headroom = (
+                target,
+                seconds_to_wait,
+                headroom,
+            )
+    return best_target, best_seconds_to_wait
+
+
+def rate_limits_from_headers(headers) -> dict:
+    """Read rate limit state from response headers; keys are omitted when their header is absent.
+
+    Returns limit_requests, limit_tokens, remaining_requests, remaining_tokens, and retry_after_seconds.
+    """
+    rate_limits = {}
+    for key, openai_header, anthropic_header in (
+        ("limit_requests", "x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit"),
+        ("limit_tokens", "x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit"),
+        ("remaining_requests", "x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining"),
+        ("remaining_tokens", "x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining"),
+    ):  # fmt: skip
+        try:
+            rate_limits[key] = float(
+                headers.get(openai_header) or headers[anthropic_header]
+            )
+        except (KeyError, ValueError):
+            pass
+
+    # retry-after-ms is more precise; retry-after is seconds or an HTTP date
+    try:
+        rate_limits["retry_after_seconds"] = float(headers["retry-after-ms"]) / 1000
+    except (KeyError, ValueError):
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                rate_limits["retry_after_seconds"] = float(retry_after)
+            except ValueError:
+                try:
+                    rate_limits["retry_after_seconds"] = max(
+                        parsedate_to_datetime(retry_after).timestamp() - time.time(), 0
+                    )
+                except (TypeError, ValueError):
+                    pass
+    # without retry-after, estimate when an exhausted limit frees up again; the reset header
+    # is when it is full again, and capacity comes back at a steady rate until then
+    if "retry_after_seconds" not in rate_limits:
+        for kind in ("requests", "tokens"):
+            limit = rate_limits.get(f"limit_{kind}")
+            remaining = rate_limits.get(f"remaining_{kind}")
+            seconds_until_reset = seconds_from_duration(
+                headers.get(f"x-ratelimit-reset-{kind}")
+            )
+            if seconds_until_reset is None:
+                seconds_until_reset = seconds_until_timestamp(
+                    headers.get(f"anthropic-ratelimit-{kind}-reset")
+                )
+            if None in (limit, remaining, seconds_until_reset) or remaining >= 1:
+                continue
+            if limit > remaining:
+                seconds_until_one_free = (
+                    seconds_until_reset * (1 - remaining) / (limit - remaining)
+                )
+                rate_limits["retry_after_seconds"] = max(
+                    rate_limits.get("retry_after_seconds", 0), seconds_until_one_free
+                )
+    return rate_limits
+
+
+def seconds_from_duration(duration: str) -> float:
+    """Parse a duration like "1s", "6m0s", or "20ms" into seconds; returns None if unparseable."""
+    if not duration:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    if not parts or "".join(number + unit for number, unit in parts) != duration:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def seconds_until_timestamp(timestamp: str) -> float:
+    """Parse an RFC 3339 timestamp like "2024-10-01T12:00:30Z" into seconds from now; returns None if unparseable."""
+    if not timestamp:
+        return None
+    try:
+        reset_time = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(reset_time.timestamp() - time.time(), 0)
+
+
+def results_file_compressor(filename: str):
+    """Return a function compressing bytes into one complete gzip member or zstd frame, if the file's name
+    ends in .gz or .zst (or None, for a plain file). Readers of either format read consecutive members or
+    frames as one stream, so a file can be appended to a batch at a time, and cut back between batches."""
+    if filename.endswith(".gz"):
+        return gzip.compress
+    elif filename.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(
+                "Writing .zst results requires the zstandard package (pip install zstandard)"
+            )
+        return zstandard.ZstdCompressor().compress
+    else:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoding(token_encoding_name: str) -> tiktoken.Encoding:
+    """Load a tiktoken encoding, once per process."""
+    return tiktoken.get_encoding(token_encoding_name)
 
 
 def num_tokens_consumed_from_request(
@@ -389,8 +2415,78 @@ def num_tokens_consumed_from_request(
     api_endpoint: str,
     token_encoding_name: str,
 ):
-    """Count the number of tokens in the request. Only supports completion and embedding requests."""
-    encoding = tiktoken.get_encoding(token_encoding_name)
+    """Count the number of tokens in the request. Only supports completion, embedding, and Anthropic messages requests."""
+    return num_tokens_consumed_from_requests(
+        [request_json], api_endpoint, token_encoding_name
+    )[0]
+
+
+def num_tokens_consumed_from_requests(
+    request_jsons: list,
+    api_endpoint: str,
+    token_encoding_name: str,
+) -> list:
+    """Count the number of tokens in each request, encoding the text of all of them in one batch."""
+    encoding = get_token_encoding(token_encoding_name)
+    texts = []  # every string to encode, across all requests
+    text_owners = []  # index of the request each string belongs to
+    token_counts = []  # starts at each request's fixed tokens; text tokens are added below
+    for i, request_json in enumerate(request_jsons):
+        request_texts, fixed_tokens = texts_and_fixed_tokens_from_request(
+            request_json, api_endpoint
+        )
+        texts.extend(request_texts)
+        text_owners.extend([i] * len(request_texts))
+        token_counts.append(fixed_tokens)
+
+    # encode_ordinary_batch encodes on a thread pool, which only pays off with
+    # several cores and more than a handful of strings
+    num_threads = min(8, os.cpu_count() or 1)
+    if num_threads > 1 and len(texts) > 16:
+        encoded_texts = encoding.encode_ordinary_batch(texts, num_threads=num_threads)
+    else:
+        encoded_texts = [encoding.encode_ordinary(text) for text in texts]
+    for owner, tokens in zip(text_owners, encoded_texts):
+        token_counts[owner] += len(tokens)
+    return token_counts
+
+
+def completion_token_limits_from_request(request_json: dict, api_endpoint: str) -> tuple:
+    """Return the max tokens per completion a request allows, and how many completions it asks for (0 if none)."""
+    if api_endpoint.endswith("completions"):
+        num_completions = request_json.get("n", 1)
+        if not api_endpoint.startswith("chat/") and isinstance(
+            request_json.get("prompt"), list
+        ):
+            num_completions *= len(request_json["prompt"])  # multiple prompts
+        return request_json.get("max_tokens", 15), num_completions
+    elif api_endpoint == "messages":
+        return request_json["max_tokens"], 1
+    return 0, 0
+
+
+def tokens_from_usage(usage: dict) -> tuple:
+    """Return the completion and total tokens in a response's usage (OpenAI or Anthropic), or (None, None)."""
+    if not isinstance(usage, dict):
+        return None, None
+    if "output_tokens" in usage:  # Anthropic
+        input_tokens = usage.get("input_tokens", 0) + (
+            usage.get("cache_creation_input_tokens") or 0
+        )
+        return usage["output_tokens"], input_tokens + usage["output_tokens"]
+    if "total_tokens" in usage:  # OpenAI; embeddings have no completion tokens
+        return usage.get("completion_tokens", 0), usage["total_tokens"]
+    return None, None
+
+
+def texts_and_fixed_tokens_from_request(
+    request_json: dict,
+    api_endpoint: str,
+) -> tuple:
+    """Return the strings to encode for a request, plus tokens that don't depend on them.
+
+    The request's token count is the encoded length of the strings plus the fixed tokens.
+    """
     # if completions request, tokens = prompt + n * max_tokens
     if api_endpoint.endswith("completions"):
         max_tokens = request_json.get("max_tokens", 15)
@@ -399,26 +2495,23 @@ def num_tokens_consumed_from_request(
 
         # chat completions
         if api_endpoint.startswith("chat/"):
-            num_tokens = 0
+            texts = []
+            fixed_tokens = 0
             for message in request_json["messages"]:
-                num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+                fixed_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
                 for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
+                    texts.append(value)
                     if key == "name":  # if there's a name, the role is omitted
-                        num_tokens -= 1  # role is always required and always 1 token
-            num_tokens += 2  # every reply is primed with <im_start>assistant
-            return num_tokens + completion_tokens
+                        fixed_tokens -= 1  # role is always required and always 1 token
+            fixed_tokens += 2  # every reply is primed with <im_start>assistant
+            return texts, fixed_tokens + completion_tokens
         # normal completions
         else:
             prompt = request_json["prompt"]
             if isinstance(prompt, str):  # single prompt
-                prompt_tokens = len(encoding.encode(prompt))
-                num_tokens = prompt_tokens + completion_tokens
-                return num_tokens
+                return [prompt], completion_tokens
             elif isinstance(prompt, list):  # multiple prompts
-                prompt_tokens = sum([len(encoding.encode(p)) for p in prompt])
-                num_tokens = prompt_tokens + completion_tokens * len(prompt)
-                return num_tokens
+                return prompt, completion_tokens * len(prompt)
             else:
                 raise TypeError(
                     'Expecting either string or list of strings for "prompt" field in completion request'
@@ -427,15 +2520,38 @@ def num_tokens_consumed_from_request(
     elif api_endpoint == "embeddings":
         input = request_json["input"]
         if isinstance(input, str):  # single input
-            num_tokens = len(encoding.encode(input))
-            return num_tokens
+            return [input], 0
         elif isinstance(input, list):  # multiple inputs
-            num_tokens = sum([len(encoding.encode(i)) for i in input])
-            return num_tokens
+            return input, 0
         else:
             raise TypeError(
                 'Expecting either string or list of strings for "inputs" field in embedding request'
             )
+    # if Anthropic messages request, tokens = system + messages + tools + max_tokens
+    # (Claude's tokenizer isn't public, so text is counted with token_encoding_name as an estimate)
+    elif api_endpoint == "messages":
+        texts = []
+        fixed_tokens = request_json["max_tokens"]
+        system = request_json.get("system")
+        if isinstance(system, str):
+            texts.append(system)
+        elif isinstance(system, list):  # text blocks
+            fixed_tokens += texts_and_fixed_tokens_from_content_blocks(system, texts)
+        for message in request_json["messages"]:
+            fixed_tokens += 4  # rough allowance for the role and turn markers around each message
+            content = message["content"]
+            if isinstance(content, str):
+                texts.append(content)
+            else:
+                fixed_tokens += texts_and_fixed_tokens_from_content_blocks(
+                    content, texts
+                )
+        tools = request_json.get("tools")
+        if tools:
+            fixed_tokens += 346  # system prompt the API adds when tools are given
+            # each tool's name, description, and input schema are all sent to the model
+            texts.extend(json.dumps(tool) for tool in tools)
+        return texts, fixed_tokens
     # more logic needed to support other API calls (e.g., edits, inserts, DALL-E)
     else:
         raise NotImplementedError(
@@ -443,12 +2559,567 @@ def num_tokens_consumed_from_request(
         )
 
 
-def task_id_generator_function():
-    """Generate integers 0, 1, 2, and so on."""
-    task_id = 0
-    while True:
-        yield task_id
-        task_id += 1
+def texts_and_fixed_tokens_from_content_blocks(blocks: list, texts: list) -> int:
+    """Add the strings to encode from Anthropic content blocks to `texts`; returns tokens that don't depend on them."""
+    fixed_tokens = 0
+    for block in blocks:
+        block_type = block.get("type")
+        if block_type == "text":
+            texts.append(block["text"])
+        elif block_type == "image":
+            fixed_tokens += image_tokens(block.get("source", {}))
+        elif block_type == "tool_use":
+            texts.append(block.get("name", ""))
+            texts.append(json.dumps(block.get("input", {})))
+        elif block_type == "tool_result":
+            content = block.get("content", "")
+            if isinstance(content, str):
+                texts.append(content)
+            else:
+                fixed_tokens += texts_and_fixed_tokens_from_content_blocks(
+                    content, texts
+                )
+        elif block_type == "thinking":
+            texts.append(block.get("thinking", ""))
+        else:
+            # documents and anything newer: count the block's JSON, which overestimates
+            # binary sources, erring on the side of staying under the limit
+            texts.append(json.dumps(block))
+    return fixed_tokens
+
+
+def image_tokens(source: dict) -> int:
+    """Estimate an image's tokens as width * height / 750, reading the size from PNG or GIF headers.
+
+    Larger images are scaled down by the API, so no image costs more than about 1,600 tokens;
+    images whose size can't be read cheaply (URLs, JPEGs, ...) are counted at that maximum.
+    """
+    max_image_tokens = 1_600
+    if source.get("type") != "base64":
+        return max_image_tokens
+    try:
+        header = base64.b64decode(source.get("data", "")[:32])
+    except ValueError:
+        return max_image_tokens
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        width, height = struct.unpack(">II", header[16:24])
+    elif header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        width, height = struct.unpack("<HH", header[6:10])
+    else:
+        return max_image_tokens
+    return min(max_image_tokens, math.ceil(width * height / 750))
+
+
+def log_final_status(status_tracker: StatusTracker, save_filepath: str) -> None:
+    """Log where results went, and warn about failures and rate limit errors."""
+    logging.info(
+        f"""Parallel processing complete. Results saved to {save_filepath}"""
+    )
+    if status_tracker.num_tasks_failed > 0:
+        logging.warning(
+            f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
+        )
+    if status_tracker.num_rate_limit_errors > 0:
+        logging.warning(
+            f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
+        )
+    if status_tracker.num_cache_hits + status_tracker.num_cache_misses > 0:
+        logging.info(
+            f"{status_tracker.num_cache_hits} requests answered from the cache, {status_tracker.num_cache_misses} sent to the API"
+        )
+    if status_tracker.num_deadlines_missed > 0:
+        logging.warning(
+            f"{status_tracker.num_deadlines_missed} requests finished after their deadline."
+        )
+    if len(status_tracker.latency_by_priority) > 1:
+        for priority, latency in sorted(status_tracker.latency_by_priority.items()):
+            logging.info(
+                f"Priority {priority}: latency from read to result p50 {latency.percentile(50):.3f}s, p99 {latency.percentile(99):.3f}s"
+            )
+    seconds_elapsed = time.time() - status_tracker.time_started
+    if status_tracker.request_latency.counts:
+        logging.info(
+            f"{status_tracker.num_tasks_succeeded / seconds_elapsed:.1f} requests/s, {status_tracker.num_tokens_consumed / seconds_elapsed:.0f} tokens/s; "
+            f"request latency p50 {status_tracker.request_latency.percentile(50):.3f}s, p99 {status_tracker.request_latency.percentile(99):.3f}s"
+        )
+
+
+def process_api_requests_from_file_in_shards(
+    requests_filepath: str,
+    save_filepath: str,
+    max_requests_per_minute: float,
+    max_tokens_per_minute: float,
+    workers: int,
+    checkpoint_filepath: str = None,
+    targets: list = None,
+    metrics_filepath: str = None,
+    metrics_port: int = None,
+    trace_filepath: str = None,
+    **processor_kwargs,
+) -> StatusTracker:
+    """Processes the requests file in `workers` processes, one per byte range, then merges their results.
+
+    Request & token limits (each target's, if targets are given) are split evenly between the workers. Each worker gets its own
+    checkpoint, metrics, and trace file, and serves metrics on its own port. Other arguments are passed through
+    to process_api_requests_from_file. Returns a StatusTracker summed over all shards.
+    """
+    logging.basicConfig(level=processor_kwargs.get("logging_level", logging.INFO))
+    shards = []
+    for shard_index, (start_offset, end_offset) in enumerate(
+        shard_byte_ranges(requests_filepath, workers)
+    ):
+        shards.append(
+            dict(
+                processor_kwargs,
+                requests_filepath=requests_filepath,
+                save_filepath=shard_filepath(save_filepath, shard_index),
+                checkpoint_filepath=(
+                    None
+                    if checkpoint_filepath is None
+                    else shard_filepath(checkpoint_filepath, shard_index)
+                ),
+                metrics_filepath=(
+                    None
+                    if metrics_filepath is None
+                    else shard_filepath(metrics_filepath, shard_index)
+                ),
+                metrics_port=None if metrics_port is None else metrics_port + shard_index,
+                trace_filepath=(
+                    None
+                    if trace_filepath is None
+                    else shard_filepath(trace_filepath, shard_index)
+                ),
+                max_requests_per_minute=max_requests_per_minute / workers,
+                max_tokens_per_minute=max_tokens_per_minute / workers,
+                targets=(
+                    None
+                    if targets is None
+                    else [
+                        dict(
+                            target,
+                            max_requests_per_minute=target["max_requests_per_minute"] / workers,
+                            max_tokens_per_minute=target["max_tokens_per_minute"] / workers,
+                        )
+                        for target in targets
+                    ]
+                ),
+                start_offset=start_offset,
+                end_offset=end_offset,
+                rate_limit_share=1 / workers,
+            )
+        )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shard_statuses = list(executor.map(process_shard, shards))
+
+    # merge results in shard order, so output order doesn't depend on which worker finished first;
+    # compressed shards can be concatenated as they are (gzip members and zstd frames)
+    with open(save_filepath, "ab") as merged_file:
+        for shard in shards:
+            if os.path.exists(shard["save_filepath"]):
+                with open(shard["save_filepath"], "rb") as shard_file:
+                    shutil.copyfileobj(shard_file, merged_file)
+                os.remove(shard["save_filepath"])
+    # shard checkpoints are kept, so a finished job resumed again skips everything
+
+    # add up each shard's counters into one report
+    status_tracker = StatusTracker()
+    for shard_status in shard_statuses:
+        for name, value in shard_status.items():
+            if name == "time_of_last_rate_limit_error":
+                status_tracker.time_of_last_rate_limit_error = max(
+                    status_tracker.time_of_last_rate_limit_error, value
+                )
+            elif name == "time_started":
+                status_tracker.time_started = min(status_tracker.time_started, value)
+            elif name == "request_latency":
+                status_tracker.request_latency.merge(LatencyHistogram(**value))
+            elif name == "num_errors_by_class":
+                for error_class, count in value.items():
+                    status_tracker.num_errors_by_class[error_class] = (
+                        status_tracker.num_errors_by_class.get(error_class, 0) + count
+                    )
+            elif name == "latency_by_priority":
+                for priority, latency in value.items():
+                    if priority not in status_tracker.latency_by_priority:
+                        status_tracker.latency_by_priority[priority] = LatencyHistogram()
+                    status_tracker.latency_by_priority[priority].merge(
+                        LatencyHistogram(**latency)
+                    )
+            else:
+                setattr(status_tracker, name, getattr(status_tracker, name) + value)
+    log_final_status(status_tracker, save_filepath)
+    return status_tracker
+
+
+def shard_byte_ranges(requests_filepath: str, workers: int) -> list:
+    """Split a file into `workers` (start, end) byte ranges of roughly equal size, moved to line boundaries.
+
+    Parquet and Arrow files are split into row ranges instead; compressed JSONL can't be split.
+    """
+    file_format = requests_file_format(requests_filepath)
+    if file_format in ("parquet", "arrow"):
+        num_rows = sum(open_table_file(requests_filepath, file_format)[0])
+        boundaries = [num_rows * i // workers for i in range(workers + 1)]
+        return list(zip(boundaries[:-1], boundaries[1:]))
+    elif file_format != "jsonl":
+        raise ValueError(
+            f"Workers need an uncompressed requests file, to split it; decompress {requests_filepath} first"
+        )
+    file_size = os.path.getsize(requests_filepath)
+    boundaries = [0]
+    with open(requests_filepath, "rb") as file:
+        for i in range(1, workers):
+            # a boundary moves forward to the start of the next line (or stays, if it already is one)
+            file.seek(max(file_size * i // workers - 1, boundaries[-1]))
+            file.readline()
+            boundaries.append(min(file.tell(), file_size))
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def shard_filepath(filepath: str, shard_index: int) -> str:
+    """Insert the shard number before a file's extensions, e.g. results.jsonl.gz -> results.shard0.jsonl.gz."""
+    directory, filename = os.path.split(filepath)
+    stem, dot, extensions = filename.partition(".")
+    return os.path.join(directory, f"{stem}.shard{shard_index}{dot}{extensions}")
+
+
+def process_shard(shard_kwargs: dict) -> dict:
+    """Run process_api_requests_from_file on one shard, in a worker process; returns its status counters."""
+    status_tracker = asyncio.run(process_api_requests_from_file(**shard_kwargs))
+    return dataclasses.asdict(status_tracker)
+
+
+async def process_api_requests_in_message_batches(
+    requests_filepath: str,
+    save_filepath: str,
+    request_url: str,
+    api_key: str,
+    max_attempts: int,
+    logging_level: int,
+    checkpoint_filepath: str = None,
+    resume: bool = False,
+    fsync_policy: str = "never",
+    requests_per_batch: int = 10_000,
+    poll_interval_seconds: float = 60.0,
+) -> StatusTracker:
+    """Processes Anthropic messages requests through the Message Batches API. Returns the final StatusTracker.
+
+    The file is submitted in batches of `requests_per_batch`, each batch is polled until it ends, and its
+    results are saved like those of process_api_requests_from_file. Requests that error for reasons
+    worth retrying (or expire) are resubmitted in a follow-up batch, up to max_attempts in all.
+    Submitted batches are logged to {checkpoint_filepath}.batches, so a resumed job collects their
+    results instead of submitting (and paying for) the same requests again.
+    """
+    logging.basicConfig(level=logging_level)
+    if requests_file_format(requests_filepath) != "jsonl":
+        raise ValueError(
+            f"Message batches need an uncompressed .jsonl requests file, to look requests up by offset; {requests_filepath} isn't one"
+        )
+    if api_endpoint_from_url(request_url) != "messages":
+        raise ValueError(
+            f"Message batches need an Anthropic messages URL, like https://api.anthropic.com/v1/messages, not {request_url}"
+        )
+    batches_url = f"{request_url}/batches"
+    request_header = request_header_from_url(request_url, api_key)
+    status_tracker = StatusTracker()
+
+    # initialize checkpoint, and the log of submitted batches next to it
+    checkpoint, batch_log = None, None
+    submitted_batches = []
+    if checkpoint_filepath is not None:
+        checkpoint = Checkpoint(filepath=checkpoint_filepath)
+        batch_log_filepath = f"{checkpoint_filepath}.batches"
+        if resume:
+            checkpoint.load()
+            checkpoint.truncate_results(save_filepath)
+            if os.path.exists(batch_log_filepath):
+                with open(batch_log_filepath) as file:
+                    submitted_batches = [
+                        MessageBatch(**json.loads(line)) for line in file
+                    ]
+        checkpoint.open(append=resume)
+        batch_log = open(batch_log_filepath, "a" if resume else "w")
+    result_writer = ResultWriter(
+        filepath=save_filepath, checkpoint=checkpoint, fsync_policy=fsync_policy
+    )
+    result_writer.open()
+
+    # a request's results come from the last batch it was submitted in; earlier ones were retried
+    latest_batches = {}  # task_id -> batch
+    attempts = collections.Counter()  # task_id -> times submitted
+    for batch in submitted_batches:
+        for task_id, _ in batch.requests:
+            latest_batches[task_id] = batch
+            attempts[task_id] += 1
+    completed_task_ids = set() if checkpoint is None else checkpoint.completed_task_ids
+
+    def is_pending(task_id: int, batch: MessageBatch) -> bool:
+        finished = (
+            checkpoint is not None and task_id < checkpoint.first_task_id
+        ) or task_id in completed_task_ids
+        return latest_batches.get(task_id) is batch and not finished
+
+    with open(requests_filepath, "rb") as file, open(
+        requests_filepath, "rb"
+    ) as requests_file:  # the second handle is for looking up requests by offset
+        async with aiohttp.ClientSession() as session:
+            batch_kwargs = dict(
+                session=session,
+                batches_url=batches_url,
+                request_header=request_header,
+                requests_file=requests_file,
+                result_writer=result_writer,
+                status_tracker=status_tracker,
+                batch_log=batch_log,
+                attempts=attempts,
+                latest_batches=latest_batches,
+                max_attempts=max_attempts,
+                poll_interval_seconds=poll_interval_seconds,
+            )
+            batch_tasks = []
+
+            # collect the results of batches submitted before a restart
+            for batch in submitted_batches:
+                pending_task_ids = {
+                    task_id for task_id, _ in batch.requests if is_pending(task_id, batch)
+                }
+                if pending_task_ids:
+                    logging.info(
+                        f"Resuming batch {batch.id}, with {len(pending_task_ids)} requests still to collect"
+                    )
+                    status_tracker.num_tasks_started += len(pending_task_ids)
+                    status_tracker.num_tasks_in_progress += len(pending_task_ids)
+                    batch_tasks.append(
+                        asyncio.create_task(
+                            run_message_batch(batch, pending_task_ids, **batch_kwargs)
+                        )
+                    )
+
+            # submit the rest of the file, skipping requests that are finished or already in a batch
+            first_task_id, first_offset = 0, 0
+            if checkpoint is not None:
+                first_task_id, first_offset = checkpoint.first_task_id, checkpoint.start_offset
+            file.seek(first_offset)
+            numbered_lines = numbered_lines_from_file(
+                file,
+                first_task_id,
+                first_offset,
+                completed_task_ids.union(latest_batches),
+            )
+            while True:
+                batch = MessageBatch(
+                    requests=[
+                        (task_id, file_offset - len(line))
+                        for task_id, file_offset, line in itertools.islice(
+                            numbered_lines, requests_per_batch
+                        )
+                    ]
+                )
+                if not batch.requests:
+                    break
+                status_tracker.num_tasks_started += len(batch.requests)
+                status_tracker.num_tasks_in_progress += len(batch.requests)
+                for task_id, _ in batch.requests:
+                    latest_batches[task_id] = batch
+                    attempts[task_id] += 1
+                batch_tasks.append(
+                    asyncio.create_task(
+                        run_message_batch(
+                            batch,
+                            {task_id for task_id, _ in batch.requests},
+                            **batch_kwargs,
+                        )
+                    )
+                )
+                await asyncio.sleep(0)  # let the batch be submitted before reading the next one
+            await asyncio.gather(*batch_tasks)
+
+    await result_writer.close()
+    if checkpoint is not None:
+        checkpoint.close()
+        batch_log.close()
+    log_final_status(status_tracker, save_filepath)
+    return status_tracker
+
+
+async def run_message_batch(
+    batch: MessageBatch,
+    pending_task_ids: set,
+    session: aiohttp.ClientSession,
+    batches_url: str,
+    request_header: dict,
+    requests_file,
+    result_writer: ResultWriter,
+    status_tracker: StatusTracker,
+    batch_log,
+    attempts: collections.Counter,
+    latest_batches: dict,
+    max_attempts: int,
+    poll_interval_seconds: float,
+) -> None:
+    """Submit a batch (unless it already was), wait for it to end, and save its results; resubmit retryable failures."""
+    while batch is not None:
+        request_offsets = dict(batch.requests)
+        if batch.id is None:
+            body = {
+                "requests": [
+                    {"custom_id": str(task_id), "params": request_json}
+                    for task_id, (request_json, _, _) in (
+                        (task_id, read_request_at(requests_file, request_offsets[task_id]))
+                        for task_id, _ in batch.requests
+                    )
+                ]
+            }
+            submitted = await call_batches_api(
+                session, "POST", batches_url, request_header, json=body
+            )
+            del body
+            batch.id, batch.time_submitted = submitted["id"], time.time()
+            if batch_log is not None:
+                batch_log.write(json.dumps(dataclasses.asdict(batch)) + "\n")
+                batch_log.flush()
+            logging.info(f"Submitted batch {batch.id} of {len(batch.requests)} requests")
+
+        # wait for the batch to end
+        while True:
+            batch_status = await call_batches_api(
+                session, "GET", f"{batches_url}/{batch.id}", request_header
+            )
+            if batch_status["processing_status"] == "ended":
+                break
+            logging.debug(f"Batch {batch.id}: {batch_status['request_counts']}")
+            await asyncio.sleep(poll_interval_seconds)
+        logging.info(f"Batch {batch.id} ended: {batch_status['request_counts']}")
+
+        # save results, and collect the requests worth another try
+        retries = []
+        async for result_line in iter_batch_results(
+            session, batch_status["results_url"], request_header
+        ):
+            result = json.loads(result_line)
+            task_id = int(result["custom_id"])
+            if task_id not in pending_task_ids:
+                continue  # finished before a restart, or retried in a later batch
+            pending_task_ids.discard(task_id)
+            request_json, metadata, end_offset = read_request_at(
+                requests_file, request_offsets[task_id]
+            )
+            outcome = result["result"]
+            status_tracker.request_latency.record(time.time() - batch.time_submitted)
+            if outcome["type"] == "succeeded":
+                response = outcome["message"]
+                data = (
+                    [request_json, response, metadata]
+                    if metadata
+                    else [request_json, response]
+                )
+                result_writer.write(data, task_id, end_offset)
+                status_tracker.num_tasks_in_progress -= 1
+                status_tracker.num_tasks_succeeded += 1
+                usage = response.get("usage", {})
+                status_tracker.num_tokens_consumed += usage.get(
+                    "input_tokens", 0
+                ) + usage.get("output_tokens", 0)
+                continue
+            # errored results hold an error response; expired and canceled ones hold nothing
+            error = outcome.get("error", {"type": outcome["type"]})
+            error_type = error.get("error", {}).get("type")
+            if error_type == "rate_limit_error":
+                status_tracker.num_rate_limit_errors += 1
+                status_tracker.time_of_last_rate_limit_error = time.time()
+            else:
+                status_tracker.num_api_errors += 1
+            retryable = outcome["type"] == "expired" or error_type in (
+                "api_error",
+                "overloaded_error",
+                "rate_limit_error",
+            )
+            if retryable and attempts[task_id] < max_attempts:
+                retries.append((task_id, request_offsets[task_id]))
+            else:
+                logging.error(
+                    f"Request {request_json} failed after all attempts. Saving errors: {error}"
+                )
+                data = (
+                    [request_json, [str(error)], metadata]
+                    if metadata
+                    else [request_json, [str(error)]]
+                )
+                result_writer.write(data, task_id, end_offset)
+                status_tracker.num_tasks_in_progress -= 1
+                status_tracker.num_tasks_failed += 1
+        # requests the results left out (which shouldn't happen) are retried too
+        retries.extend(
+            (task_id, request_offsets[task_id]) for task_id in sorted(pending_task_ids)
+        )
+
+        batch = None
+        if retries:
+            logging.warning(f"Resubmitting {len(retries)} failed requests in a new batch")
+            batch = MessageBatch(requests=retries)
+            pending_task_ids = {task_id for task_id, _ in retries}
+            for task_id in pending_task_ids:
+                latest_batches[task_id] = batch
+                attempts[task_id] += 1
+
+
+def read_request_at(requests_file, file_offset: int) -> tuple:
+    """Read the request whose line starts at `file_offset`; returns (request_json, metadata, offset past the line)."""
+    requests_file.seek(file_offset)
+    request_json = json.loads(requests_file.readline())
+    return request_json, request_json.pop("metadata", None), requests_file.tell()
+
+
+async def call_batches_api(
+    session: aiohttp.ClientSession,
+    method: str,
+    url: str,
+    request_header: dict,
+    max_attempts: int = 5,
+    **kwargs,
+) -> dict:
+    """Make one Message Batches API call, retrying rate limit, server, and connection errors with backoff."""
+    for attempt in range(max_attempts):
+        try:
+            async with session.request(
+                method, url, headers=request_header, **kwargs
+            ) as http_response:
+                if http_response.status < 500 and http_response.status != 429:
+                    response = await http_response.json()
+                    if "error" in response:
+                        raise RuntimeError(f"{method} {url} failed: {response['error']}")
+                    return response
+                error = f"HTTP {http_response.status}"
+                retry_after_seconds = rate_limits_from_headers(http_response.headers).get(
+                    "retry_after_seconds", 0
+                )
+        except aiohttp.ClientError as e:
+            error, retry_after_seconds = e, 0
+        if attempt + 1 == max_attempts:
+            raise RuntimeError(f"{method} {url} failed after {max_attempts} attempts: {error}")
+        seconds_to_back_off = max(random.uniform(0, 2**attempt), retry_after_seconds)
+        logging.warning(
+            f"{method} {url} failed with {error}; retrying in {seconds_to_back_off:.1f} seconds"
+        )
+        await asyncio.sleep(seconds_to_back_off)
+
+
+async def iter_batch_results(
+    session: aiohttp.ClientSession, results_url: str, request_header: dict
+):
+    """Stream a batch's results file, yielding one line at a time (lines can be too long for readline)."""
+    async with session.get(results_url, headers=request_header) as http_response:
+        http_response.raise_for_status()
+        buffer = b""
+        async for chunk in http_response.content.iter_chunked(1 << 16):
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
 
 
 # run script
@@ -460,31 +3131,114 @@ if __name__ == "__main__":
     parser.add_argument("--requests_filepath")
     parser.add_argument("--save_filepath", default=None)
     parser.add_argument("--request_url", default="https://api.openai.com/v1/embeddings")
-    parser.add_argument("--api_key", default=os.getenv("OPENAI_API_KEY"))
+    parser.add_argument("--api_key", default=None)
     parser.add_argument("--max_requests_per_minute", type=int, default=3_000 * 0.5)
     parser.add_argument("--max_tokens_per_minute", type=int, default=250_000 * 0.5)
     parser.add_argument("--token_encoding_name", default="cl100k_base")
     parser.add_argument("--max_attempts", type=int, default=5)
+    parser.add_argument("--max_requests_in_flight", type=int, default=1_000)
+    parser.add_argument("--max_error_history", type=int, default=5)
     parser.add_argument("--logging_level", default=logging.INFO)
+    parser.add_argument("--checkpoint_filepath", default=None)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--fsync_policy", default="never")
+    parser.add_argument("--result_batch_size", type=int, default=1_000)
+    parser.add_argument("--result_flush_interval_seconds", type=float, default=None)
+    parser.add_argument("--adaptive_rate_limits", action="store_true")
+    parser.add_argument("--targets_filepath", default=None)
+    parser.add_argument("--priority_aging_seconds", type=float, default=10)
+    parser.add_argument("--coalesce_max_inputs", type=int, default=1)
+    parser.add_argument("--coalesce_max_tokens", type=int, default=100_000)
+    parser.add_argument("--learn_completion_tokens", action="store_true")
+    parser.add_argument("--completion_token_quantile", type=float, default=0.99)
+    parser.add_argument("--metrics_filepath", default=None)
+    parser.add_argument("--metrics_interval_seconds", type=float, default=10)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--trace_filepath", default=None)
+    parser.add_argument("--cache_filepath", default=None)
+    parser.add_argument("--cache_max_megabytes", type=float, default=1_024)
+    parser.add_argument("--cache_ttl_hours", type=float, default=None)
+    parser.add_argument("--message_batches", action="store_true")
+    parser.add_argument("--requests_per_batch", type=int, default=10_000)
+    parser.add_argument("--batch_poll_seconds", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=1)
     args = parser.parse_args()
 
     if args.save_filepath is None:
-        args.save_filepath = args.requests_filepath.replace(".jsonl", "_results.jsonl")
+        if ".jsonl" in args.requests_filepath:
+            args.save_filepath = args.requests_filepath.replace(".jsonl", "_results.jsonl")
+        else:  # a table file
+            args.save_filepath = os.path.splitext(args.requests_filepath)[0] + "_results.jsonl"
+    if args.checkpoint_filepath is None:
+        args.checkpoint_filepath = args.save_filepath + ".checkpoint"
+    if args.api_key is None:
+        if api_endpoint_from_url(args.request_url).startswith("messages"):
+            args.api_key = os.getenv("ANTHROPIC_API_KEY")
+        else:
+            args.api_key = os.getenv("OPENAI_API_KEY")
 
     # run script
-    asyncio.run(
-        process_api_requests_from_file(
-            requests_filepath=args.requests_filepath,
-            save_filepath=args.save_filepath,
+    processor_kwargs = dict(
+        requests_filepath=args.requests_filepath,
+        save_filepath=args.save_filepath,
+        request_url=args.request_url,
+        api_key=args.api_key,
+        max_requests_per_minute=float(args.max_requests_per_minute),
+        max_tokens_per_minute=float(args.max_tokens_per_minute),
+        token_encoding_name=args.token_encoding_name,
+        max_attempts=int(args.max_attempts),
+        max_requests_in_flight=args.max_requests_in_flight,
+        max_error_history=args.max_error_history,
+        priority_aging_seconds=args.priority_aging_seconds,
+        coalesce_max_inputs=args.coalesce_max_inputs,
+        coalesce_max_tokens=args.coalesce_max_tokens,
+        learn_completion_tokens=args.learn_completion_tokens,
+        completion_token_quantile=args.completion_token_quantile,
+        logging_level=int(args.logging_level),
+        checkpoint_filepath=args.checkpoint_filepath,
+        resume=args.resume,
+        fsync_policy=args.fsync_policy,
+        result_batch_size=args.result_batch_size,
+        result_flush_interval_seconds=args.result_flush_interval_seconds,
+        adaptive_rate_limits=args.adaptive_rate_limits,
+        metrics_filepath=args.metrics_filepath,
+        metrics_interval_seconds=args.metrics_interval_seconds,
+        metrics_port=args.metrics_port,
+        trace_filepath=args.trace_filepath,
+        cache_filepath=args.cache_filepath,
+        cache_max_bytes=int(args.cache_max_megabytes * 1024**2),
+        cache_ttl_seconds=(
+            None if args.cache_ttl_hours is None else args.cache_ttl_hours * 3600
+        ),
+    )
+    if args.targets_filepath is not None:
+        processor_kwargs["targets"] = load_api_targets(
+            args.targets_filepath,
             request_url=args.request_url,
             api_key=args.api_key,
             max_requests_per_minute=float(args.max_requests_per_minute),
             max_tokens_per_minute=float(args.max_tokens_per_minute),
-            token_encoding_name=args.token_encoding_name,
-            max_attempts=int(args.max_attempts),
-            logging_level=int(args.logging_level),
         )
-    )
+    if args.message_batches:
+        asyncio.run(
+            process_api_requests_in_message_batches(
+                requests_filepath=args.requests_filepath,
+                save_filepath=args.save_filepath,
+                request_url=args.request_url,
+                api_key=args.api_key,
+                max_attempts=int(args.max_attempts),
+                logging_level=int(args.logging_level),
+                checkpoint_filepath=args.checkpoint_filepath,
+                resume=args.resume,
+                fsync_policy=args.fsync_policy,
+                requests_per_batch=args.requests_per_batch,
+                poll_interval_seconds=args.batch_poll_seconds,
+            )
+        )
+    elif args.workers > 1:
+        process_api_requests_from_file_in_shards(workers=args.workers, **processor_kwargs)
+    else:
+        asyncio.run(process_api_requests_from_file(**processor_kwargs))
 
 
 """
@@ -0,0 +1,139 @@
+"""
+IMAGE INGESTION
+
+What the image search backends (v3_qdrant.py, v3_numpy.py, v3_supabase.py) share in getting images to Cohere's
+embed API: preprocessing, reading and hashing files, and the pipeline that embeds them concurrently, leaving
+each backend only the code that stores and searches the embeddings.
+"""
+
+from PIL import Image, ImageOps
+import cohere
+import base64
+import os
+import asyncio
+import httpx
+import hashlib
+import io
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from request_pacing import RequestPacer
+
+max_image_side = 1024  # camera-sized images only add upload time (and can hit the API's size limits), not embedding quality
+
+def preprocess_image(image_bytes, max_side=max_image_side, image_format="JPEG", quality=85):
+    """Encode an image as a base64 data URL for the embed API, scaled down to fit max_side pixels.
+
+    A JPEG or WebP that already fits is sent as it is; anything else (a bigger image, or a PNG, GIF, ...)
+    is turned upright, resized, and re-encoded as image_format ("JPEG" or "WEBP"). With max_side=None,
+    every image is sent as it is. The data URL's MIME type is always that of the bytes in it.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if max_side is None or (img.format in ("JPEG", "WEBP") and max(img.size) <= max_side):
+            mime_type = Image.MIME[img.format]
+        else:
+            img.draft("RGB", (max_side, max_side))  # lets a JPEG decode at a fraction of its size, which is much faster
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, format=image_format, quality=quality)
+            image_bytes, mime_type = buffer.getvalue(), Image.MIME[image_format.upper()]
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+def read_image(image_path):
+    """Read an image, returning its content hash (of the file as it is, whatever preprocessing it gets) and its bytes."""
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    return hashlib.sha256(image_bytes).hexdigest(), image_bytes
+
+def scan_folder(folder_path):
+    """The files in a folder, as a dict of path -> (file name, modification time in ns, size)."""
+    files = {}
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files[entry.path] = (entry.name, stat.st_mtime_ns, stat.st_size)
+    return files
+
+async def embed_images(
+    file_paths,
+    is_embedded,
+    counts,
+    max_concurrency=16,
+    requests_per_minute=None,
+    read_workers=8,
+    max_side=max_image_side,
+    image_format="JPEG",
+    preprocess_processes=None
+):
+    """Read, hash, and embed image files, yielding (file path, content hash, embedding) as each is done.
+
+    Embedding one image at a time leaves the pipeline idle while each call is in flight, so:
+    - files are read and hashed in a pool of read_workers threads, ahead of the embed calls, and content that
+      is_embedded(content_hash) doesn't already know is scaled down to fit max_side pixels and re-encoded as
+      image_format (see preprocess_image) in the same threads, or in a pool of preprocess_processes processes
+      if given (resizing big images is CPU-bound)
+    - at most max_concurrency embed calls are in flight, starting at most requests_per_minute a minute
+      (the Cohere client also retries 429s)
+    Only a window of files is in memory at once, however many there are. Content already embedded is yielded
+    with the embedding None. A file that fails to read or embed is reported and skipped; counts["failed"]
+    counts those, and counts["bytes_read"] and counts["bytes_sent"] the bytes read from the embedded files
+    and sent for them (base64 data URLs).
+    """
+    loop = asyncio.get_running_loop()
+    pacer = RequestPacer(requests_per_minute)
+    embed_slots = asyncio.Semaphore(max_concurrency)
+
+    async def embed_file(async_co, file_path):
+        try:
+            content_hash, image_bytes = await loop.run_in_executor(read_executor, read_image, file_path)
+            if is_embedded(content_hash):
+                return file_path, content_hash, None
+            enc_img = await loop.run_in_executor(
+                preprocess_executor, preprocess_image, image_bytes, max_side, image_format
+            )
+            counts["bytes_read"] += len(image_bytes)
+            counts["bytes_sent"] += len(enc_img)
+            del image_bytes  # only the (smaller) data URL needs to wait for an embed slot
+            async with embed_slots:
+                await pacer.wait()
+                response = await async_co.embed(
+                    model="embed-multilingual-v3.0",
+                    images=[enc_img],
+                    input_type="image",
+                    embedding_types=["float"],
+                )
+        except Exception as e:
+            print(f"Skipping {file_path}: {e}")
+            return None
+        return file_path, content_hash, response.embeddings.float_[0]
+
+    # the async client is made per run, since its connections belong to this run's event loop
+    async with httpx.AsyncClient(
+        timeout=300, limits=httpx.Limits(max_connections=max_concurrency)
+    ) as http_client:
+        async_co = cohere.AsyncClientV2(
+            api_key=os.environ.get("CO_API_KEY", "your-cohere-api-key"),
+            base_url=os.environ.get("CO_API_URL"),
+            httpx_client=http_client
+        )
+        with ThreadPoolExecutor(read_workers) as read_executor, (
+            ProcessPoolExecutor(preprocess_processes) if preprocess_processes else ThreadPoolExecutor(read_workers)
+        ) as preprocess_executor:
+            remaining_files = iter(file_paths)
+            in_flight = set()
+            window = max_concurrency + 2 * read_workers  # files being read or embedded
+            while True:
+                for file_path in itertools.islice(remaining_files, window - len(in_flight)):
+                    in_flight.add(asyncio.ensure_future(embed_file(async_co, file_path)))
+                if not in_flight:
+                    break
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result is None:
+                        counts["failed"] += 1
+                    else:
+                        yield result
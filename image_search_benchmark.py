@@ -0,0 +1,319 @@
+"""
+IMAGE SEARCH BENCHMARK
+
+Measures how fast v3_qdrant.py can index images, without spending money on the real Cohere API.
+
+The benchmark starts the mock API from api_mock_server.py in a separate process (it answers Cohere's
+/v2/embed with a random embedding per image), writes synthetic JPEGs to a temporary folder, and points
+v3_qdrant at the mock (through CO_API_URL) and at a local Qdrant (QDRANT_URL; by default an in-memory
+instance, or e.g. http://localhost:6333 for a Qdrant server running locally). Because the mock runs
+in its own process, the CPU time reported is the ingestion's alone.
+
+Each scenario reports images/s, CPU time, how many embed calls the mock answered, how many points the
+collection holds afterwards, and (for ingest_images) its counts of files indexed, embedded, unchanged,
+failed, and points deleted.
+
+Scenarios:
+- sequential: --sequential_images images embedded one at a time and upserted in one call at the end,
+  the way load_and_embed_images used to work
+- pipelined: ingest_images on --num_images images at each --max_concurrency, each into an emptied collection
+- resync_unchanged: ingest_images run again on the same folder; should make no embed calls and take well under a second
+- resync_changed: the same again after 1% of the images each are added, deleted, rewritten, and renamed;
+  should embed only the added and rewritten images, delete the points of the deleted and rewritten ones,
+  and just update the payloads of the renamed ones
+- paced: ingest_images with requests_per_minute set to the limit the mock enforces (with 429s) in a second
+  mock, for 10 seconds' worth of images; throughput should sit at the limit
+- camera_original / camera_downscaled / camera_downscaled_processes: ingest_images on --camera_images 12-megapixel
+  photos (a quarter of them PNGs) through a third mock that uploads request bodies at --upload_megabits_per_second,
+  first sending every file as it is, then scaled down to fit max_image_side and re-encoded as JPEG, in threads and
+  in a process per CPU (whose CPU time cpu_seconds leaves out); compare bytes_sent (and bytes_read) and wall_seconds. The synthetic photos are smoother
+  than noise but still compress worse than most real ones, so real savings in bytes are if anything larger
+
+Client CPU per image (mostly the Cohere SDK building its response object one float at a time, and httpx's
+connection pool bookkeeping) caps one process at around 40-50 images/s, however high max_concurrency goes;
+that is still about ten times the sequential rate, and turns days of indexing 200k images into about an hour.
+
+Example command to call script:
+```
+python image_search_benchmark.py --num_images 2000 --max_concurrency 8 32 64 --latency_seconds 0.2
+```
+
+Inputs:
+- num_images : int, optional
+    - images in each pipelined scenario
+    - if omitted, will default to 2,000
+- sequential_images : int, optional
+    - images in the sequential scenario
+    - if omitted, will default to 100
+- max_concurrency : list of int, optional
+    - embed calls in flight to run the pipelined scenario with
+    - if omitted, will default to 8, 32, and 64
+- image_size : int, optional
+    - width and height of the synthetic images, in pixels
+    - if omitted, will default to 512
+- latency_seconds : float, optional
+    - mean time the mock waits before answering each embed call
+    - if omitted, will default to 0.2
+- latency_distribution : str, optional
+    - "constant", "exponential", or "lognormal"; see api_mock_server.py
+    - if omitted, will default to "lognormal"
+- camera_images : int, optional
+    - photos in each camera scenario
+    - if omitted, will default to 40
+- upload_megabits_per_second : float, optional
+    - upload bandwidth the camera scenarios' mock simulates
+    - if omitted, will default to 100
+- paced_requests_per_minute : float, optional
+    - request limit in the paced scenario
+    - if omitted, will default to 3,000
+- qdrant_url : str, optional
+    - Qdrant to index into
+    - if omitted, will default to ":memory:" (Qdrant's local mode, in this process)
+- port : int, optional
+    - port the mock server listens on (the paced scenario's mock uses the next one, the camera scenarios' the one after)
+    - if omitted, will default to 8751
+"""
+
+# imports
+import argparse  # for running script from command line
+import asyncio  # for running ingest_images
+import glob  # for picking images to change
+import json  # for printing results
+import os  # for pointing the clients at the mock and local Qdrant
+import random  # for coloring the synthetic images
+import resource  # for measuring CPU time
+import tempfile  # for the synthetic images
+import time  # for measuring wall time
+
+from PIL import Image  # for writing the synthetic images
+
+from api_request_benchmark import requests_served, start_mock_server, stop_mock_server
+
+
+# functions
+
+
+def write_synthetic_images(folder_path: str, num_images: int, image_size: int) -> None:
+    """Write noisy JPEGs, so each compresses to a realistic size and gets its own embedding."""
+    for i in range(num_images):
+        image = Image.effect_noise((image_size, image_size), random.uniform(20, 80)).convert("RGB")
+        tint = Image.new("RGB", image.size, tuple(random.randrange(256) for _ in range(3)))
+        Image.blend(image, tint, 0.5).save(os.path.join(folder_path, f"image_{i:06d}.jpg"), quality=85)
+
+
+def write_camera_images(folder_path: str, num_images: int, image_size: tuple = (4000, 3000)) -> None:
+    """Write camera-sized photos, three JPEGs to every PNG: one blurred noise picture with film grain, tinted differently each time."""
+    base = Image.effect_noise((image_size[0] // 10, image_size[1] // 10), 60).convert("RGB")
+    base = base.resize(image_size, Image.Resampling.BICUBIC)
+    photo = Image.blend(base, Image.effect_noise(image_size, 30).convert("RGB"), 0.15)
+    for i in range(num_images):
+        tint = Image.new("RGB", image_size, tuple(random.randrange(256) for _ in range(3)))
+        image = Image.blend(photo, tint, 0.4)
+        if i % 4 == 3:
+            image.save(os.path.join(folder_path, f"photo_{i:06d}.png"), compress_level=1)
+        else:
+            image.save(os.path.join(folder_path, f"photo_{i:06d}.jpg"), quality=92)
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_collection(image_search) -> None:
+    image_search.qdrant_client.delete_collection(image_search.collection_name)
+    image_search.qdrant_client.create_collection(
+        collection_name=image_search.collection_name,
+        vectors_config=image_search.models.VectorParams(
+            size=image_search.vector_size, distance=image_search.models.Distance.COSINE
+        ),
+    )
+
+
+def embed_calls_served() -> int:
+    return asyncio.run(requests_served(os.environ["CO_API_URL"]))
+
+
+def report(
+    name: str, image_search, num_images: int, wall_seconds: float, cpu_used: float, embed_calls: int, **extra
+) -> dict:
+    return {
+        "scenario": name,
+        "images": num_images,
+        "wall_seconds": round(wall_seconds, 3),
+        "images_per_second": round(num_images / wall_seconds, 1),
+        "cpu_seconds": round(cpu_used, 3),
+        "embed_calls": embed_calls,
+        "points": image_search.qdrant_client.count(image_search.collection_name).count,
+        **extra,
+    }
+
+
+def change_images(folder_path: str, fraction: float, image_size: int) -> None:
+    """Add, delete, rewrite, and rename `fraction` of the images in the folder each."""
+    paths = sorted(glob.glob(os.path.join(folder_path, "*.jpg")))
+    num_changes = max(1, int(len(paths) * fraction))
+    random.shuffle(paths)
+    for path in paths[:num_changes]:
+        os.remove(path)
+    with tempfile.TemporaryDirectory() as new_folder:
+        write_synthetic_images(new_folder, 2 * num_changes, image_size)
+        new_paths = sorted(glob.glob(os.path.join(new_folder, "*.jpg")))
+        for i, new_path in enumerate(new_paths[:num_changes]):
+            os.replace(new_path, os.path.join(folder_path, f"added_{i:06d}.jpg"))
+        for path, new_path in zip(paths[num_changes : 2 * num_changes], new_paths[num_changes:]):
+            os.replace(new_path, path)  # same name, new content
+    for path in paths[2 * num_changes : 3 * num_changes]:
+        os.replace(path, path.replace(".jpg", "_renamed.jpg"))
+
+
+def run_sequential_scenario(image_search, folder_path: str) -> dict:
+    """Index the way load_and_embed_images used to: one blocking embed call per image, then one upsert."""
+    reset_collection(image_search)
+    embed_calls_before = embed_calls_served()
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    points = []
+    for i, file in enumerate(os.listdir(folder_path)):
+        file_path = os.path.join(folder_path, file)
+        embedding = image_search.image_to_base64_data_url(file_path).embeddings.float_[0]
+        points.append(
+            image_search.models.PointStruct(
+                id=i, vector=embedding, payload={"file_path": file_path, "file_name": file}
+            )
+        )
+    image_search.qdrant_client.upsert(collection_name=image_search.collection_name, points=points)
+    wall_seconds, cpu_used = time.time() - wall_start, cpu_seconds() - cpu_start
+    return report(
+        "sequential", image_search, len(points), wall_seconds, cpu_used, embed_calls_served() - embed_calls_before
+    )
+
+
+def run_pipelined_scenario(
+    image_search, name: str, folder_path: str, reset: bool = True, **ingest_kwargs
+) -> dict:
+    if reset:
+        reset_collection(image_search)
+    embed_calls_before = embed_calls_served()
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    counts = asyncio.run(image_search.ingest_images(folder_path, **ingest_kwargs))
+    wall_seconds, cpu_used = time.time() - wall_start, cpu_seconds() - cpu_start
+    ingest_kwargs.pop("manifest_path")
+    return report(
+        name,
+        image_search,
+        len(os.listdir(folder_path)),
+        wall_seconds,
+        cpu_used,
+        embed_calls_served() - embed_calls_before,
+        **counts,
+        **ingest_kwargs,
+    )
+
+
+# run script
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_images", type=int, default=2_000)
+    parser.add_argument("--sequential_images", type=int, default=100)
+    parser.add_argument("--max_concurrency", type=int, nargs="+", default=[8, 32, 64])
+    parser.add_argument("--image_size", type=int, default=512)
+    parser.add_argument("--latency_seconds", type=float, default=0.2)
+    parser.add_argument(
+        "--latency_distribution",
+        default="lognormal",
+        choices=["constant", "exponential", "lognormal"],
+    )
+    parser.add_argument("--camera_images", type=int, default=40)
+    parser.add_argument("--upload_megabits_per_second", type=float, default=100)
+    parser.add_argument("--paced_requests_per_minute", type=float, default=3_000)
+    parser.add_argument("--qdrant_url", default=":memory:")
+    parser.add_argument("--port", type=int, default=8751)
+    args = parser.parse_args()
+
+    server_kwargs = dict(
+        latency_seconds=args.latency_seconds,
+        latency_distribution=args.latency_distribution,
+    )
+    server = start_mock_server(args.port, **server_kwargs)
+    paced_server = start_mock_server(
+        args.port + 1, requests_per_minute=args.paced_requests_per_minute, **server_kwargs
+    )
+    camera_server = start_mock_server(
+        args.port + 2, upload_megabits_per_second=args.upload_megabits_per_second, **server_kwargs
+    )
+    try:
+        os.environ["CO_API_URL"] = f"http://127.0.0.1:{args.port}"
+        os.environ.setdefault("CO_API_KEY", "mock-key")
+        os.environ["QDRANT_URL"] = args.qdrant_url
+        import v3_qdrant as image_search  # its clients read the environment on import
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sequential_folder = os.path.join(tmpdir, "sequential")
+            folder = os.path.join(tmpdir, "images")
+            paced_folder = os.path.join(tmpdir, "paced")
+            camera_folder = os.path.join(tmpdir, "camera")
+            for folder_path, num_images in (
+                (sequential_folder, args.sequential_images),
+                (folder, args.num_images),
+                (paced_folder, int(args.paced_requests_per_minute / 6)),
+            ):
+                os.mkdir(folder_path)
+                write_synthetic_images(folder_path, num_images, args.image_size)
+            os.mkdir(camera_folder)
+            write_camera_images(camera_folder, args.camera_images)
+
+            manifest_path = os.path.join(tmpdir, "manifest.sqlite")
+            results = [run_sequential_scenario(image_search, sequential_folder)]
+            for max_concurrency in args.max_concurrency:
+                results.append(
+                    run_pipelined_scenario(
+                        image_search,
+                        "pipelined",
+                        folder,
+                        manifest_path=manifest_path,
+                        max_concurrency=max_concurrency,
+                    )
+                )
+            results.append(
+                run_pipelined_scenario(
+                    image_search, "resync_unchanged", folder, reset=False, manifest_path=manifest_path
+                )
+            )
+            change_images(folder, 0.01, args.image_size)
+            results.append(
+                run_pipelined_scenario(
+                    image_search, "resync_changed", folder, reset=False, manifest_path=manifest_path
+                )
+            )
+            os.environ["CO_API_URL"] = f"http://127.0.0.1:{args.port + 1}"  # ingest_images reads it each run
+            results.append(
+                run_pipelined_scenario(
+                    image_search,
+                    "paced",
+                    paced_folder,
+                    manifest_path=manifest_path,
+                    max_concurrency=max(args.max_concurrency),
+                    requests_per_minute=args.paced_requests_per_minute,
+                )
+            )
+            os.environ["CO_API_URL"] = f"http://127.0.0.1:{args.port + 2}"
+            for name, preprocess_kwargs in (
+                ("camera_original", dict(max_side=None)),
+                ("camera_downscaled", dict()),
+                ("camera_downscaled_processes", dict(preprocess_processes=os.cpu_count())),
+            ):
+                results.append(
+                    run_pipelined_scenario(
+                        image_search, name, camera_folder, manifest_path=manifest_path, **preprocess_kwargs
+                    )
+                )
+    finally:
+        stop_mock_server(server)
+        stop_mock_server(paced_server)
+        stop_mock_server(camera_server)
+
+    for result in results:
+        print(json.dumps(result))
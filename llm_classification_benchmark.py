@@ -0,0 +1,292 @@
+"""
+LLM CLASSIFICATION BENCHMARK
+
+Measures how many tickets per second llm_classification_system.py can classify, one at a time and in
+bulk, without spending money on the real API.
+
+The benchmark starts the mock API from api_mock_server.py in a separate process and points the OpenAI
+client at it (through OPENAI_BASE_URL). The mock answers instructor's tool calls with made-up
+classifications that fit the TicketClassification schema, so the full path (request, tool call,
+validation) is exercised. Importing llm_classification_system runs its examples, which then go to
+the mock too.
+
+Each scenario reports tickets/s, CPU time, and how many tickets failed (exceptions returned in place
+of classifications).
+
+Scenarios:
+- sequential: classify_ticket called once per ticket, the way the module classified tickets before
+- concurrent: classify_tickets at each --max_concurrency
+- paced: classify_tickets for 10 seconds' worth of tickets with requests_per_minute set to the limit a second
+  mock enforces (with 429s); throughput should sit at the limit rather than bursting, with no failures
+- large_model / cascade: --num_tickets classified by gpt-4o alone, then by a gpt-4o-mini -> gpt-4o cascade at
+  --confidence_threshold; both report per-stage tickets, escalations, failures, mean latency, tokens and cost.
+  The mock makes confidences up uniformly between 0 and 1, so about that fraction of tickets is escalated,
+  and it answers every model equally fast, so the cascade's savings here are in cost, not latency
+- similar_tickets_cold / similar_tickets_warm: --num_tickets classified through an index of similar tickets at
+  --similarity_threshold, first starting empty, then with a fresh batch of tickets against the index the
+  first run saved; reports hits, hit rate, LLM calls made, and the index's size. The synthetic tickets come
+  from four templates, so nearly all should hit once the index has seen each template
+- cache_cold / cache_warm: --num_tickets drawn from a quarter as many distinct tickets, resubmitted with their case
+  and spacing changed, classified through a classification cache, first empty, then as the first run left it;
+  reports hits, hit rate, and LLM calls made (about a quarter of the tickets cold, none warm)
+
+Client CPU per ticket (mostly instructor building the tool schema, and the OpenAI client preparing the
+request) caps one process at around 100 tickets/s, however high max_concurrency goes.
+
+Example command to call script:
+```
+python llm_classification_benchmark.py --num_tickets 2000 --max_concurrency 8 32 128 --latency_seconds 0.2
+```
+
+Inputs:
+- num_tickets : int, optional
+    - tickets in each concurrent scenario
+    - if omitted, will default to 2,000
+- sequential_tickets : int, optional
+    - tickets in the sequential scenario
+    - if omitted, will default to 50
+- max_concurrency : list of int, optional
+    - concurrency limits to run the concurrent scenario at
+    - if omitted, will default to 8, 32, and 128
+- latency_seconds : float, optional
+    - mean time the mock waits before answering each request
+    - if omitted, will default to 0.2, roughly a short real completion
+- latency_distribution : str, optional
+    - "constant", "exponential", or "lognormal"; see api_mock_server.py
+    - if omitted, will default to "lognormal"
+- error_rate : float, optional
+    - fraction of requests the mock answers with a 500 (the client retries them)
+    - if omitted, will default to 0
+- confidence_threshold : float, optional
+    - confidence below which the cascade scenario escalates a ticket to gpt-4o
+    - if omitted, will default to 0.5
+- similarity_threshold : float, optional
+    - similarity above which the similar_tickets scenarios reuse a classification; the mock's bag of words
+      embeddings put tickets from one template at about 0.94
+    - if omitted, will default to 0.9
+- paced_requests_per_minute : float, optional
+    - request limit in the paced scenario
+    - if omitted, will default to 3,000
+- port : int, optional
+    - port the mock server listens on (the paced scenario's mock uses the next one)
+    - if omitted, will default to 8741
+"""
+
+# imports
+import argparse  # for running script from command line
+import asyncio  # for running classify_tickets
+import json  # for printing results
+import os  # for pointing the OpenAI client at the mock
+import random  # for varying the synthetic tickets
+import resource  # for measuring CPU time
+import tempfile  # for the saved index
+import time  # for measuring wall time
+
+from api_request_benchmark import start_mock_server, stop_mock_server
+
+
+# functions
+
+
+def synthetic_tickets(num_tickets: int) -> list:
+    """Make up support tickets, varied a little so no two requests are identical."""
+    templates = [
+        "I ordered a laptop (Order #{n}) but received a tablet instead. I need the laptop for work urgently.",
+        "I can't log into my account. The password reset email for user {n} never arrives.",
+        "I was charged twice for order #{n}. Please refund the duplicate charge.",
+        "Does the model {n} blender come with a warranty? Thinking of buying one.",
+    ]
+    return [random.choice(templates).format(n=random.randint(10_000, 99_999)) for _ in range(num_tickets)]
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def report(name: str, results: list, wall_seconds: float, cpu_used: float, **extra) -> dict:
+    return {
+        "scenario": name,
+        "tickets": len(results),
+        "wall_seconds": round(wall_seconds, 3),
+        "tickets_per_second": round(len(results) / wall_seconds, 1),
+        "cpu_seconds": round(cpu_used, 3),
+        "failed": sum(isinstance(result, Exception) for result in results),
+        **extra,
+    }
+
+
+def run_sequential_scenario(classification, num_tickets: int) -> dict:
+    tickets = synthetic_tickets(num_tickets)
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    results = []
+    for ticket_text in tickets:
+        try:
+            results.append(classification.classify_ticket(ticket_text))
+        except Exception as e:
+            results.append(e)
+    return report("sequential", results, time.time() - wall_start, cpu_seconds() - cpu_start)
+
+
+def run_concurrent_scenario(classification, name: str, num_tickets: int, **classify_kwargs) -> dict:
+    tickets = synthetic_tickets(num_tickets)
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    results = asyncio.run(classification.classify_tickets(tickets, **classify_kwargs))
+    return report(
+        name, results, time.time() - wall_start, cpu_seconds() - cpu_start, **classify_kwargs
+    )
+
+
+def run_cascade_scenario(classification, name: str, num_tickets: int, models: list, **cascade_kwargs) -> dict:
+    tickets = synthetic_tickets(num_tickets)
+    cascade = classification.ModelCascade(models, **cascade_kwargs)
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    results = asyncio.run(classification.classify_tickets(tickets, max_concurrency=64, cascade=cascade))
+    return report(
+        name,
+        results,
+        time.time() - wall_start,
+        cpu_seconds() - cpu_start,
+        cost_usd=round(sum(stats.cost() for stats in cascade.stats.values()), 6),
+        stages=cascade.summary(),
+    )
+
+
+def resubmitted_tickets(distinct_tickets: list, num_tickets: int) -> list:
+    """Draw tickets from distinct_tickets, changing case and spacing the way resubmissions do."""
+    variations = [str, str.upper, str.lower, lambda text: f"  {text}\n", lambda text: text.replace(" ", "  ")]
+    return [random.choice(variations)(random.choice(distinct_tickets)) for _ in range(num_tickets)]
+
+
+def run_cache_scenario(classification, name: str, tickets: list, cache_path: str) -> dict:
+    cache = classification.ClassificationCache(cache_path)
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    results = asyncio.run(classification.classify_tickets(tickets, max_concurrency=64, cache=cache))
+    wall_seconds, cpu_used = time.time() - wall_start, cpu_seconds() - cpu_start
+    cache.close()
+    return report(
+        name,
+        results,
+        wall_seconds,
+        cpu_used,
+        hits=cache.hits,
+        hit_rate=round(cache.hit_rate(), 4),
+        llm_calls=cache.misses,
+    )
+
+
+def run_similar_tickets_scenario(classification, name: str, num_tickets: int, index_path: str, similarity_threshold: float) -> dict:
+    """Classify through an index of similar tickets, loading it from index_path if it exists, and saving it back there."""
+    tickets = synthetic_tickets(num_tickets)
+    if os.path.exists(index_path):
+        similar_tickets = classification.SimilarTicketIndex.load(index_path, similarity_threshold)
+    else:
+        similar_tickets = classification.SimilarTicketIndex(similarity_threshold)
+    indexed_before = len(similar_tickets)
+    wall_start, cpu_start = time.time(), cpu_seconds()
+    results = asyncio.run(
+        classification.classify_tickets(tickets, max_concurrency=64, similar_tickets=similar_tickets)
+    )
+    wall_seconds, cpu_used = time.time() - wall_start, cpu_seconds() - cpu_start
+    similar_tickets.save(index_path)
+    return report(
+        name,
+        results,
+        wall_seconds,
+        cpu_used,
+        hits=similar_tickets.hits,
+        hit_rate=round(similar_tickets.hit_rate(), 4),
+        llm_calls=len(similar_tickets) - indexed_before,
+        indexed_tickets=len(similar_tickets),
+    )
+
+
+# run script
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_tickets", type=int, default=2_000)
+    parser.add_argument("--sequential_tickets", type=int, default=50)
+    parser.add_argument("--max_concurrency", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--latency_seconds", type=float, default=0.2)
+    parser.add_argument(
+        "--latency_distribution",
+        default="lognormal",
+        choices=["constant", "exponential", "lognormal"],
+    )
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--confidence_threshold", type=float, default=0.5)
+    parser.add_argument("--similarity_threshold", type=float, default=0.9)
+    parser.add_argument("--paced_requests_per_minute", type=float, default=3_000)
+    parser.add_argument("--port", type=int, default=8741)
+    args = parser.parse_args()
+
+    server_kwargs = dict(
+        latency_seconds=args.latency_seconds,
+        latency_distribution=args.latency_distribution,
+        error_rate=args.error_rate,
+    )
+    server = start_mock_server(args.port, **server_kwargs)
+    paced_server = start_mock_server(
+        args.port + 1, requests_per_minute=args.paced_requests_per_minute, **server_kwargs
+    )
+    try:
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+        working_directory = os.getcwd()
+        os.chdir(tempfile.mkdtemp())  # its examples save an index of similar tickets to the working directory
+        import llm_classification_system as classification  # its clients read the environment on import
+
+        results = [run_sequential_scenario(classification, args.sequential_tickets)]
+        for max_concurrency in args.max_concurrency:
+            results.append(
+                run_concurrent_scenario(
+                    classification, "concurrent", args.num_tickets, max_concurrency=max_concurrency
+                )
+            )
+        results.append(
+            run_cascade_scenario(classification, "large_model", args.num_tickets, ["gpt-4o"])
+        )
+        results.append(
+            run_cascade_scenario(
+                classification,
+                "cascade",
+                args.num_tickets,
+                ["gpt-4o-mini", "gpt-4o"],
+                confidence_threshold=args.confidence_threshold,
+            )
+        )
+        index_path = os.path.join(os.getcwd(), "similar_tickets.npz")
+        for name in ("similar_tickets_cold", "similar_tickets_warm"):
+            results.append(
+                run_similar_tickets_scenario(
+                    classification, name, args.num_tickets, index_path, args.similarity_threshold
+                )
+            )
+        distinct_tickets = synthetic_tickets(args.num_tickets // 4)
+        cache_path = os.path.join(os.getcwd(), "classification_cache.sqlite")
+        for name in ("cache_cold", "cache_warm"):
+            results.append(
+                run_cache_scenario(
+                    classification, name, resubmitted_tickets(distinct_tickets, args.num_tickets), cache_path
+                )
+            )
+        classification.async_client.base_url = f"http://127.0.0.1:{args.port + 1}/v1"
+        results.append(
+            run_concurrent_scenario(
+                classification,
+                "paced",
+                int(args.paced_requests_per_minute / 6),
+                max_concurrency=max(args.max_concurrency),
+                requests_per_minute=args.paced_requests_per_minute,
+            )
+        )
+    finally:
+        stop_mock_server(server)
+        stop_mock_server(paced_server)
+        os.chdir(working_directory)
+
+    for result in results:
+        print(json.dumps(result))
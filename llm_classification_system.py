@@ -2,11 +2,22 @@
 # Customer Support Ticket Classification System
 # --------------------------------------------------------------
 
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+import numpy as np
 import instructor
+from dataclasses import dataclass
 from pydantic import BaseModel, Field
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from enum import Enum
-from typing import List
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from request_pacing import RequestPacer
 
 # Sample customer support tickets
 ticket1 = """
@@ -202,4 +213,504 @@ result1 = classify_ticket(ticket1)
 result2 = classify_ticket(ticket2)
 
 print(result1.model_dump_json(indent=2))
-print(result2.model_dump_json(indent=2))
\ No newline at end of file
+print(result2.model_dump_json(indent=2))
+
+
+# --------------------------------------------------------------
+# Step 6: Classify tickets in bulk, concurrently
+# --------------------------------------------------------------
+
+"""
+classify_ticket makes one blocking call per ticket, so thousands of tickets a day means thousands of
+round trips back to back. classify_tickets sends them concurrently with the async client instead:
+- at most max_concurrency requests are in flight at once
+- at most requests_per_minute requests start in any minute, spaced evenly so bursts don't trip rate limits
+  (the client itself retries 429s and server errors, waiting as long as the API asks)
+- a ticket that fails doesn't stop the others: its result is the exception, for the caller to retry or flag
+- tickets are taken from the iterable only as slots free up, so a long stream isn't loaded up front
+
+classify_tickets returns results in the order of the tickets; stream_ticket_classifications yields
+(index, result) pairs as soon as each is ready, e.g. to route urgent tickets without waiting for the batch.
+"""
+
+async_client = instructor.patch(AsyncOpenAI(max_retries=5))
+
+
+async def classify_ticket_async(
+    ticket_text: str, model: str = "gpt-3.5-turbo", max_retries: int = 3
+) -> TicketClassification:
+    response = await async_client.chat.completions.create(
+        model=model,
+        response_model=TicketClassification,
+        temperature=0,
+        max_retries=max_retries,
+        messages=[
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT,
+            },
+            {"role": "user", "content": ticket_text}
+        ]
+    )
+    return response
+
+
+async def stream_ticket_classifications(
+    tickets: Iterable[str],
+    max_concurrency: int = 32,
+    requests_per_minute: Optional[float] = None,
+    model: str = "gpt-3.5-turbo",
+    cascade: Optional["ModelCascade"] = None,
+    similar_tickets: Optional["SimilarTicketIndex"] = None,
+    cache: Optional["ClassificationCache"] = None,
+) -> AsyncIterator[Tuple[int, Union[TicketClassification, Exception]]]:
+    """Classify tickets concurrently, yielding (index, classification or exception) as each finishes.
+
+    With a cascade, tickets go through its models (and model is ignored); with an index of similar tickets,
+    near-duplicates of tickets already in it reuse their classifications; with a cache, tickets whose
+    normalized text was classified before get the stored classification, and identical tickets in flight
+    at once share one classification. requests_per_minute paces tickets, not the requests these make.
+    """
+    pacer = RequestPacer(requests_per_minute)
+    classifier_name = cascade.name if cascade is not None else model
+    classifying: Dict[str, asyncio.Future] = {}  # cache key -> classification in flight
+
+    async def classify_with_llm(ticket_text: str) -> TicketClassification:
+        if cascade is not None:
+            return await cascade.classify(ticket_text)
+        return await classify_ticket_async(ticket_text, model)
+
+    if similar_tickets is not None and similar_tickets.classifier != classifier_name:
+        raise ValueError(
+            f"the index of similar tickets holds classifications by {similar_tickets.classifier}, not {classifier_name}"
+        )
+
+    async def classify_uncached(ticket_text: str) -> TicketClassification:
+        if similar_tickets is not None:
+            return await similar_tickets.classify(ticket_text, classify_with_llm)
+        return await classify_with_llm(ticket_text)
+
+    async def classify_cached(ticket_text: str) -> TicketClassification:
+        key = cache.key(ticket_text, classifier_name)
+        result = cache.get(key)
+        if result is not None or key in classifying:
+            cache.hits += 1
+            return result if result is not None else await asyncio.shield(classifying[key])
+        cache.misses += 1
+        classifying[key] = task = asyncio.ensure_future(classify_uncached(ticket_text))
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            del classifying[key]
+        cache.put(key, result)
+        return result
+
+    async def classify(index: int, ticket_text: str):
+        await pacer.wait()
+        try:
+            if cache is not None:
+                return index, await classify_cached(ticket_text)
+            return index, await classify_uncached(ticket_text)
+        except Exception as e:  # isolate the failure to this ticket
+            return index, e
+
+    numbered_tickets = enumerate(tickets)
+    in_flight = set()
+    try:
+        while True:
+            for index, ticket_text in itertools.islice(numbered_tickets, max_concurrency - len(in_flight)):
+                in_flight.add(asyncio.ensure_future(classify(index, ticket_text)))
+            if not in_flight:
+                return
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in in_flight:  # the caller stopped early
+            task.cancel()
+
+
+async def classify_tickets(
+    tickets: Iterable[str],
+    max_concurrency: int = 32,
+    requests_per_minute: Optional[float] = None,
+    model: str = "gpt-3.5-turbo",
+    cascade: Optional["ModelCascade"] = None,
+    similar_tickets: Optional["SimilarTicketIndex"] = None,
+    cache: Optional["ClassificationCache"] = None,
+) -> List[Union[TicketClassification, Exception]]:
+    """Classify tickets concurrently, returning results in ticket order (the exception, for a ticket that failed)."""
+    results = {}
+    async for index, result in stream_ticket_classifications(
+        tickets, max_concurrency, requests_per_minute, model, cascade, similar_tickets, cache
+    ):
+        results[index] = result
+    return [results[index] for index in range(len(results))]
+
+results = asyncio.run(classify_tickets([ticket1, ticket2]))
+
+for result in results:
+    print(result if isinstance(result, Exception) else result.model_dump_json(indent=2))
+
+
+# --------------------------------------------------------------
+# Step 7: Escalate only uncertain tickets to the larger model
+# --------------------------------------------------------------
+
+"""
+Most tickets are routine, and a small, fast model classifies them as well as gpt-4o does. A cascade
+sends every ticket to the cheap model first, and escalates to the next model only the tickets it is
+unsure of (confidence below the threshold) or whose output fails validation, so the large model's
+latency and price are paid for the hard tickets alone. The last model's answer is kept whatever its
+confidence; low-confidence results from it are the ones to flag for human review.
+
+Each stage counts its tickets, escalations, failures, latency, and tokens, so the threshold can be
+tuned against what it saves. Prices are USD per million tokens, and change; check them before relying
+on the costs.
+"""
+
+MODEL_PRICES = {  # USD per million (prompt, completion) tokens
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o": (2.50, 10.00),
+}
+
+
+@dataclass
+class CascadeStageStats:
+    model: str
+    tickets: int = 0  # tickets this stage was asked to classify
+    escalated: int = 0  # passed on for low confidence
+    failed: int = 0  # passed on (or, at the last stage, failed) for errors, including failed validation
+    seconds: float = 0.0  # total time spent in this stage's calls
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def cost(self) -> float:
+        prompt_price, completion_price = MODEL_PRICES.get(self.model, (0.0, 0.0))
+        return (self.prompt_tokens * prompt_price + self.completion_tokens * completion_price) / 1e6
+
+    def summary(self) -> dict:
+        return {
+            "model": self.model,
+            "tickets": self.tickets,
+            "escalated": self.escalated,
+            "failed": self.failed,
+            "mean_latency_seconds": round(self.seconds / self.tickets, 4) if self.tickets else None,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": round(self.cost(), 6),
+        }
+
+
+class ModelCascade:
+    """Classifies with each model in turn, cheapest first, until one is confident enough."""
+
+    def __init__(
+        self,
+        models: Sequence[str] = ("gpt-4o-mini", "gpt-4o"),
+        confidence_threshold: float = 0.8,
+    ):
+        self.models = list(models)
+        self.confidence_threshold = confidence_threshold
+        self.name = f"cascade:{'>'.join(self.models)}@{confidence_threshold}"  # identifies its results in a cache
+        self.stats: Dict[str, CascadeStageStats] = {model: CascadeStageStats(model) for model in self.models}
+
+    async def classify(self, ticket_text: str) -> TicketClassification:
+        for stage, model in enumerate(self.models):
+            is_last_stage = stage == len(self.models) - 1
+            stats = self.stats[model]
+            stats.tickets += 1
+            start = time.monotonic()
+            try:
+                # earlier stages don't re-ask on invalid output; escalating is the retry
+                result = await classify_ticket_async(ticket_text, model, max_retries=3 if is_last_stage else 1)
+            except Exception:
+                stats.seconds += time.monotonic() - start
+                stats.failed += 1
+                if is_last_stage:
+                    raise
+                continue
+            stats.seconds += time.monotonic() - start
+            usage = getattr(getattr(result, "_raw_response", None), "usage", None)
+            if usage is not None:
+                stats.prompt_tokens += usage.prompt_tokens
+                stats.completion_tokens += usage.completion_tokens
+            if result.confidence >= self.confidence_threshold or is_last_stage:
+                return result
+            stats.escalated += 1
+
+    def summary(self) -> List[dict]:
+        return [self.stats[model].summary() for model in self.models]
+
+cascade = ModelCascade(["gpt-4o-mini", "gpt-4o"], confidence_threshold=0.8)
+results = asyncio.run(classify_tickets([ticket1, ticket2], cascade=cascade))
+
+for result in results:
+    print(result if isinstance(result, Exception) else result.model_dump_json(indent=2))
+for stage in cascade.summary():
+    print(stage)
+
+
+# --------------------------------------------------------------
+# Step 8: Reuse classifications of near-duplicate tickets
+# --------------------------------------------------------------
+
+"""
+Many tickets are near-identical ("can't log in, reset email not arriving"), and each still costs a full
+structured output call. An embedding costs a tiny fraction of that, so we keep an index of the tickets
+classified so far: each new ticket is embedded and compared with all of them (brute force with NumPy,
+which takes well under a millisecond up to about 100,000 tickets). If the most similar ticket is above
+the similarity threshold, its classification is reused, with its confidence scaled by the similarity;
+otherwise the ticket is classified by the LLM and added to the index.
+
+The index is saved to a .npz file and loaded back, so it carries over between runs and keeps growing;
+hits, lookups, and the hit rate show how much it is saving. The file records the model (or cascade) that
+made its classifications and the classification version (a hash of SYSTEM_PROMPT and TicketClassification's
+schema): loading it for another classifier, or after the prompt or an enum changed, starts a new index
+rather than serving classifications the current setup wouldn't make (or can't even parse).
+"""
+
+
+def classification_version() -> str:
+    """Hash of what a classification depends on besides the ticket and model: the prompt and the schema."""
+    schema = json.dumps(TicketClassification.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(f"{SYSTEM_PROMPT}\0{schema}".encode()).hexdigest()[:16]
+
+
+class SimilarTicketIndex:
+    """Embeddings of classified tickets (unit vectors, one row each) and their classifications by classifier."""
+
+    def __init__(
+        self,
+        similarity_threshold: float = 0.95,
+        embedding_model: str = "text-embedding-3-small",
+        dimensions: int = 256,
+        classifier: str = "gpt-3.5-turbo",
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = embedding_model
+        self.dimensions = dimensions
+        self.classifier = classifier  # the model, or cascade name, whose classifications the index holds
+        self.version = classification_version()
+        self.embeddings = np.empty((0, dimensions), dtype=np.float32)  # capacity grows by doubling
+        self.classifications: List[TicketClassification] = []
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self.classifications)
+
+    async def embed(self, ticket_text: str) -> np.ndarray:
+        response = await async_client.embeddings.create(
+            model=self.embedding_model, input=ticket_text, dimensions=self.dimensions
+        )
+        embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def nearest(self, embedding: np.ndarray) -> Tuple[Optional[int], float]:
+        """Return the row of the most similar ticket and its cosine similarity (None and 0 if the index is empty)."""
+        if not len(self):
+            return None, 0.0
+        similarities = self.embeddings[: len(self)] @ embedding
+        row = int(np.argmax(similarities))
+        return row, float(similarities[row])
+
+    def add(self, embedding: np.ndarray, classification: TicketClassification) -> None:
+        if len(self) == len(self.embeddings):
+            grown = np.empty((max(2 * len(self), 1024), self.dimensions), dtype=np.float32)
+            grown[: len(self)] = self.embeddings[: len(self)]
+            self.embeddings = grown
+        self.embeddings[len(self)] = embedding
+        self.classifications.append(classification)
+
+    async def classify(self, ticket_text: str, classify_with_llm) -> TicketClassification:
+        """Reuse the classification of a near-duplicate if there is one, else call classify_with_llm and remember its result."""
+        embedding = await self.embed(ticket_text)
+        self.lookups += 1
+        row, similarity = self.nearest(embedding)
+        if row is not None and similarity >= self.similarity_threshold:
+            self.hits += 1
+            neighbor = self.classifications[row]
+            return neighbor.model_copy(update={"confidence": neighbor.confidence * similarity})
+        classification = await classify_with_llm(ticket_text)
+        self.add(embedding, classification)
+        return classification
+
+    def hit_rate(self) -> Optional[float]:
+        return self.hits / self.lookups if self.lookups else None
+
+    def save(self, path: str) -> None:
+        """Write the index to a .npz file, replacing the old one only once the new one is complete."""
+        temporary_path = path + ".tmp.npz"
+        np.savez(
+            temporary_path,
+            embeddings=self.embeddings[: len(self)],
+            classifications=np.array([c.model_dump_json() for c in self.classifications], dtype=str),
+            embedding_model=self.embedding_model,
+            classifier=self.classifier,
+            version=self.version,
+        )
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(
+        cls, path: str, similarity_threshold: float = 0.95, classifier: str = "gpt-3.5-turbo"
+    ) -> "SimilarTicketIndex":
+        """Load a saved index, or start an empty one if it was made by another classifier or classification version."""
+        with np.load(path) as saved:
+            embeddings = saved["embeddings"]
+            index = cls(similarity_threshold, str(saved["embedding_model"]), embeddings.shape[1], classifier)
+            saved_by = (str(saved["classifier"]), str(saved["version"])) if "version" in saved.files else (None, None)
+            if saved_by != (classifier, index.version):
+                print(
+                    f"Discarding {path}: its classifications are by {saved_by[0]} at version {saved_by[1]}, "
+                    f"not {classifier} at version {index.version}"
+                )
+                return index
+            index.embeddings = embeddings.astype(np.float32)
+            index.classifications = [
+                TicketClassification.model_validate_json(c) for c in saved["classifications"]
+            ]
+        return index
+
+INDEX_PATH = "classified_tickets.npz"
+similar_tickets = (
+    SimilarTicketIndex.load(INDEX_PATH) if os.path.exists(INDEX_PATH) else SimilarTicketIndex()
+)
+results = asyncio.run(classify_tickets([ticket1, ticket2, ticket2], max_concurrency=1, similar_tickets=similar_tickets))
+similar_tickets.save(INDEX_PATH)
+
+for result in results:
+    print(result if isinstance(result, Exception) else result.model_dump_json(indent=2))
+print(f"Reused {similar_tickets.hits} of {similar_tickets.lookups} classifications (hit rate {similar_tickets.hit_rate():.0%})")
+
+
+# --------------------------------------------------------------
+# Step 9: Cache classifications of identical tickets
+# --------------------------------------------------------------
+
+"""
+Retried webhooks and duplicate submissions bring the same ticket text back many times a day, and
+classifying it again gets the same answer at full price. ClassificationCache keeps classifications in
+a SQLite file, keyed on the ticket text (normalized: Unicode NFKC, case folded, whitespace collapsed)
+and the model that classified it.
+
+Every key also includes a version: a hash of SYSTEM_PROMPT and of TicketClassification's JSON schema,
+which spells out the TicketCategory, TicketUrgency, and CustomerSentiment values. Change the prompt or
+an enum and the version changes, so old classifications stop matching, and they are deleted the next
+time the cache is opened. Entries older than ttl_seconds (if set) count as missing, and past
+max_entries the least recently used are evicted.
+"""
+
+
+def normalize_ticket_text(ticket_text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", ticket_text).casefold().split())
+
+
+class ClassificationCache:
+    """SQLite store of classifications, keyed on normalized ticket text, model, and classification version."""
+
+    evict_to_fraction = 0.9  # evict down to a bit under max_entries, so eviction doesn't run on every write
+
+    def __init__(
+        self,
+        path: str = "classification_cache.sqlite",
+        max_entries: int = 100_000,
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version = classification_version()
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS classifications (
+                key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                classification TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS classifications_by_last_use ON classifications (last_used_at)"
+        )
+        # the prompt or schema changed since these were stored, so they'd never match again
+        self.connection.execute("DELETE FROM classifications WHERE version != ?", (self.version,))
+        if ttl_seconds is not None:
+            self.connection.execute(
+                "DELETE FROM classifications WHERE created_at < ?", (time.time() - ttl_seconds,)
+            )
+        (self.num_entries,) = self.connection.execute("SELECT COUNT(*) FROM classifications").fetchone()
+
+    def key(self, ticket_text: str, model: str) -> str:
+        return hashlib.sha256(
+            f"{self.version}\0{model}\0{normalize_ticket_text(ticket_text)}".encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[TicketClassification]:
+        """Return the stored classification, if there is one that hasn't expired, marking it as just used."""
+        current_time = time.time()
+        row = self.connection.execute(
+            "SELECT classification, created_at FROM classifications WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        classification, created_at = row
+        if self.ttl_seconds is not None and created_at < current_time - self.ttl_seconds:
+            return None
+        self.connection.execute(
+            "UPDATE classifications SET last_used_at = ? WHERE key = ?", (current_time, key)
+        )
+        return TicketClassification.model_validate_json(classification)
+
+    def put(self, key: str, classification: TicketClassification) -> None:
+        current_time = time.time()
+        classification_json = classification.model_dump_json()
+        inserted = self.connection.execute(
+            "INSERT OR IGNORE INTO classifications VALUES (?, ?, ?, ?, ?)",
+            (key, self.version, classification_json, current_time, current_time),
+        )
+        if inserted.rowcount:
+            self.num_entries += 1
+        else:  # a key stored before (say, by a retried webhook) is replaced, and doesn't count as another entry
+            self.connection.execute(
+                "UPDATE classifications SET classification = ?, created_at = ?, last_used_at = ? WHERE key = ?",
+                (classification_json, current_time, current_time, key),
+            )
+        if self.num_entries > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM classifications WHERE key IN (SELECT key FROM classifications ORDER BY last_used_at LIMIT ?)",
+                (self.num_entries - int(self.max_entries * self.evict_to_fraction),),
+            )
+            (self.num_entries,) = self.connection.execute("SELECT COUNT(*) FROM classifications").fetchone()
+
+    def hit_rate(self) -> Optional[float]:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else None
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def classify_ticket_cached(ticket_text: str, cache: ClassificationCache) -> TicketClassification:
+    key = cache.key(ticket_text, "gpt-3.5-turbo")  # the model classify_ticket uses
+    result = cache.get(key)
+    if result is not None:
+        cache.hits += 1
+        return result
+    cache.misses += 1
+    result = classify_ticket(ticket_text)
+    cache.put(key, result)
+    return result
+
+cache = ClassificationCache("classification_cache.sqlite", ttl_seconds=7 * 24 * 3600)
+result1 = classify_ticket_cached(ticket1, cache)
+result2 = classify_ticket_cached("  " + ticket1.upper(), cache)  # the same ticket, resubmitted in a different case
+
+print(result1.model_dump_json(indent=2))
+print(result2.model_dump_json(indent=2))
+print(f"Cache hits: {cache.hits}, misses: {cache.misses}")
@@ -0,0 +1,25 @@
+"""
+REQUEST PACING
+
+Spaces out API calls made concurrently from one event loop, so a burst of them doesn't trip a requests-per-minute
+rate limit. Shared by llm_classification_system.py and the image search backends (v3_qdrant.py, v3_numpy.py).
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+
+class RequestPacer:
+    """Spaces out request starts so no more than requests_per_minute begin in any minute."""
+
+    def __init__(self, requests_per_minute: Optional[float] = None):
+        self.seconds_between_requests = 60 / requests_per_minute if requests_per_minute else 0
+        self.next_start = time.monotonic()
+
+    async def wait(self) -> None:
+        # claim the next start time before sleeping, so concurrent callers queue up behind each other
+        now = time.monotonic()
+        start = max(now, self.next_start)
+        self.next_start = start + self.seconds_between_requests
+        await asyncio.sleep(start - now)
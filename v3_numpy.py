@@ -0,0 +1,329 @@
+from PIL import Image
+import cohere
+import numpy as np
+import os
+import asyncio
+import json
+import uuid
+from image_ingestion import embed_images, max_image_side, scan_folder
+
+# Initialize client (CO_API_URL points the async client at another endpoint). There is no database to run:
+# the index is a folder holding a memory-mapped .npy file of embeddings and a JSON file of their payloads
+co = cohere.ClientV2(api_key=os.environ.get("CO_API_KEY", "your-cohere-api-key"))
+
+# Index configuration
+index_path = os.environ.get("IMAGE_INDEX_PATH", "image_search_index")
+vector_size = 1024  # Cohere's embed-multilingual-v3.0 dimension
+quantization = os.environ.get("IMAGE_INDEX_QUANTIZATION") or None  # None, "int8", or "binary"; see VectorIndex
+default_oversampling = {"int8": 4, "binary": 32}  # candidates rescored per result asked for; rescoring a few hundred rows is cheap
+if quantization is not None and quantization not in default_oversampling:
+    raise ValueError(f"IMAGE_INDEX_QUANTIZATION must be unset, {' or '.join(map(repr, default_oversampling))}; got {quantization!r}")
+byte_bit_counts = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1, dtype=np.uint8)  # set bits in each byte value
+
+def quantize_embeddings(embeddings, quantization, rows_per_chunk=65536):
+    """Quantize normalized embeddings, returning the codes and the scale int8 codes were made with (1 for binary).
+
+    int8 maps each component to -127..127, scaled so all but the most extreme 0.1% of components fit;
+    binary keeps each component's sign, packed 8 to a byte, as Cohere's ubinary embeddings do.
+    """
+    if quantization == "int8":
+        sample = np.abs(embeddings[:: max(1, len(embeddings) // 10_000)])
+        scale = 127 / float(np.quantile(sample, 0.999)) if sample.size else 1.0
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        for start in range(0, len(embeddings), rows_per_chunk):
+            chunk = embeddings[start : start + rows_per_chunk] * scale
+            codes[start : start + rows_per_chunk] = np.clip(np.rint(chunk), -127, 127)
+        return codes, scale
+    if quantization == "binary":
+        codes = np.empty((len(embeddings), embeddings.shape[1] // 8), dtype=np.uint8)
+        for start in range(0, len(embeddings), rows_per_chunk):
+            codes[start : start + rows_per_chunk] = np.packbits(embeddings[start : start + rows_per_chunk] > 0, axis=1)
+        return codes, 1.0
+    raise ValueError(f"unknown quantization: {quantization}")
+
+def top_scored(scores, top_k):
+    """The columns of the top_k scores in each row of scores, best first, and those scores."""
+    top = np.argpartition(scores, -top_k, axis=1)[:, -top_k:]  # the top_k best, unordered
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+class VectorIndex:
+    """Normalized float32 embeddings, one row per image, in <path>/embeddings_<generation>.npy, with
+    <path>/payloads.json holding the generation and each row's file path, file name, modification time,
+    size, and content hash.
+
+    The embeddings are memory-mapped, so opening an index reads only the payloads, and the OS keeps
+    as much of the matrix in memory as searching touches. Rows are normalized, so a dot product is the
+    cosine similarity, as in the Qdrant collection.
+
+    Every write makes a new generation, with a new embeddings file, and renames the payloads file naming
+    it over the old one last; so the embeddings and payloads an index is opened with are always ones
+    written together, even if a write was cut off.
+
+    With quantization="int8" (4x smaller) or "binary" (32x smaller), a quantized copy of the embeddings,
+    kept in <path>/embeddings_<generation>_<quantization>.npz, is loaded into memory and searched first; then the best
+    top_k * oversampling candidates are rescored with their full-precision rows, read from the memory-mapped
+    file, so searching only needs the quantized copy in memory. The copy is made from the float embeddings
+    (on first open, then whenever the index is written), so an existing index can be quantized without
+    embedding anything again.
+    """
+
+    def __init__(self, path, quantization=None, oversampling=None):
+        self.path = path
+        self.quantization = quantization
+        self.oversampling = oversampling or default_oversampling.get(quantization, 1)
+        self.codes, self.scale = None, 1.0
+        self.payloads_path = os.path.join(path, "payloads.json")
+        if os.path.exists(self.payloads_path):
+            with open(self.payloads_path) as f:
+                saved = json.load(f)
+            self.generation, self.payloads = saved["generation"], saved["payloads"]
+            self.embeddings = np.load(self.embeddings_path(), mmap_mode="r")
+            if len(self.payloads) != len(self.embeddings):
+                raise ValueError(f"{path} holds {len(self.embeddings)} embeddings but {len(self.payloads)} payloads")
+        else:
+            self.generation = None
+            self.embeddings = np.zeros((0, vector_size), dtype=np.float32)
+            self.payloads = []
+        if quantization is not None:
+            self.load_codes()
+
+    def embeddings_path(self, generation=None):
+        return os.path.join(self.path, f"embeddings_{generation or self.generation}.npy")
+
+    def codes_path(self, quantization):
+        return os.path.join(self.path, f"embeddings_{self.generation}_{quantization}.npz")
+
+    def load_codes(self):
+        """Load the quantized embeddings, making (and saving) them if they are missing or out of date."""
+        if os.path.exists(self.codes_path(self.quantization)):
+            with np.load(self.codes_path(self.quantization)) as saved:
+                if len(saved["codes"]) == len(self):
+                    self.codes, self.scale = saved["codes"], float(saved["scale"])
+                    return
+        self.codes, self.scale = quantize_embeddings(self.embeddings, self.quantization)
+        if len(self):
+            with open(self.codes_path(self.quantization) + ".tmp", "wb") as f:
+                np.savez(f, codes=self.codes, scale=self.scale)
+            os.replace(self.codes_path(self.quantization) + ".tmp", self.codes_path(self.quantization))
+
+    def quantized_scores(self, queries, rows_per_block=256):
+        """Approximate scores of every row for each query, from the quantized embeddings (higher is closer)."""
+        if self.quantization == "binary":
+            # Hamming distance between the sign bits, 64 at a time (NumPy < 2 has no bitwise_count: a byte at a time)
+            query_bits = np.packbits(queries > 0, axis=1)
+            if hasattr(np, "bitwise_count"):
+                words = self.codes.view(np.uint64)
+                return np.stack([
+                    -np.bitwise_count(words ^ query).sum(axis=1, dtype=np.int32) for query in query_bits.view(np.uint64)
+                ])
+            return np.stack([-byte_bit_counts[self.codes ^ query].sum(axis=1, dtype=np.int32) for query in query_bits])
+        # NumPy has no fast int8 matrix product, so convert the codes to float a cache-sized block at a time
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        block = np.empty((rows_per_block, vector_size), dtype=np.float32)
+        for start in range(0, len(self), rows_per_block):
+            rows = block[: len(self.codes[start : start + rows_per_block])]
+            rows[...] = self.codes[start : start + rows_per_block]
+            scores[:, start : start + len(rows)] = queries @ rows.T
+        return scores
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def search(self, query_embeddings, top_k=5):
+        """The top_k rows most similar to each query, best first, as lists of (row, score) pairs, one per query.
+
+        Takes one embedding or a 2-D array of them; a batch is scored with one matrix product per block
+        of queries, which reads the embeddings once per block rather than once per query. A quantized index
+        scores the quantized embeddings instead, then rescores each query's candidates exactly.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        top_k = min(top_k, len(self))
+        if top_k == 0:
+            return [[] for _ in queries]
+        results = []
+        block_size = max(1, 2**24 // len(self))  # keeps each block's scores under 64 MB
+        for start in range(0, len(queries), block_size):
+            block = queries[start : start + block_size]
+            if self.codes is None:
+                top, top_scores = top_scored(block @ self.embeddings.T, top_k)
+            else:
+                candidates, _ = top_scored(
+                    self.quantized_scores(block), min(len(self), top_k * self.oversampling)
+                )
+                top, top_scores = [], []
+                for query, query_candidates in zip(block, candidates):
+                    query_candidates = np.sort(query_candidates)  # reads the memory-mapped rows front to back
+                    best, best_scores = top_scored((self.embeddings[query_candidates] @ query)[None], top_k)
+                    top.append(query_candidates[best[0]])
+                    top_scores.append(best_scores[0])
+            results.extend(
+                [(int(row), float(score)) for row, score in zip(rows, row_scores)]
+                for rows, row_scores in zip(top, top_scores)
+            )
+        return results
+
+    def write(self, embeddings, payloads):
+        """Replace the index's contents with a new generation, switched to by renaming one file."""
+        os.makedirs(self.path, exist_ok=True)
+        for array in embeddings:
+            if len(array) and array.shape[1] != vector_size:
+                raise ValueError(f"expected {vector_size}-dimensional embeddings, got {array.shape[1]}")
+        generation = uuid.uuid4().hex
+        num_rows = sum(len(array) for array in embeddings)
+        out = np.lib.format.open_memmap(
+            self.embeddings_path(generation), mode="w+", dtype=np.float32, shape=(num_rows, vector_size)
+        )
+        row = 0
+        for array in embeddings:
+            out[row : row + len(array)] = array
+            row += len(array)
+        out.flush()
+        del out
+        with open(self.payloads_path + ".tmp", "w") as f:
+            json.dump({"generation": generation, "payloads": payloads}, f)
+        # the commit point: until this rename, the index is the old generation
+        os.replace(self.payloads_path + ".tmp", self.payloads_path)
+        self.generation = generation
+        for entry in os.scandir(self.path):  # older generations, and any a cut-off write left behind
+            if entry.name.startswith("embeddings_") and not entry.name.startswith(f"embeddings_{generation}"):
+                os.remove(entry.path)
+        self.embeddings = np.load(self.embeddings_path(), mmap_mode="r")
+        self.payloads = payloads
+        if self.quantization is not None:
+            self.load_codes()
+
+index = VectorIndex(index_path, quantization)
+
+async def ingest_images(
+    folder_path,
+    max_concurrency=16,
+    requests_per_minute=None,
+    read_workers=8,
+    max_side=max_image_side,
+    image_format="JPEG",
+    preprocess_processes=None
+):
+    """Sync the index with a folder of images, embedding only what is new or changed, as v3_qdrant's ingest_images does.
+
+    A file whose modification time and size match its payload keeps its row without being read; a new or
+    changed file is read and hashed, and reuses the embedding of any indexed file with the same content,
+    or of one embedded earlier in the run. Only the rest is embedded, by image_ingestion.embed_images (see it for the options). Rows of files that
+    went are dropped. The index is rewritten once, at the end, so an interrupted run leaves it as it was.
+    An image that fails to read or embed is reported and skipped (and tried again next run).
+
+    Returns counts of the files indexed, embedded, unchanged, failed, and of the rows deleted, and the
+    bytes read from the embedded files and sent for them (base64 data URLs).
+    """
+    row_by_path = {payload["file_path"]: row for row, payload in enumerate(index.payloads)}
+    row_by_hash = {payload["content_hash"]: row for row, payload in enumerate(index.payloads)}
+    files = scan_folder(folder_path)
+    kept_rows, kept_payloads, changed = [], [], []
+    for path, (_, mtime_ns, size) in files.items():
+        row = row_by_path.get(path)
+        if row is not None and (index.payloads[row]["mtime_ns"], index.payloads[row]["size"]) == (mtime_ns, size):
+            kept_rows.append(row)
+            kept_payloads.append(index.payloads[row])
+        else:
+            changed.append(path)
+    counts = {"indexed": 0, "embedded": 0, "unchanged": len(kept_rows), "failed": 0, "deleted": 0,
+              "bytes_read": 0, "bytes_sent": 0}
+
+    new_vectors, new_payloads = [], []
+    new_row_by_hash = {}  # content embedded in this run -> its row in new_vectors
+    async for file_path, content_hash, embedding in embed_images(
+        changed, lambda content_hash: content_hash in row_by_hash or content_hash in new_row_by_hash, counts,
+        max_concurrency, requests_per_minute, read_workers, max_side, image_format, preprocess_processes
+    ):
+        file_name, mtime_ns, size = files[file_path]
+        payload = {"file_path": file_path, "file_name": file_name, "mtime_ns": mtime_ns, "size": size,
+                   "content_hash": content_hash}
+        if embedding is None and content_hash in row_by_hash:  # already in the index
+            kept_rows.append(row_by_hash[content_hash])
+            kept_payloads.append(payload)
+        elif embedding is None:  # embedded earlier in this run
+            new_vectors.append(new_vectors[new_row_by_hash[content_hash]])
+            new_payloads.append(payload)
+        else:
+            vector = np.asarray(embedding, dtype=np.float32)
+            new_row_by_hash.setdefault(content_hash, len(new_vectors))
+            new_vectors.append(vector / np.linalg.norm(vector))
+            new_payloads.append(payload)
+            counts["embedded"] += 1
+
+    counts["deleted"] = len(index) - len(set(kept_rows))  # old rows no file uses any more
+    order = np.argsort(kept_rows, kind="stable")  # reads the old rows front to back
+    index.write(
+        [index.embeddings[np.asarray(kept_rows, dtype=np.int64)[order]],
+         np.array(new_vectors, dtype=np.float32).reshape(-1, vector_size)],
+        [kept_payloads[i] for i in order] + new_payloads
+    )
+    counts["indexed"] = len(index)
+    return counts
+
+def load_and_embed_images(folder_path, **ingest_kwargs):
+    """Load new and changed images from folder and create embeddings (see ingest_images for the options)."""
+    return asyncio.run(ingest_images(folder_path, **ingest_kwargs))
+
+def retrieve_images_batch(queries, top_k=5):
+    """Retrieve similar images for each of several text queries, embedding them in as few calls as the API allows and searching them together."""
+    query_embs = [
+        emb
+        for start in range(0, len(queries), 96)  # the most texts one embed call takes
+        for emb in co.embed(
+            texts=queries[start : start + 96],
+            model="embed-multilingual-v3.0",
+            input_type="search_query",
+            embedding_types=["float"]
+        ).embeddings.float_
+    ]
+
+    return [
+        [
+            {
+                'file_path': index.payloads[row]['file_path'],
+                'score': score,
+                'file_name': index.payloads[row]['file_name']
+            }
+            for row, score in matches
+        ]
+        for matches in index.search(query_embs, top_k)
+    ]
+
+def retrieve_images(query, top_k=5):
+    """Retrieve similar images based on text query."""
+    return retrieve_images_batch([query], top_k)[0]
+
+def display_results(results, size=(200, 200)):
+    """Display search results with scores."""
+    print("-" * 100)
+    print("Top matches:")
+    for i, result in enumerate(results):
+        print(f"Ranking {i+1} with similarity score: {result['score']:.2f}")
+        print(f"File: {result['file_name']}")
+
+        # Open and resize image
+        img = Image.open(result['file_path'])
+        img_resized = img.resize(size)
+        display(img_resized)  # This works in Jupyter notebooks
+        print("-" * 50)
+
+# Example usage:
+if __name__ == "__main__":
+    # 1. Load and index images
+    folder_path = "data/multimodal_semantic_search"
+    counts = load_and_embed_images(folder_path)
+    print(f"Indexed {counts['indexed']} images ({counts['embedded']} embedded, {counts['deleted']} deleted)")
+
+    # 2. Perform searches
+    queries = [
+        "People wearing jewelry",
+        "People wearing green",
+        "People wearing glasses"
+    ]
+
+    for query, results in zip(queries, retrieve_images_batch(queries, top_k=2)):
+        print(f"\nSearching for: {query}")
+        display_results(results)
@@ -1,35 +1,62 @@
 from PIL import Image
 import cohere
-import base64
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 import os
+import asyncio
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from image_ingestion import embed_images, max_image_side, preprocess_image, scan_folder
 
-# Initialize clients
-co = cohere.ClientV2(api_key="your-cohere-api-key")
+# Initialize clients (the environment can override the placeholders, e.g. to use a local Qdrant with QDRANT_URL=":memory:";
+# CO_API_URL points the Cohere clients at another endpoint)
+co = cohere.ClientV2(api_key=os.environ.get("CO_API_KEY", "your-cohere-api-key"))
 qdrant_client = QdrantClient(
-    url="your-qdrant-url",
-    api_key="your-qdrant-api-key"
+    location=os.environ.get("QDRANT_URL", "your-qdrant-url"),
+    api_key=os.environ.get("QDRANT_API_KEY", "your-qdrant-api-key")
 )
 
 # Collection configuration
 collection_name = "image_search"
 vector_size = 1024  # Cohere's embed-multilingual-v3.0 dimension
 
-# Create collection
-qdrant_client.recreate_collection(
-    collection_name=collection_name,
-    vectors_config=models.VectorParams(
-        size=vector_size,
-        distance=models.Distance.COSINE
+# Quantization (None, "int8", or "binary"): Qdrant keeps quantized vectors (4x or 32x smaller) in memory and the
+# full ones on disk, searches the quantized ones first, and rescores the best oversampling x top_k with the full ones
+quantization = os.environ.get("QDRANT_QUANTIZATION") or None
+quantization_configs = {
+    "int8": models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.999, always_ram=True)
+    ),
+    "binary": models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True)),
+}
+oversampling = {"int8": 4.0, "binary": 32.0}  # see vector_search_benchmark.py for recall at each
+if quantization is not None and quantization not in quantization_configs:
+    raise ValueError(f"QDRANT_QUANTIZATION must be unset, {' or '.join(map(repr, quantization_configs))}; got {quantization!r}")
+
+# Create collection, keeping what earlier runs indexed (ingest_images syncs it with the folder)
+if not qdrant_client.collection_exists(collection_name):
+    qdrant_client.create_collection(
+        collection_name=collection_name,
+        vectors_config=models.VectorParams(
+            size=vector_size,
+            distance=models.Distance.COSINE,
+            on_disk=quantization is not None
+        ),
+        quantization_config=quantization_configs.get(quantization)
+    )
+elif quantization is not None:
+    # quantize what is already indexed, rather than embedding it all again
+    qdrant_client.update_collection(
+        collection_name=collection_name,
+        vectors_config={"": models.VectorParamsDiff(on_disk=True)},
+        quantization_config=quantization_configs[quantization]
     )
-)
 
 def image_to_base64_data_url(image_path):
     """Convert image to base64 and get embedding from Cohere."""
     with open(image_path, "rb") as f:
-        enc_img = base64.b64encode(f.read()).decode("utf-8")
-        enc_img = f"data:image/jpeg;base64,{enc_img}"
+        enc_img = preprocess_image(f.read())
 
     response = co.embed(
         model="embed-multilingual-v3.0",
@@ -40,36 +67,154 @@ def image_to_base64_data_url(image_path):
 
     return response
 
-def load_and_embed_images(folder_path):
-    """Load images from folder and create embeddings."""
-    files = os.listdir(folder_path)
-    points = []
-    
-    for i, file in enumerate(files):
-        file_path = os.path.join(folder_path, file)
-        
-        # Get embedding
-        res = image_to_base64_data_url(file_path)
-        embedding = res.embeddings.float[0]
-        
-        # Create point
-        point = models.PointStruct(
-            id=i,
-            vector=embedding,
-            payload={
-                "file_path": file_path,
-                "file_name": file
-            }
+def point_id(content_hash):
+    """A stable point ID for an image's content, so the same image always maps to the same point."""
+    return str(uuid.UUID(hex=content_hash[:32]))
+
+class IndexManifest:
+    """SQLite record of the files indexed: path, modification time, size, and content hash (which gives the point ID)."""
+
+    def __init__(self, path):
+        # written from the upsert thread, once each batch is in Qdrant
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, content_hash TEXT)"
         )
-        points.append(point)
-    
-    # Upload points to collection
-    qdrant_client.upsert(
-        collection_name=collection_name,
-        points=points
-    )
-    
-    return len(points)
+
+    def load(self):
+        return {
+            path: (mtime_ns, size, content_hash)
+            for path, mtime_ns, size, content_hash in self.connection.execute("SELECT * FROM files")
+        }
+
+    def record(self, rows):
+        self.connection.execute("BEGIN")
+        self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+        self.connection.execute("COMMIT")
+
+    def forget(self, paths):
+        self.connection.execute("BEGIN")
+        self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+        self.connection.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
+
+async def ingest_images(
+    folder_path,
+    manifest_path="image_search_manifest.sqlite",
+    max_concurrency=16,
+    requests_per_minute=None,
+    upsert_batch_size=256,
+    read_workers=8,
+    max_side=max_image_side,
+    image_format="JPEG",
+    preprocess_processes=None
+):
+    """Sync the collection with a folder of images, embedding only what is new or changed.
+
+    Each image's point ID is a hash of its content, and the manifest records every indexed file's
+    path, modification time, size, and hash. A file whose time and size match the manifest isn't read
+    at all; a new or changed file is read and hashed, and embedded only if no indexed file has the same
+    content (so a renamed file just has its point's payload updated). Points no file refers to any more,
+    like those of deleted files, are deleted, and a point whose file went while another file with the same
+    content stayed is pointed at that file. An unchanged folder costs a directory scan and no embed calls.
+
+    Files are embedded by image_ingestion.embed_images, which reads, preprocesses, and embeds them concurrently
+    (see it for max_concurrency, requests_per_minute, read_workers, max_side, image_format, and
+    preprocess_processes). Points are upserted in batches of about upsert_batch_size, in a background
+    thread, while embedding goes on, and the manifest is updated once each batch is in, so an interrupted
+    run picks up where it stopped. An image that fails to read or embed is tried again next run.
+
+    Returns counts of the files indexed, embedded, unchanged, failed, and of the points deleted, and the
+    bytes read from the embedded files and sent for them (base64 data URLs).
+    """
+    loop = asyncio.get_running_loop()
+    manifest = IndexManifest(manifest_path)
+    indexed = manifest.load()
+    if indexed and qdrant_client.count(collection_name).count == 0:
+        # the collection was wiped since the manifest was written, so nothing in it is indexed
+        manifest.forget(list(indexed))
+        indexed = {}
+    files = scan_folder(folder_path)
+    changed = [
+        path for path, (_, mtime_ns, size) in files.items()
+        if indexed.get(path, (None, None))[:2] != (mtime_ns, size)
+    ]
+    indexed_hashes = {content_hash for _, _, content_hash in indexed.values()}
+    counts = {"indexed": 0, "embedded": 0, "unchanged": len(files) - len(changed), "failed": 0, "deleted": 0,
+              "bytes_read": 0, "bytes_sent": 0}
+
+    points, rows = [], []  # waiting for the next upsert
+    upserting = None  # the upsert in flight; waited for before the next, so batches don't pile up
+
+    def upsert_and_record(batch_points, batch_rows):
+        if batch_points:
+            qdrant_client.upsert(collection_name=collection_name, points=batch_points)
+        manifest.record(batch_rows)
+
+    async def upsert():
+        nonlocal upserting, points, rows
+        if upserting is not None:
+            await upserting
+        upserting = loop.run_in_executor(upsert_executor, upsert_and_record, points, rows)
+        counts["embedded"] += len(points)
+        points, rows = [], []
+
+    with ThreadPoolExecutor(1) as upsert_executor:
+        async for file_path, content_hash, embedding in embed_images(
+            changed, indexed_hashes.__contains__, counts, max_concurrency, requests_per_minute,
+            read_workers, max_side, image_format, preprocess_processes
+        ):
+            file_name, mtime_ns, size = files[file_path]
+            rows.append((file_path, mtime_ns, size, content_hash))
+            if embedding is not None:
+                points.append(models.PointStruct(
+                    id=point_id(content_hash),
+                    vector=embedding,
+                    payload={
+                        "file_path": file_path,
+                        "file_name": file_name
+                    }
+                ))
+                indexed_hashes.add(content_hash)
+            if len(points) >= upsert_batch_size:
+                await upsert()
+        if rows:
+            await upsert()
+        if upserting is not None:
+            await upserting
+
+    # delete the points of content no file has any more: deleted files, and changed files' old versions
+    current = manifest.load()
+    deleted_paths = [path for path in current if path not in files]
+    manifest.forget(deleted_paths)
+    path_by_hash = {content_hash: path for path, (_, _, content_hash) in current.items() if path in files}
+    # content whose file went or changed, but that another file still has: its point's payload may name the old file
+    for content_hash in {
+        content_hash for path, (_, _, content_hash) in indexed.items()
+        if current[path][2] != content_hash or path not in files
+    } & path_by_hash.keys():
+        path = path_by_hash[content_hash]
+        qdrant_client.set_payload(
+            collection_name=collection_name,
+            payload={"file_path": path, "file_name": files[path][0]},
+            points=[point_id(content_hash)]
+        )
+    orphaned_hashes = {content_hash for _, _, content_hash in indexed.values()} - path_by_hash.keys()
+    if orphaned_hashes:
+        qdrant_client.delete(
+            collection_name=collection_name,
+            points_selector=models.PointIdsList(points=[point_id(content_hash) for content_hash in orphaned_hashes])
+        )
+    manifest.close()
+    counts["deleted"] = len(orphaned_hashes)
+    counts["indexed"] = len(current) - len(deleted_paths)
+    return counts
+
+def load_and_embed_images(folder_path, **ingest_kwargs):
+    """Load new and changed images from folder and create embeddings (see ingest_images for the options)."""
+    return asyncio.run(ingest_images(folder_path, **ingest_kwargs))
 
 def retrieve_images(query, top_k=5):
     """Retrieve similar images based on text query."""
@@ -79,13 +224,16 @@ def retrieve_images(query, top_k=5):
         model="embed-multilingual-v3.0",
         input_type="search_query",
         embedding_types=["float"]
-    ).embeddings.float[0]
+    ).embeddings.float_[0]
     
     # Search in Qdrant
     search_results = qdrant_client.search(
         collection_name=collection_name,
         query_vector=query_emb,
-        limit=top_k
+        limit=top_k,
+        search_params=models.SearchParams(
+            quantization=models.QuantizationSearchParams(rescore=True, oversampling=oversampling[quantization])
+        ) if quantization is not None else None
     )
     
     results = []
@@ -116,8 +264,8 @@ def display_results(results, size=(200, 200)):
 if __name__ == "__main__":
     # 1. Load and index images
     folder_path = "data/multimodal_semantic_search"
-    num_indexed = load_and_embed_images(folder_path)
-    print(f"Indexed {num_indexed} images")
+    counts = load_and_embed_images(folder_path)
+    print(f"Indexed {counts['indexed']} images ({counts['embedded']} embedded, {counts['deleted']} deleted)")
     
     # 2. Perform searches
     queries = [
@@ -1,9 +1,9 @@
 from PIL import Image
 import cohere
-import base64
 from supabase import create_client
 import os
 import numpy as np
+from image_ingestion import preprocess_image
 
 # Initialize clients
 co = cohere.ClientV2(api_key="your-cohere-api-key")
@@ -30,13 +30,18 @@ create table if not exists image_embeddings (
 create index on image_embeddings 
 using ivfflat (embedding vector_cosine_ops)
 with (lists = 100);
+
+-- Or, to keep the index 32x smaller (pgvector 0.7+), index the embeddings' sign bits instead, and search
+-- with match_images_quantized (below), which rescores its candidates with the full embeddings in the table.
+-- (embedding::halfvec(1024)) with halfvec_cosine_ops is the middle ground: 2x smaller, and needs no rescoring
+create index on image_embeddings
+using hnsw ((binary_quantize(embedding)::bit(1024)) bit_hamming_ops);
 """
 
 def image_to_base64_data_url(image_path):
     """Convert image to base64 and get embedding from Cohere."""
     with open(image_path, "rb") as f:
-        enc_img = base64.b64encode(f.read()).decode("utf-8")
-        enc_img = f"data:image/jpeg;base64,{enc_img}"
+        enc_img = preprocess_image(f.read())
 
     response = co.embed(
         model="embed-multilingual-v3.0",
@@ -56,7 +61,7 @@ def load_and_embed_images(folder_path):
         
         # Get embedding
         res = image_to_base64_data_url(file_path)
-        embedding = res.embeddings.float[0]
+        embedding = res.embeddings.float_[0]
         
         # Insert into Supabase
         data = {
@@ -70,19 +75,19 @@ def load_and_embed_images(folder_path):
     
     return len(files)
 
-def retrieve_images(query, top_k=5):
-    """Retrieve similar images based on text query."""
+def retrieve_images(query, top_k=5, quantized=False):
+    """Retrieve similar images based on text query (through the binary quantized index, if quantized)."""
     # Convert query to embedding
     query_emb = co.embed(
         texts=[query],
         model="embed-multilingual-v3.0",
         input_type="search_query",
         embedding_types=["float"]
-    ).embeddings.float[0]
+    ).embeddings.float_[0]
     
     # Search in Supabase using vector similarity
     rpc_response = supabase.rpc(
-        'match_images',  # We'll create this function below
+        'match_images_quantized' if quantized else 'match_images',  # We'll create these functions below
         {
             'query_embedding': query_emb,
             'match_count': top_k
@@ -131,6 +136,36 @@ begin
   limit match_count;
 end;
 $$;
+
+-- Searches the binary quantized index for match_count * oversampling candidates, then rescores them
+create or replace function match_images_quantized (
+  query_embedding vector(1024),
+  match_count int,
+  oversampling int default 32
+)
+returns table (
+  id bigint,
+  file_path text,
+  file_name text,
+  similarity float
+)
+language sql
+-- an HNSW scan returns at most hnsw.ef_search rows, so it has to cover the candidates (32 * top_k up to 12)
+set hnsw.ef_search = 400
+as $$
+  select
+    id,
+    file_path,
+    file_name,
+    1 - (embedding <=> query_embedding) as similarity
+  from (
+    select * from image_embeddings
+    order by binary_quantize(embedding)::bit(1024) <~> binary_quantize(query_embedding)
+    limit match_count * oversampling
+  ) candidates
+  order by embedding <=> query_embedding
+  limit match_count;
+$$;
 """
 
 # Example usage:
@@ -0,0 +1,172 @@
+"""
+VECTOR SEARCH BENCHMARK
+
+Measures how fast v3_numpy.py's in-process index answers top-k queries, without any embed calls.
+
+The benchmark fills an index in a temporary folder with synthetic embeddings (unit vectors scattered
+around a few hundred cluster centers, so that, like real image embeddings, neighbors are close and the
+rest are not), reopens it memory-mapped as retrieve_images would, and times VectorIndex.search on
+held-out queries drawn the same way, one at a time and in batches, at full precision and with each
+--quantization at each --oversampling (the candidates rescored per result asked for; at 1, rescoring
+only reorders the quantized search's results, so recall is the quantized search's own).
+
+Each result reports the index's size, quantization and oversampling, the batch size, the milliseconds per
+query (mean, median, and 99th percentile, a batch's time being split evenly among its queries), recall@k
+(the fraction of the exact top_k found), what searching keeps in memory (the float embeddings, or just
+their quantized copy), and the index's size on disk.
+
+Brute force reads every embedding once per search call, so a single query is bound by memory bandwidth:
+100k 1024-dimensional float32 vectors are 400 MB, tens of milliseconds on one core. Batching queries
+shares that read among them (a few milliseconds a query at 64 a batch, on one core); at 10k vectors,
+batches get under a millisecond a query. int8 takes a quarter of the memory and, rescoring 4 candidates a
+result, finds the exact results, but as NumPy has no fast int8 matrix product it takes about as long as
+float32. binary takes a thirty-second of the memory and answers single queries several times faster, but
+Hamming distance ranks neighbors coarsely, so it needs a few hundred candidates (oversampling 32 at top_k
+10) to find nearly all of them. Keeping the float embeddings for rescoring makes the index bigger on disk.
+
+Example command to call script:
+```
+python vector_search_benchmark.py --num_vectors 10000 100000 --batch_sizes 1 16 64
+```
+
+Inputs:
+- num_vectors : list of int, optional
+    - index sizes to measure
+    - if omitted, will default to 10,000 and 100,000
+- num_queries : int, optional
+    - queries timed at each index size and batch size
+    - if omitted, will default to 256
+- batch_sizes : list of int, optional
+    - queries per search call
+    - if omitted, will default to 1, 16, and 64
+- quantization : list of str, optional
+    - quantizations to measure besides full precision: "int8" and/or "binary"
+    - if omitted, will default to both
+- oversampling : list of int, optional
+    - oversamplings to measure each quantization at
+    - if omitted, will default to 1, 4, and 32
+- top_k : int, optional
+    - results per query
+    - if omitted, will default to 10
+- seed : int, optional
+    - seed for the synthetic embeddings
+    - if omitted, will default to 0
+"""
+
+# imports
+import argparse  # for running script from command line
+import json  # for printing results
+import os  # for pointing v3_numpy at the temporary index
+import tempfile  # for the index
+import time  # for measuring latency
+
+import numpy as np  # for the synthetic embeddings and percentiles
+
+
+# functions
+
+
+def synthetic_embeddings(rng: np.random.Generator, num_vectors: int, centers: np.ndarray, spread: float = 0.6) -> np.ndarray:
+    """Unit vectors, each a random cluster center plus gaussian noise `spread` times as long as the center."""
+    noise = rng.standard_normal((num_vectors, centers.shape[1]), dtype=np.float32)
+    noise *= spread / np.sqrt(centers.shape[1])
+    vectors = centers[rng.integers(len(centers), size=num_vectors)] + noise
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def time_search(search, queries: np.ndarray, batch_size: int, top_k: int) -> list:
+    """Milliseconds per query of each batch, after one untimed batch to page the embeddings in."""
+    search(queries[:batch_size], top_k)
+    milliseconds = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start : start + batch_size]
+        batch_start = time.perf_counter()
+        search(batch, top_k)
+        milliseconds.extend([(time.perf_counter() - batch_start) * 1000 / len(batch)] * len(batch))
+    return milliseconds
+
+
+def recall_at_k(results: list, exact_results: list) -> float:
+    """Fraction of each query's exact results found, averaged over the queries."""
+    return float(np.mean([
+        len({row for row, _ in found} & {row for row, _ in exact}) / len(exact)
+        for found, exact in zip(results, exact_results)
+    ]))
+
+
+def disk_bytes(index_path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(index_path))
+
+
+def report(
+    num_vectors: int, quantization: str, oversampling: int, batch_size: int, milliseconds: list, memory_bytes: int, **extra
+) -> dict:
+    return {
+        "vectors": num_vectors,
+        "quantization": quantization,
+        "oversampling": oversampling,
+        "batch_size": batch_size,
+        "mean_ms_per_query": round(float(np.mean(milliseconds)), 3),
+        "p50_ms_per_query": round(float(np.percentile(milliseconds, 50)), 3),
+        "p99_ms_per_query": round(float(np.percentile(milliseconds, 99)), 3),
+        "memory_mb": round(memory_bytes / 2**20, 1),
+        **extra,
+    }
+
+
+# run script
+
+
+if __name__ == "__main__":
+    # parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--num_queries", type=int, default=256)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--quantization", nargs="+", default=["int8", "binary"], choices=["int8", "binary"])
+    parser.add_argument("--oversampling", type=int, nargs="+", default=[1, 4, 32])
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ["IMAGE_INDEX_PATH"] = os.path.join(tmpdir, "unused")
+        os.environ.setdefault("CO_API_KEY", "mock-key")
+        import v3_numpy  # its index reads the environment on import
+
+        rng = np.random.default_rng(args.seed)
+        centers = rng.standard_normal((256, v3_numpy.vector_size), dtype=np.float32)
+        centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+        queries = synthetic_embeddings(rng, args.num_queries, centers)
+        results = []
+        for num_vectors in args.num_vectors:
+            index_path = os.path.join(tmpdir, f"index_{num_vectors}")
+            v3_numpy.VectorIndex(index_path).write(
+                [synthetic_embeddings(rng, num_vectors, centers)],
+                [{"file_path": f"image_{i:06d}.jpg", "file_name": f"image_{i:06d}.jpg"} for i in range(num_vectors)],
+            )
+            index = v3_numpy.VectorIndex(index_path)  # memory-mapped, as retrieve_images reads it
+            exact_results = index.search(queries, args.top_k)
+            configurations = [(None, 1)] + [
+                (quantization, oversampling) for quantization in args.quantization for oversampling in args.oversampling
+            ]
+            for quantization, oversampling in configurations:
+                if quantization is not None:
+                    index = v3_numpy.VectorIndex(index_path, quantization, oversampling)
+                recall = recall_at_k(index.search(queries, args.top_k), exact_results)
+                for batch_size in args.batch_sizes:
+                    results.append(
+                        report(
+                            num_vectors,
+                            quantization or "float32",
+                            oversampling,
+                            batch_size,
+                            time_search(index.search, queries, batch_size, args.top_k),
+                            index.embeddings.nbytes if index.codes is None else index.codes.nbytes,
+                            recall_at_k=round(recall, 4),
+                            disk_mb=round(disk_bytes(index_path) / 2**20, 1),
+                        )
+                    )
+
+    for result in results:
+        print(json.dumps(result))